@@ -0,0 +1,60 @@
+"""Compilation time of queries, depending on how many measures they have.
+
+Compiles (without executing) a query on the test cube by month and region,
+with 10, 100 and 1000 measures computed from the cube measures, some of
+them relative to the year.
+
+Needs the test database (see pypet/test/init_db.sql)::
+
+    python benchmarks/bench_compile.py [measures...]
+
+"""
+from pypet.test import BaseTestCase
+import sys
+import time
+
+
+class Fixture(BaseTestCase):
+
+    def runTest(self):
+        pass
+
+
+def measures(cube, count):
+    price = cube.m['Price']
+    quantity = cube.m['Quantity']
+    year = cube.d['time'].l['year']
+    result = []
+    for i in xrange(count):
+        if i % 10 == 9:
+            measure = (quantity * (i + 1)).percent_over(year)
+        elif i % 2:
+            measure = price / (quantity + i)
+        else:
+            measure = quantity * (i + 1) + price
+        result.append(measure.label('measure %d' % i))
+    return result
+
+
+def bench(fixture, count):
+    c = fixture.cube
+    query = (c.query.axis(c.d['time'].l['month'], c.d['store'].l['region'])
+             .measure(*measures(c, count)))
+    start = time.time()
+    sql = query._as_sql()
+    duration = time.time() - start
+    assert len(list(sql.inner_columns)) == count + 4
+    return duration
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+    fixture = Fixture()
+    fixture.setUp()
+    try:
+        for count in counts:
+            duration = bench(fixture, count)
+            print('%5d measures compiled in %7.3fs: %8.2fms per measure' % (
+                count, duration, 1000 * duration / count))
+    finally:
+        fixture.tearDown()
@@ -0,0 +1,84 @@
+"""Ingest throughput of the fact table, depending on how the aggregates are
+maintained.
+
+Loads batches of facts with a single INSERT ... SELECT statement into the
+test cube, without any aggregate trigger, with row level triggers and with
+statement level triggers, then with Cube.bulk_load (COPY) and row level
+triggers.
+
+Needs the test database (see pypet/test/init_db.sql)::
+
+    python benchmarks/bench_triggers.py [rows]
+
+"""
+from pypet.test import BaseTestCase
+from pypet.aggbuilder import AggBuilder
+import datetime
+import sys
+import time
+
+
+INSERT_BATCH = """
+    INSERT INTO facts_table (store_id, product_id, date, qty, price)
+    SELECT 1 + mod(i, 8), 1 + mod(i, 5), DATE '2009-01-01' + mod(i, 1000),
+           1 + mod(i, 20), 100 + mod(i, 500)
+    FROM generate_series(1, %d) AS i
+"""
+
+
+class Fixture(BaseTestCase):
+
+    def runTest(self):
+        pass
+
+
+def facts(rows):
+    start = datetime.date(2009, 1, 1)
+    for i in xrange(1, rows + 1):
+        yield (1 + i % 8, start + datetime.timedelta(days=i % 1000),
+               1 + i % 5, 100 + i % 500, 1 + i % 20)
+
+
+def bench(rows, trigger_level=None, bulk_load=False):
+    fixture = Fixture()
+    fixture.setUp()
+    try:
+        c = fixture.cube
+        queries = [
+            c.query.axis(c.d['time'].l['month'], c.d['store'].l['region']),
+            c.query.axis(c.d['time'].l['year'], c.d['product'].l['product'])]
+        for query in queries:
+            AggBuilder(query).build(with_trigger=trigger_level is not None,
+                                    trigger_level=trigger_level or 'ROW')
+        if bulk_load:
+            start = time.time()
+            c.bulk_load(facts(rows))
+            duration = time.time() - start
+        else:
+            conn = c.table.bind.connect()
+            start = time.time()
+            conn.execute(INSERT_BATCH % rows)
+            duration = time.time() - start
+            conn.close()
+    finally:
+        for agg in fixture.cube.aggregates:
+            fixture.cube.table.bind.execute(
+                'DROP TABLE %s CASCADE' % agg.selectable.name)
+            for prefix in ('ins', 'upd'):
+                fixture.cube.table.bind.execute(
+                    'DROP FUNCTION IF EXISTS '
+                    '"%s_trigger_function_%s"() CASCADE' % (
+                        prefix, agg.selectable.name))
+        fixture.tearDown()
+    return duration
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, level, bulk_load in (('no trigger', None, False),
+                                   ('row level', 'ROW', False),
+                                   ('statement level', 'STATEMENT', False),
+                                   ('bulk load', 'ROW', True)):
+        duration = bench(rows, level, bulk_load)
+        print('%-16s %8d rows in %7.3fs: %10.0f rows/s' % (
+            name, rows, duration, rows / duration))
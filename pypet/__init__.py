@@ -1,18 +1,22 @@
 from sqlalchemy.sql import (func, over, operators,
                             select as sql_select,
-                            cast,
-                            ColumnCollection)
+                            cast)
 from sqlalchemy import types
+from sqlalchemy.schema import Table, Column, MetaData as SchemaMetaData
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql.expression import (
-    literal,
+    literal, literal_column, true, null, union_all,
     or_, and_, ColumnClause, _Generative, _generative, _literal_as_binds)
 from collections import OrderedDict, defaultdict
-from itertools import groupby
+from itertools import groupby, count
 from functools import wraps
 
 from pypet.internals import (ValueSelect, IdSelect, OverSelect, FilterSelect,
                              AggregateSelect, PostFilterSelect, LabelSelect,
-                             OrderSelect, join_table_with_query, compile)
+                             OrderSelect, JoinGraph, Lateral,
+                             join_table_with_query, column_collection,
+                             compile)
+from pypet.ddl import CreateTableAs
 
 from pypet import aggregates
 
@@ -37,6 +41,20 @@ def wrap_filter(filter):
     return filter
 
 
+# The ranges of a computed level column matching a comparison between the
+# level and member ids, given the (lower, upper) bounds of each member.
+RANGES = {
+    operators.eq: lambda column, key: and_(column >= key[0],
+                                           column < key[1]),
+    operators.lt: lambda column, key: column < key[0],
+    operators.le: lambda column, key: column < key[1],
+    operators.gt: lambda column, key: column >= key[1],
+    operators.ge: lambda column, key: column >= key[0],
+    operators.between_op: lambda column, low, high: and_(column >= low[0],
+                                                         column < high[1]),
+}
+
+
 def operator(fun):
     @wraps(fun)
     def op_fun(self, *args):
@@ -133,7 +151,7 @@ class Measure(CubeObject):
         return self.replace_expr(aggregate.measures_expr[self.name])
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         groups = [g._simplify(query) for g in self.need_groups]
         self.need_groups = groups
         if self.name in cc:
@@ -218,7 +236,7 @@ class CountMeasure(Measure):
         return (1 * 0.8 ** (len(agg.levels))), []
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         groups = [g._simplify(query) for g in self.need_groups]
         self.need_groups = groups
         if self.name in cc:
@@ -282,7 +300,7 @@ class RelativeMeasure(Measure):
         return sum([over_score, order_score, measure_score]), dims
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         if self.name in cc:
             return Measure(self.name, cc[self.name], agg=self.agg)
         over_levels = [over_level._simplify(query) for over_level in
@@ -350,7 +368,7 @@ class ConstantMeasure(Measure):
     def _as_selects(self, cuboid):
         col = _literal_as_binds(self.constant)
         col._is_agg = self.agg
-        return [self._select_class(self, column_clause=col)]
+        return [self._select_class(self, column_clause=col, is_constant=True)]
 
     @_generative
     def replace_expr(self, expression):
@@ -379,7 +397,7 @@ class ComputedMeasure(Measure):
                                self.agg)
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         if self.name in cc:
             agg = self.agg
             return Measure(self.name, cc[self.name], agg)
@@ -438,7 +456,7 @@ class ForceAgg(Measure):
         return ForceAgg(self.measure._adapt(aggregate), agg=self.agg)
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         base = self.measure._simplify(query)
         if self.name in cc:
             col = cc[self.name]
@@ -494,9 +512,27 @@ class Filter(CubeObject):
 
     def _as_selects(self, cuboid):
         sub_operands, deps = self._build_sub_selects_and_deps(cuboid)
-        return [self._select_class(self, where_clause=self.operator(
-            *[sub.column_clause for sub in sub_operands]),
-            dependencies=sub_operands)]
+        where_clause = self._range_clause()
+        if where_clause is None:
+            where_clause = self.operator(
+                *[sub.column_clause for sub in sub_operands])
+        return [self._select_class(self, where_clause=where_clause,
+                                   dependencies=sub_operands)]
+
+    def _range_clause(self):
+        """Returns the filter as a range on the level column, if it compares
+        a computed level with bounds to member ids.
+
+        Contrary to the computed expression, the range can be answered from
+        an index or a partition on the column."""
+        level, values = self.operands[0], self.operands[1:]
+        if (not isinstance(level, ComputedLevel) or level.bounds is None or
+                level.is_label or self.operator not in RANGES or
+                not all(isinstance(value, ConstantMeasure)
+                        for value in values)):
+            return None
+        return RANGES[self.operator](level.column, *[
+            level._column_bounds(value.constant) for value in values])
 
     def __eq__(self, other):
         return (isinstance(other, Filter) and self.operator == other.operator
@@ -564,6 +600,93 @@ class OrFilter(Filter):
             dependencies=deps)]
 
 
+class MembersFilter(Filter):
+    """Filters a level on a list of member ids, compared at once to an array
+    parameter.
+
+    Above ```table_threshold``` ids, they are rather loaded in a temporary
+    table when the query is executed, and read through a semi-join, so that
+    the planner knows how many they are."""
+
+    table_threshold = 1000
+    _table_names = count()
+
+    def __init__(self, level, ids, table=None):
+        super(MembersFilter, self).__init__(operators.in_op, level)
+        self.ids = list(ids)
+        if table is None and len(self.ids) > self.table_threshold:
+            table = Table('pypet_members_%d' % next(self._table_names),
+                          SchemaMetaData(), Column('id', level.column.type),
+                          prefixes=['TEMPORARY'])
+        self.table = table
+
+    def _adapt(self, aggregate):
+        return self.__class__(self.operands[0]._adapt(aggregate), self.ids,
+                              self.table)
+
+    def _simplify(self, query):
+        return self.__class__(self.operands[0]._simplify(query), self.ids,
+                              self.table)
+
+    def _as_selects(self, cuboid):
+        sub_operands, deps = self._build_sub_selects_and_deps(cuboid)
+        column = sub_operands[0].column_clause
+        if self.table is None:
+            where_clause = column == func.any(literal(self.ids,
+                                                      ARRAY(column.type)))
+        else:
+            where_clause = column.in_(sql_select([self.table.c.id]))
+        return [self._select_class(self, where_clause=where_clause,
+                                   dependencies=sub_operands)]
+
+    def _create_table(self, conn):
+        """Creates and fills the temporary table of the ids."""
+        ids = func.unnest(literal(self.ids, ARRAY(self.table.c.id.type)))
+        conn.execute(CreateTableAs(self.table.name,
+                                   sql_select([ids.label('id')]),
+                                   temporary=True))
+        conn.execute('ANALYZE %s' %
+                     conn.dialect.identifier_preparer.format_table(
+                         self.table))
+
+    def __eq__(self, other):
+        return (isinstance(other, MembersFilter) and
+                self.operands == other.operands and self.ids == other.ids)
+
+
+def _members_filters(filter):
+    """Returns the MembersFilter read from a temporary table in the filter
+    tree."""
+    if isinstance(filter, MembersFilter):
+        return [filter] if filter.table is not None else []
+    if isinstance(filter, Filter):
+        return [sub for operand in filter.operands
+                for sub in _members_filters(operand)]
+    return []
+
+
+def _group_members(members):
+    """Returns the filters matching the given members or filters, the
+    members of a level being compared at once to the list of their ids."""
+    filters = []
+    by_level = OrderedDict()
+    for member in members:
+        if (isinstance(member, Member) and
+                not isinstance(member.level, (ComputedLevel, AllLevel))):
+            # Levels are compared by identity, their == building a filter.
+            by_level.setdefault(id(member.level),
+                                (member.level, []))[1].append(member)
+        else:
+            filters.append(wrap_filter(member))
+    for level, level_members in by_level.values():
+        if len(level_members) > 1:
+            filters.append(MembersFilter(
+                level, [member.id for member in level_members]))
+        else:
+            filters.append(wrap_filter(level_members[0]))
+    return filters
+
+
 class PostFilter(Filter):
     _select_class = PostFilterSelect
 
@@ -585,7 +708,7 @@ class Member(CutPoint):
         return Member(self.level._adapt(aggregate), self.id, self.label)
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         if self._label_for_select in cc:
             return Member(self.level._simplify(query), self.id, self.label)
         return Member(self.level._simplify(query), self.id, self.label)
@@ -594,12 +717,15 @@ class Member(CutPoint):
         subs = [sub for sub in self.level._as_selects(cuboid)
                 if isinstance(sub, IdSelect)]
         assert len(subs) == 1
+        fact_column = self.level._fact_column(cuboid)
+        id_table = (self.level.column.table if fact_column is None
+                    else fact_column.table)
         selects = [LabelSelect(self, column_clause=self.label_expression,
                                name=self._label_label_for_select,
                                joins=[self.level.label_column.table],
                                is_constant=True),
                    IdSelect(self, column_clause=self.id_expr,
-                            joins=[self.level.column.table],
+                            joins=[id_table],
                             name=self._label_for_select, is_constant=True)]
         return selects
 
@@ -647,6 +773,7 @@ class Level(CutPoint):
                              else column)
         self.name = name
         self.is_label = False
+        self.is_id = False
         self.column = column
         if label_expression is None:
             label_expression = lambda x: x
@@ -735,6 +862,11 @@ class Level(CutPoint):
     def label_only(self):
         self.is_label = True
 
+    @property
+    @_generative
+    def id_only(self):
+        self.is_id = True
+
     @_generative
     def label(self, label):
         self._level_label_key = label
@@ -748,6 +880,19 @@ class Level(CutPoint):
         return self._level_key or '%s_%s' % (self.dimension.name, self.name)
 
 
+    def _fact_column(self, cuboid):
+        """Returns the column of the cuboid table referencing the level id
+        through a foreign key, if any.
+
+        Grouping and filtering on it rather than on the level column spares
+        the join to the level table."""
+        if cuboid is None:
+            return None
+        for fk in getattr(cuboid.selectable, 'foreign_keys', ()):
+            if fk.column is self.column:
+                return fk.parent
+        return None
+
     def _as_selects(self, cuboid=None):
         sub_selects = []
         sub_joins = []
@@ -755,6 +900,28 @@ class Level(CutPoint):
             sub_selects = self.child_level._as_selects(cuboid)
             sub_joins = [elem for alist in sub_selects
                          for elem in alist.joins]
+        fact_column = self._fact_column(cuboid)
+        if fact_column is not None:
+            # The facts without a level member would not be joined to the
+            # level table.
+            where_clause = (fact_column != None if fact_column.nullable
+                            else None)
+            id_select = IdSelect(self, column_clause=fact_column,
+                                 name=self._label_for_select,
+                                 joins=[fact_column.table],
+                                 where_clause=where_clause)
+        elif self.is_id:
+            id_select = IdSelect(self, column_clause=self.column,
+                                 name=self._label_for_select,
+                                 joins=sub_joins + [self._id_column.table])
+        else:
+            id_select = IdSelect(self, column_clause=self.column,
+                                 name=self._label_for_select,
+                                 dependencies=[],
+                                 joins=sub_joins + [self._id_column.table,
+                                                    self.label_column.table])
+        if self.is_id:
+            return [id_select]
         label_select = LabelSelect(self,
                             column_clause=self._label_column,
                             name=self._label_label_for_select,
@@ -765,28 +932,30 @@ class Level(CutPoint):
         if self.is_label:
             return [label_select]
         else:
-            return [IdSelect(self, column_clause=self.column,
-                             name=self._label_for_select,
-                             dependencies=[],
-                             joins=sub_joins + [self._id_column.table,
-                                                self.label_column.table]),
-                    label_select]
-
-    def _adapt(self, aggregate):
-        for level in aggregate.levels:
-            if level.dimension == self.dimension:
-                if level.name == self.name:
-                    column = aggregate.levels.get(level)
-                    return self.replace_expr(column)
-                else:
-                    if self.child_level is None:
-                        raise KeyError('Cannot find matching level in'
-                                       'aggregate!')
-                    return self.replace_level(
-                        self.child_level._adapt(aggregate))
+            return [id_select, label_select]
+
+    def _adapt(self, aggregate, with_label=True):
+        levels = [level for level in aggregate.levels
+                  if level.dimension == self.dimension]
+        for level in levels:
+            if level.name == self.name:
+                column = aggregate.levels.get(level)
+                label = aggregate.labels.get(level)
+                if with_label and label is not None:
+                    return (self.replace_expr(column, label)
+                            .replace_label_expression(lambda x: x))
+                return self.replace_expr(column)
+        if levels:
+            if self.child_level is None:
+                raise KeyError('Cannot find matching level in'
+                               'aggregate!')
+            # The parent level is joined through the child level table,
+            # rather than through its label stored in the aggregate.
+            return self.replace_level(
+                self.child_level._adapt(aggregate, with_label=False))
 
     def _simplify(self, query):
-        cc = ColumnCollection(*query.inner_columns)
+        cc = column_collection(query)
         if self._label_for_select in cc:
             dim_expr = cc[self._label_for_select]
             label_col = self._label_label_for_select
@@ -811,7 +980,8 @@ class Level(CutPoint):
                 for value in self.members_query.distinct().execute()]
 
 
-for op_name in ('__eq__', 'like_op', 'ilike_op', '__ne__'):
+for op_name in ('__eq__', '__lt__', '__le__', '__gt__', '__ge__',
+                'like_op', 'ilike_op', '__ne__', 'between_op'):
     def dumb_closure():
         sql_op = getattr(operators, op_name.strip('_'))
         @operator
@@ -826,15 +996,57 @@ for op_name in ('__eq__', 'like_op', 'ilike_op', '__ne__'):
 
 
 
+class KeyEncoding(object):
+    """Maps the ids of a computed level to compact keys, stored in the
+    aggregate tables instead of the ids.
+
+    ```encode``` and ```decode``` convert SQL expressions, and must preserve
+    the ids order. The columns of the ```type``` type are considered as
+    holding keys, which must therefore not be the type of the ids.
+    """
+
+    def __init__(self, type, encode, decode):
+        self.type = type
+        self.encode = encode
+        self.decode = decode
+
+    def holds_keys(self, column):
+        return isinstance(column.type, self.type.__class__)
+
+
 class ComputedLevel(Level):
 
     def __init__(self, name, column=None, label_expression=None,
-                 function=lambda x: x, metadata=None):
+                 function=lambda x: x, metadata=None, bounds=None,
+                 encoding=None):
         super(ComputedLevel, self).__init__(
             name, column, label_expression=label_expression, metadata=None)
         self.function = function
+        # Returns the (lower, upper) half-open range of the values the
+        # function maps to the given member id. It must only be given for a
+        # non-decreasing function, so that the filters on the level can be
+        # turned into ranges on its column.
+        self.bounds = bounds
+        # The KeyEncoding of the level ids in the aggregates built for it.
+        self.encoding = encoding
         self.metadata = metadata or MetaData()
 
+    def _decoded(self, column):
+        """Returns the column, decoded if it holds keys."""
+        if self.encoding is not None and self.encoding.holds_keys(column):
+            return self.encoding.decode(column)
+        return column
+
+    def _column_bounds(self, id):
+        """Returns the range of the level column values belonging to the
+        member with the given id."""
+        id = _literal_as_binds(id)
+        decoded = self._decoded(self.column)
+        if decoded is self.column:
+            return self.bounds(cast(id, self.column.type))
+        return tuple(self.encoding.encode(bound)
+                     for bound in self.bounds(cast(id, decoded.type)))
+
     @_generative
     def replace_expr(self, expr, label_column=None):
         self.column = expr
@@ -855,7 +1067,11 @@ class ComputedLevel(Level):
 
     @property
     def _id_column(self):
-        return self.function(self.column).label(self.name)
+        return self.function(self._decoded(self.column)).label(self.name)
+
+    @property
+    def _label_column(self):
+        return self.label_expression(self._decoded(self.label_column))
 
     def _as_selects(self, cuboid=None):
         col = self._id_column
@@ -1047,15 +1263,77 @@ class OrderClause(CubeObject):
     def _simplify(self, query):
         return OrderClause(self.measure._simplify(query), self.reverse)
 
+    @property
+    def agg(self):
+        return self.measure.agg
+
     def _as_selects(self, cuboid):
         sub_selects = [sel for sel in self.measure._as_selects(cuboid)]
         col = sub_selects[0].column_clause
-        if is_agg(col):
+        # A column read from a subquery is only an aggregate there.
+        if not hasattr(col, '_is_agg') and is_agg(col):
             col._is_agg = is_agg(col)[0]
         return [OrderSelect(self, column_clause=col,
                 dependencies=sub_selects, reverse=self.reverse)]
 
 
+def _has_late_label(level):
+    """Returns True if the label of the level can be read afterwards from
+    the table holding it, given the level id."""
+    return (type(level) is Level and not level.is_label and
+            level.label_column is not level.column and
+            level.label_column.table is level.column.table)
+
+
+def _attach_labels(query, levels):
+    """Returns a select adding the labels of the given levels to the rows of
+    the query, which only has their ids."""
+    ordered = bool(query._order_by_clause.clauses)
+    if ordered:
+        # Joining the labels does not keep the rows order.
+        query = query.column(func.row_number().over(
+            order_by=list(query._order_by_clause)).label('row_number'))
+    rows = query.alias()
+    columns = [column for column in rows.c if column.key != 'row_number']
+    from_obj = rows
+    for level in levels:
+        table = level.label_column.table.alias()
+        from_obj = from_obj.outerjoin(
+            table,
+            table.c[level.column.key] == rows.c[level._label_for_select])
+        columns.append(level.label_expression(
+            table.c[level.label_column.key])
+            .label(level._label_label_for_select))
+    labels = sql_select(columns, from_obj=from_obj)
+    if ordered:
+        labels = labels.order_by(rows.c.row_number)
+    return labels
+
+
+def _reads_measures(filter):
+    """Returns True if the filter tree compares measures, and not only
+    levels and constants."""
+    if isinstance(filter, ConstantMeasure):
+        return False
+    if isinstance(filter, Measure):
+        return True
+    if isinstance(filter, Filter):
+        return any(_reads_measures(operand) for operand in filter.operands)
+    return False
+
+
+def _relative_measures(thing):
+    """Returns the measures computed with a window function in the given
+    measure, filter or order."""
+    if isinstance(thing, RelativeMeasure):
+        return [thing]
+    children = list(vars(thing).get('operands', []))
+    if vars(thing).get('measure') is not None:
+        children.append(vars(thing)['measure'])
+    return [measure for child in children
+            for measure in _relative_measures(child)]
+
+
 class Query(_Generative):
 
     def __init__(self, cuboid, axes, measures):
@@ -1064,6 +1342,10 @@ class Query(_Generative):
         self.measures = measures
         self.filter_clause = None
         self.orders = []
+        self.freshness = None
+        self.labels = 'early'
+        self.row_limit = None
+        self.partition_top = None
 
     def _generate(self):
         newself = super(Query, self)._generate()
@@ -1072,14 +1354,162 @@ class Query(_Generative):
         newself.measures = list(self.measures)
         return newself
 
-    def _as_sql(self):
-        best_agg = self.cuboid._find_best_agg(self.parts)
+    def _as_sql(self, cuboid=None):
+        """Compile this query to sql, against the given cuboid or, by
+        default, against the best aggregate available."""
+        query = self._top_query()
+        if query is not self:
+            return query._as_sql(cuboid)
+        if self.partition_top is not None:
+            return self._partition_top_sql(cuboid)
+        best_agg = cuboid
+        if best_agg is None:
+            best_agg = self.cuboid._find_best_agg(self.parts, self.freshness)
+            if best_agg is self.cuboid:
+                groups = self._split_measures()
+                if groups is not None:
+                    return self._split_sql(groups)
+        query = self._compile(best_agg)
+        if self.row_limit is not None:
+            query = query.limit(self.row_limit)
+        return self._late_labels_sql(query)
+
+    def _compile(self, best_agg):
+        """Returns the select computing this query from the given cuboid,
+        without the late labels."""
         query = self._adapt(best_agg)
+        if self.labels == 'late':
+            query.axes = [adapted.id_only if _has_late_label(axis)
+                          else adapted
+                          for axis, adapted in zip(self.axes, query.axes)]
         things = query.parts
         selects = [sel for t in things for sel in t._as_selects(best_agg)]
         query = sql_select([], from_obj=query.cuboid.selectable)
         return compile(selects, query, best_agg)
 
+    def _late_labels_sql(self, query):
+        """Returns the query, with the labels of the axes added afterwards if
+        they are late."""
+        if self.labels == 'late':
+            late_levels = [axis for axis in self.axes
+                           if _has_late_label(axis)]
+            if late_levels:
+                return _attach_labels(query, late_levels)
+        return query
+
+    def _split_measures(self):
+        """Returns the measures grouped by the aggregate best suited to
+        answer the query for them, as (aggregate, measures) pairs, if no
+        aggregate answers the whole query but some answer it for some of the
+        measures. Returns None otherwise.
+
+        Queries ordered, limited or filtered on their measures are not
+        split."""
+        if (len(self.measures) < 2 or self.orders or
+                self.row_limit is not None or
+                _reads_measures(self.filter_clause)):
+            return None
+        aggregates = self.cuboid._usable_aggregates(self.freshness)
+        if not aggregates:
+            return None
+        common = list(self.axes)
+        if self.filter_clause is not None:
+            common.append(self.filter_clause)
+        groups = OrderedDict()
+        for measure in self.measures:
+            agg = self.cuboid._best_of(aggregates, common + [measure])
+            groups.setdefault(id(agg), (agg, []))[1].append(measure)
+        if len(groups) < 2:
+            return None
+        return groups.values()
+
+    def _split_sql(self, groups):
+        """Returns the query computing each group of measures from its own
+        aggregate.
+
+        The rows of the groups are merged by grouping their union on the
+        axes columns, each measure being read from the rows of its group.
+        Unlike a join on the axes ids, this keeps the rows missing from some
+        of the groups, and those whose ids are null."""
+        names = [measure.name for _, measures in groups
+                 for measure in measures]
+        keys = None
+        selects = []
+        for agg, measures in groups:
+            query = self._generate()
+            query.measures = measures
+            rows = query._compile(agg).alias()
+            if keys is None:
+                keys = [column.name for column in rows.c
+                        if column.name not in names]
+            own = set(measure.name for measure in measures)
+            selects.append(sql_select(
+                [rows.c[key] for key in keys] +
+                [rows.c[name] if name in own else null().label(name)
+                 for name in names]))
+        union = union_all(*selects).alias()
+        group_by = [union.c[key] for key in keys]
+        columns = group_by + [func.max(union.c[name]).label(name)
+                              for name in names]
+        return self._late_labels_sql(
+            sql_select(columns).group_by(*group_by))
+
+    def _top_query(self):
+        """Returns the query computing the top rows requested by a
+        partitioned top.
+
+        The top rows are read by a lateral subquery per member of the
+        partition level if every window measure of the final query is
+        partitioned by that level. Otherwise, the rows are ranked by the top
+        expression and those ranked beyond the top ones are filtered out."""
+        if self.partition_top is None:
+            return self
+        n, expr, partition_by = self.partition_top
+        level = partition_by[0]
+        windows = [measure for thing in self.parts
+                   for measure in _relative_measures(thing)]
+        if (len(partition_by) == 1 and isinstance(level, Level) and
+                not isinstance(level, AllLevel) and
+                self.row_limit is None and
+                all(any(over_level is level
+                        for over_level in measure.over_levels)
+                    for measure in windows)):
+            return self
+        query = self._generate()
+        query.partition_top = None
+        query._rank_top(n, expr, partition_by)
+        return query
+
+    def _rank_top(self, n, expr, partition_by):
+        """Filters out the rows ranked beyond ```n``` by ```expr``` in each
+        member of the ```partition_by``` levels."""
+        name = 'RANK OVER %s' % expr.name
+        measure = rank(name, partition_by, [expr])
+        self.orders.append(OrderClause(measure))
+        self.append_filter(PostFilter(operators.le,
+                                      measure, ConstantMeasure(n)))
+
+    def _partition_top_sql(self, cuboid=None):
+        """Returns the top rows of each member of the partition level, each
+        read by a lateral subquery filtered on the member and limited to the
+        top rows."""
+        n, expr, (level,) = self.partition_top
+        partitions = sql_select(
+            [self.cuboid.best_agg_level(level)._id_column.label('id')]
+        ).distinct().alias('pypet_partitions')
+        member = ConstantMeasure(literal_column('pypet_partitions.id'))
+        query = self._generate()
+        query.partition_top = None
+        query.orders.insert(0, OrderClause(expr, reverse=True))
+        query.row_limit = n
+        query.append_filter(Filter(operators.eq, level, member))
+        top = Lateral(query._as_sql(cuboid), 'pypet_top')
+        order_by = [partitions.c.id]
+        if expr.name in top.c:
+            order_by.append(top.c[expr.name].desc())
+        return sql_select(
+            [top], from_obj=partitions.join(top, true())).order_by(*order_by)
+
     @property
     def parts(self):
         values = self.axes + self.measures + self.orders
@@ -1109,7 +1539,7 @@ class Query(_Generative):
     @_generative
     def filter(self, *members):
         if members:
-            members = [wrap_filter(member) for member in members]
+            members = _group_members(members)
             if len(members) > 1:
                 member = OrFilter(*members)
             else:
@@ -1125,6 +1555,25 @@ class Query(_Generative):
         else:
             self.filter_clause = filter
 
+    @_generative
+    def fresh(self, fold=True):
+        """Requires results reflecting every change made to the fact table.
+
+        Aggregates lagging behind the fact table are read along with their
+        pending changes if ```fold``` is True, and are not used otherwise.
+        """
+        self.freshness = 'fold' if fold else 'fact'
+
+    @_generative
+    def late_labels(self, late=True):
+        """Groups the rows by the axes ids only, and fetches the labels of
+        the dimension levels afterwards, for the grouped rows.
+
+        The labels are then neither read nor grouped by for every row of
+        the fact table or aggregate, but joined to the grouped rows.
+        """
+        self.labels = 'late' if late else 'early'
+
     @_generative
     def order_by(self, measure, reverse=False):
         self.orders.append(OrderClause(measure, reverse))
@@ -1149,26 +1598,63 @@ class Query(_Generative):
 
     @_generative
     def top(self, n, expr, partition_by=None):
+        """Keeps the ```n``` rows with the greatest ```expr``` values, in
+        each member of the ```partition_by``` levels if given.
+
+        Without partition, the query is ordered by ```expr``` and limited to
+        ```n``` rows. With a single partition level, the top rows are read
+        for each of its members by a lateral subquery. Rows tied with the
+        last kept one are dropped in both cases.
+
+        Otherwise, or if the final query has window measures which are not
+        partitioned by that level, the rows are ranked by ```expr``` and
+        those ranked beyond ```n``` are filtered out, keeping the ties. The
+        choice is made when the query is compiled, so that it accounts for
+        the measures added after the top."""
         if (not isinstance(partition_by, list) and partition_by is not None):
             partition_by = [partition_by]
-        order_by = [expr]
-        name = 'RANK OVER %s' % expr.name
-        measure = rank(name, partition_by, order_by)
-        self.orders.append(OrderClause(measure))
-        return self.append_filter(PostFilter(operators.le,
-                                            measure, ConstantMeasure(n)))
+        if not partition_by:
+            self.orders.insert(0, OrderClause(expr, reverse=True))
+            self.row_limit = (n if self.row_limit is None
+                              else min(n, self.row_limit))
+        elif self.partition_top is None:
+            self.partition_top = (n, expr, partition_by)
+        else:
+            self._rank_top(n, expr, partition_by)
+
+    def _execute(self, sql):
+        tables = _members_filters(self.filter_clause)
+        if not tables:
+            return ResultProxy(self, sql.execute())
+        conn = self.cuboid.selectable.bind.connect()
+        # The temporary tables are dropped with the transaction.
+        tr = conn.begin()
+        try:
+            for filter in tables:
+                filter._create_table(conn)
+            return ResultProxy(self, conn.execute(sql))
+        finally:
+            tr.rollback()
+            conn.close()
 
     def execute(self):
-        return ResultProxy(self, self._as_sql().execute())
+        query = self._top_query()
+        return query._execute(query._as_sql())
 
     def __getslice__(self, i, j):
-        return ResultProxy(self, self._as_sql().offset(i).limit(j-i).execute())
+        query = self._top_query()
+        if query is not self:
+            return query[i:j]
+        if self.row_limit is not None:
+            # The slice is taken among the top rows.
+            j = min(j, self.row_limit)
+        return self._execute(self._as_sql().offset(i).limit(max(j - i, 0)))
 
 
 class Aggregate(_Generative):
 
     def __init__(self, selectable, levels, measures, fact_count_column,
-                 fact_count_measure=None):
+                 fact_count_measure=None, labels=None):
         self.selectable = selectable
         self.fact_count_column = fact_count_column
         self.fact_count_column_name = fact_count_column.name
@@ -1180,7 +1666,32 @@ class Aggregate(_Generative):
         self.measures = OrderedDict((measure.name, measure)
                 for measure, expr in measures.items())
         self.levels = levels
+        # The columns holding the labels of some of the levels, sparing the
+        # joins to their tables.
+        self.labels = labels or {}
+        # The log of the fact table changes not yet folded into the
+        # aggregate, if it is maintained in deferred mode.
+        self.delta_log = None
+        self._join_graph = None
 
+    @property
+    def join_graph(self):
+        """The JoinGraph from the aggregate table, built on first use."""
+        if self._join_graph is None:
+            self._join_graph = JoinGraph(self.selectable)
+        return self._join_graph
+
+    def lag(self):
+        """Returns the number of fact table changes not yet folded into this
+        aggregate."""
+        if self.delta_log is None:
+            return 0
+        return self.delta_log.lag()
+
+    def folded(self):
+        """Returns an aggregate reading this one along with the fact table
+        changes not yet folded into it."""
+        return self.delta_log.folded(self)
 
     def score(self, things):
         scores, dims = zip(*[thing._score(self) for thing in things])
@@ -1201,7 +1712,10 @@ class Cube(_Generative):
 
     def __init__(self, metadata, fact_table, dimensions, measures,
             aggregates=None, fact_count_column=None,
-            fact_count_measure_name='FACT_COUNT'):
+            fact_count_measure_name='FACT_COUNT', join_paths=None):
+        """```join_paths```: maps the dimension tables which cannot be
+        joined to the fact table through a single foreign key (role-playing
+        aliases, ambiguous foreign keys) to the clause joining them."""
         self.alchemy_md = metadata
         self.dimensions = OrderedDict((dim.name, dim) for dim in dimensions)
         self.measures = OrderedDict((measure.name, measure) for measure in
@@ -1214,6 +1728,8 @@ class Cube(_Generative):
         self.fact_count_measure = CountMeasure(fact_count_measure_name)
 
         self.measures[fact_count_measure_name] = self.fact_count_measure
+        self.join_paths = join_paths or {}
+        self.join_graph = JoinGraph(self.table, self.join_paths)
 
 
     @property
@@ -1234,9 +1750,35 @@ class Cube(_Generative):
     def m(self):
         return self.measures
 
-    def _find_best_agg(self, parts):
+    def _find_best_agg(self, parts, fresh=None):
+        """Returns the aggregate best suited to answer a query made of the
+        given parts, or the cube itself.
+
+        ```fresh```: if 'fold', the aggregates lagging behind the fact table
+        are read along with their pending changes. If 'fact', they are
+        ignored.
+        """
+        return self._best_of(self._usable_aggregates(fresh), parts)
+
+    def _usable_aggregates(self, fresh=None):
+        """Returns the aggregates usable with the ```fresh``` requirement
+        of ```_find_best_agg```."""
+        aggregates = self.aggregates
+        if fresh is not None:
+            aggregates = []
+            for agg in self.aggregates:
+                if agg.lag():
+                    if fresh == 'fact':
+                        continue
+                    agg = agg.folded()
+                aggregates.append(agg)
+        return aggregates
+
+    def _best_of(self, aggregates, parts):
+        """Returns the aggregate with the best score for the parts among the
+        given ones, or the cube itself."""
         agg_scores = ((agg, agg.score(parts))
-                for agg in self.aggregates)
+                for agg in aggregates)
         best_agg, score = reduce(lambda (x, scorex), (y, scorey): (x, scorex)
                 if scorex >= scorey
                 else (y, scorey), agg_scores, (self, 0))
@@ -1244,4 +1786,16 @@ class Cube(_Generative):
 
     def best_agg_level(self, level):
         """Returns the level, using the best aggregate available."""
-        return level._adapt(self._find_best_agg([level]))
+        best_agg = self._find_best_agg([level])
+        if best_agg is self:
+            return level
+        return level._adapt(best_agg)
+
+    def bulk_load(self, data, columns=None, **kwargs):
+        """Loads facts into the fact table with COPY, maintaining the
+        aggregates once for the whole batch.
+
+        See pypet.aggbuilder.bulk_load.
+        """
+        from pypet.aggbuilder import bulk_load
+        return bulk_load(self, data, columns, **kwargs)
@@ -1,12 +1,22 @@
 from sqlalchemy.schema import (PrimaryKeyConstraint, ForeignKeyConstraint,
-                               AddConstraint, Index)
-from sqlalchemy.sql import select, func, and_, update, literal_column
+                               AddConstraint, Index, Table, Column, MetaData)
+from sqlalchemy.sql import (select, func, and_, update, delete,
+                            literal_column, literal, cast, tuple_, text,
+                            union_all)
+from sqlalchemy import types
 from sqlalchemy.sql.expression import (Executable, ClauseElement, Select,
-                                       FromClause, ColumnCollection)
+                                       FromClause, ColumnCollection,
+                                       TableClause, Alias, column)
 from sqlalchemy.ext.compiler import compiles
 from pypet import (Level, ComputedLevel, Aggregate, AllLevel, Measure,
-                   CountMeasure, aggregates)
+                   CountMeasure, MembersFilter, aggregates)
+from pypet.ddl import (InsertFromSelect, excluded, CreateTableAs,
+                       CreateFunction, DropFunction, CreateTrigger)
+from collections import namedtuple
+import itertools
 import re
+import threading
+import time
 
 
 class TriggerRow(Select):
@@ -58,6 +68,76 @@ def visit_accumulator_row(element, compiler, **kw):
     return compiler.process(element._select, **kw)
 
 
+class StandIn(object):
+    """Mixin for from clauses standing for the rows of another table, with
+    the same columns names, so that they can replace it in a query."""
+
+    def is_derived_from(self, from_clause):
+        return self.orig_table.is_derived_from(from_clause)
+
+    def corresponding_column(self, column, require_embedded=False):
+        col = self.orig_table.corresponding_column(column,
+                                                   require_embedded)
+        if col is not None:
+            return self.c[col.name]
+
+
+class TransitionTable(StandIn, TableClause):
+    """The transition table of a statement level trigger, standing for
+    the rows of the table the trigger is defined on."""
+
+    def __init__(self, orig_table, name):
+        super(TransitionTable, self).__init__(
+            name, *[column(col.name, col.type) for col in orig_table.c])
+        self.orig_table = orig_table
+
+
+class FactRows(StandIn, Alias):
+    """A subquery standing for rows of the fact table."""
+
+    def __init__(self, selectable, orig_table, name=None):
+        super(FactRows, self).__init__(selectable, name)
+        self.orig_table = orig_table
+
+
+class OpaqueAlias(Alias):
+    """An alias not telling the tables it is computed from, so that the
+    queries reading it still join them when needed."""
+
+    def is_derived_from(self, from_clause):
+        return from_clause is self
+
+
+class UpsertRow(object):
+    """A row as seen by the aggregators accumulators, built from a mapping
+    of the aggregate column names to expressions."""
+
+    def __init__(self, columns, agg):
+        self.c = columns
+        self.count = columns[agg.fact_count_column.name]
+
+
+def accumulate(agg, new_row, agg_row, old_row=None):
+    """Returns a dictionary mapping each aggregate measure column name to
+    the expression folding the new row, minus the old row if any, into the
+    aggregate row."""
+    values = {}
+    fact_count_name = agg.fact_count_column.name
+    for name, measure in agg.measures.items():
+        column_name = agg.measures_expr[name].name
+        if column_name == fact_count_name:
+            continue
+        args = [column_name, new_row, agg_row]
+        if old_row is not None:
+            args.append(old_row)
+        values[column_name] = measure.agg.accumulator(*args)
+    count = new_row.count
+    if old_row is not None:
+        count = count - old_row.count
+    values[fact_count_name] = count + func.coalesce(agg_row.count, 0)
+    return values
+
+
 class SelectInto(Select):
 
     def __init__(self, selectable, into):
@@ -73,122 +153,82 @@ def visit_select_into(element, compiler, **kw):
             compiler.process(element._select, **kw)))
 
 
-class InsertFromSelect(Executable, ClauseElement):
-    def __init__(self, table, select, destination=None):
-        self.table = table
-        self.select = select
-        self.destination = destination or self.table.c.keys()
-
-
-@compiles(InsertFromSelect)
-def visit_insert_from_select(element, compiler, **kw):
-    preparer = compiler.dialect.identifier_preparer
-    column_names = [preparer.quote_identifier(t)
-                    for t in element.destination]
-    return "INSERT INTO %s (%s) (%s)" % (
-        compiler.process(element.table, asfrom=True),
-        ', '.join(column_names),
-        compiler.process(element.select)
-    )
-
 
-class CreateTableAs(Executable, ClauseElement):
+class CreatePartitionedTable(Executable, ClauseElement):
+    """Creates a table partitioned by range on the given column, with the
+    same columns, defaults and check constraints as the ```like``` table."""
 
-    def __init__(self, table_name, select, columns=None, schema=None):
+    def __init__(self, table_name, like, column_name, schema=None,
+                 like_schema=None):
         self.table_name = table_name
+        self.like = like
+        self.column_name = column_name
         self.schema = schema
-        self.select = select
-        self.columns = columns
+        self.like_schema = like_schema
 
 
-@compiles(CreateTableAs)
-def visit_create_table_as(element, compiler, **kw):
+@compiles(CreatePartitionedTable)
+def visit_create_partitioned_table(element, compiler, **kw):
     preparer = compiler.dialect.identifier_preparer
-    table_name = preparer.quote_identifier(element.table_name)
-    if element.schema is not None:
-        table_name = '%s.%s' % (preparer.quote_identifier(element.schema),
-                                table_name)
-    return "CREATE TABLE %s AS %s" % (
-        table_name,
-        compiler.process(element.select)
-    )
-
+    return ("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING "
+            "CONSTRAINTS) PARTITION BY RANGE (%s)") % (
+        _qualified_name(preparer, element.table_name, element.schema),
+        _qualified_name(preparer, element.like, element.like_schema),
+        preparer.quote_identifier(element.column_name))
 
-class CreateFunction(Executable, ClauseElement):
 
-    _returning = False
+class CreatePartition(Executable, ClauseElement):
+    """Creates the partition of a partitioned table holding the
+    [```lower```, ```upper```) range, or its default partition if no bounds
+    are given."""
 
-    def __init__(self, name, args, return_type, body,
-                 language='plpgsql', schema=None):
-        self.name = name
-        self.args = args
-        self.return_type = return_type
-        self.language = language
-        self.body = body
+    def __init__(self, table_name, parent_name, lower=None, upper=None,
+                 schema=None):
+        self.table_name = table_name
+        self.parent_name = parent_name
+        self.lower = lower
+        self.upper = upper
         self.schema = schema
 
 
-@compiles(CreateFunction)
-def visit_create_function(element, compiler, **kw):
+@compiles(CreatePartition)
+def visit_create_partition(element, compiler, **kw):
     preparer = compiler.dialect.identifier_preparer
-    fn_name = preparer.quote_identifier(element.name)
-    if element.schema is not None:
-        fn_name = '%s.%s' % (preparer.quote_identifier(element.schema),
-                             fn_name)
-    if 'as_trigger' in kw:
-        return '%s()' % fn_name
-    params = []
-    for name, type in element.args.items():
-        if not isinstance(type, basestring):
-            type = compiler.process(type, **kw)
-        params.append('%s %s' % (name, type))
-    return_type = element.return_type
-    if not isinstance(return_type, basestring):
-        return_type = compiler.process(type, **kw)
-    result = ('CREATE FUNCTION %s (%s) RETURNS %s as $fn_body$ \n' %
-              (fn_name, ','.join(params), return_type))
-    if isinstance(element.body, ClauseElement):
-        result += compiler.process(element.body, **kw)
+    if element.lower is None:
+        bounds = 'DEFAULT'
     else:
-        result += element.body
-    result += '\n $fn_body$ language %s' % (element.language)
-    return result
+        bounds = 'FOR VALUES FROM (%s) TO (%s)' % (
+            compiler.process(literal(element.lower)),
+            compiler.process(literal(element.upper)))
+    return "CREATE TABLE %s PARTITION OF %s %s" % (
+        _qualified_name(preparer, element.table_name, element.schema),
+        _qualified_name(preparer, element.parent_name, element.schema),
+        bounds)
 
 
-class CreateTrigger(Executable, ClauseElement):
+def _qualified_name(preparer, name, schema=None):
+    name = preparer.quote_identifier(name)
+    if schema is not None:
+        name = '%s.%s' % (preparer.quote_identifier(schema), name)
+    return name
 
-    _returning = False
 
-    def __init__(self, name, when, operations, table, level, fn):
-        self.name = name
-        self.when = when
-        self.operations = operations
-        if isinstance(self.operations, basestring):
-            self.operations = [self.operations]
-        self.table = table
-        self.level = level
-        self.fn = fn
+class CreateIndexConcurrently(Executable, ClauseElement):
+
+    def __init__(self, index):
+        self.index = index
 
 
-@compiles(CreateTrigger)
-def visit_create_trigger(element, compiler, **kw):
+@compiles(CreateIndexConcurrently)
+def visit_create_index_concurrently(element, compiler, **kw):
     preparer = compiler.dialect.identifier_preparer
-    trigger_name = preparer.quote_identifier(element.name)
-    table_name = element.table
-    if isinstance(table_name, ClauseElement):
-        table_name = compiler.process(table_name, asfrom=True, **kw)
-    fn = element.fn
-    if isinstance(fn, ClauseElement):
-        fn = compiler.process(fn, as_trigger=True, **kw)
-    return """
-        CREATE TRIGGER %(name)s %(when)s %(operations)s
-        ON %(table)s FOR EACH %(level)s EXECUTE PROCEDURE %(fn)s
-        """ % dict(name=trigger_name,
-                   when=element.when,
-                   operations=' OR '.join(element.operations),
-                   table=table_name,
-                   level=element.level,
-                   fn=fn)
+    index = element.index
+    return "CREATE INDEX CONCURRENTLY %s ON %s (%s)" % (
+        preparer.quote_identifier(index.name),
+        preparer.format_table(index.table),
+        ', '.join(preparer.quote_identifier(column.name)
+                  for column in index.columns))
+
 
 
 class NamingConvention(object):
@@ -197,6 +237,7 @@ class NamingConvention(object):
 
     table_name = 'agg_{levels}'
     level_name = '{level.dimension.name}_{level.name}'
+    level_label_name = '{level.dimension.name}_{level.name}_label'
     measure_name = '{measure.name}'
     table_level_name = level_name
     table_measure_name = measure_name
@@ -206,11 +247,24 @@ class NamingConvention(object):
     trigger_function_name = 'trigger_function_{tablename}'
     trigger_name = 'trigger_{tablename}'
     idx_name = 'idx_{tablename}_{levelname}'
+    watermark_table_name = 'pypet_watermark'
+    maintenance_table_name = 'pypet_maintenance'
+    combined_trigger_prefix = 'aggs'
+    delta_table_name = 'pypet_delta_{tablename}'
+    capture_table_name = 'pypet_capture_{tablename}'
+    online_table_name = 'pypet_online_{tablename}'
+    staging_table_name = 'pypet_staging_{tablename}_{suffix}'
+    partition_name = '{tablename}_{key:%Y%m%d}'
+    default_partition_name = '{tablename}_default'
 
     @classmethod
     def build_level_name(cls, level):
         return cls.level_name.format(level=level)
 
+    @classmethod
+    def build_level_label_name(cls, level):
+        return cls.level_label_name.format(level=level)
+
     @classmethod
     def build_measure_name(cls, measure):
         return cls.measure_name.format(measure=measure)
@@ -244,6 +298,14 @@ class NamingConvention(object):
                     if splitted[1] in hierarchy.l:
                         return hierarchy.l[splitted[1]]
 
+    @classmethod
+    def find_column_as_label(cls, cube, column, levels):
+        """Returns the level, among the given ones, whose label the column
+        holds."""
+        for level in levels:
+            if column.name == cls.build_level_label_name(level):
+                return level
+
     @classmethod
     def find_column_as_measure(cls, cube, column):
         if column.name in cube.m:
@@ -254,7 +316,9 @@ class NamingConvention(object):
         if cube.fact_count_column is not None:
             if cube.fact_count_column.name == column.name:
                 return column
-        if column.name == cls.fact_count_column_name:
+        if column.name in (cls.fact_count_column_name,
+                           cube.fact_count_measure.name):
+            # The latter is the one of the aggregates built by AggBuilder.
             return column
 
     @classmethod
@@ -265,6 +329,23 @@ class NamingConvention(object):
     def build_trigger_function_name(cls, tablename):
         return cls.trigger_function_name.format(tablename=tablename)
 
+    @classmethod
+    def build_delta_table_name(cls, tablename):
+        return cls.delta_table_name.format(tablename=tablename)
+
+    @classmethod
+    def build_staging_table_name(cls, tablename, suffix):
+        return cls.staging_table_name.format(tablename=tablename,
+                                             suffix=suffix)
+
+    @classmethod
+    def build_partition_name(cls, tablename, key=None):
+        """Returns the name of the partition starting at ```key```, or of the
+        default partition if no key is given."""
+        if key is None:
+            return cls.default_partition_name.format(tablename=tablename)
+        return cls.partition_name.format(tablename=tablename, key=key)
+
 
 def table_to_aggregate(cube, table, naming_convention=NamingConvention):
     if naming_convention.matches_table_name(cube, table):
@@ -281,8 +362,247 @@ def table_to_aggregate(cube, table, naming_convention=NamingConvention):
             as_level = naming_convention.find_column_as_level(cube, col)
             if as_level:
                 levels[as_level] = col
+        labels = {}
+        for col in table.columns:
+            as_label = naming_convention.find_column_as_label(cube, col,
+                                                              levels)
+            if as_label:
+                labels[as_label] = col
         if measures and levels and fact_count_column is not None:
-            return Aggregate(table, levels, measures, fact_count_column)
+            return Aggregate(table, levels, measures, fact_count_column,
+                             labels=labels)
+
+
+def _table_key(table_name, schema=None):
+    if schema:
+        return '%s.%s' % (schema, table_name)
+    return table_name
+
+
+def _stores_label(level):
+    """Returns True if the level label is read from a dimension table, and
+    can be stored in the aggregates."""
+    return (isinstance(level, Level) and
+            not isinstance(level, (ComputedLevel, AllLevel)) and
+            level.label_column is not level.column)
+
+
+def _stored_key(level, id, column=None):
+    """Returns the value stored in the aggregates for the given level id:
+    its key if the level has a key encoding, unless ```column```, the
+    aggregate column, does not hold keys."""
+    encoding = getattr(level, 'encoding', None)
+    if encoding is None or (column is not None and
+                            not encoding.holds_keys(column)):
+        return id
+    return encoding.encode(id)
+
+
+def reflect_table(conn, metadata, table_name, schema=None,
+                  naming_convention=NamingConvention):
+    """Reflects the given table in the metadata, and returns it.
+
+    SQLAlchemy does not see partitioned tables: their columns and
+    constraints are copied from their default partition instead.
+    """
+    preparer = conn.dialect.identifier_preparer
+    relkind = conn.execute(text(
+        'SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)'),
+        table=_qualified_name(preparer, table_name, schema)).scalar()
+    key = _table_key(table_name, schema)
+    if relkind != 'p':
+        metadata.reflect(bind=conn, schema=schema, only=[table_name])
+        return metadata.tables[key]
+    if key in metadata.tables:
+        return metadata.tables[key]
+    default_name = naming_convention.build_partition_name(table_name)
+    default_key = _table_key(default_name, schema)
+    reflected = default_key in metadata.tables
+    if not reflected:
+        metadata.reflect(bind=conn, schema=schema, only=[default_name])
+    default = metadata.tables[default_key]
+    table = Table(table_name, metadata,
+                  *([col.copy() for col in default.c] +
+                    [constraint.copy() for constraint in default.constraints
+                     if isinstance(constraint, ForeignKeyConstraint)]),
+                  schema=schema)
+    if not reflected:
+        metadata.remove(default)
+    return table
+
+
+def partitions(conn):
+    """Returns a dictionary mapping the names of the partitioned tables to
+    the list of the names of their partitions."""
+    result = {}
+    for row in conn.execute(
+            'SELECT parent.relname AS parent, child.relname AS child '
+            'FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = inhparent '
+            'JOIN pg_class child ON child.oid = inhrelid '
+            "WHERE parent.relkind = 'p' "
+            'AND pg_table_is_visible(parent.oid)'):
+        result.setdefault(row.parent, []).append(row.child)
+    return result
+
+
+def create_partitions(conn, table_name, level, schema=None, until=None,
+                      naming_convention=NamingConvention, encoding=None):
+    """Creates the partitions of a table partitioned by range, one for each
+    member of the level found in the level column, up to the member of
+    ```until``` if given, along with the default partition.
+
+    ```encoding``` is the KeyEncoding of the partitioned column, if it holds
+    keys instead of ids.
+
+    The existing partitions are kept, so that this can be used to create
+    partitions ahead of time.
+    """
+    preparer = conn.dialect.identifier_preparer
+
+    def create_partition(name, *bounds):
+        if encoding is not None and bounds:
+            bounds = conn.execute(select([encoding.encode(literal(bound))
+                                          for bound in bounds])).first()
+        if conn.execute(text('SELECT to_regclass(:table) IS NULL'),
+                        table=_qualified_name(preparer, name,
+                                              schema)).scalar():
+            conn.execute(CreatePartition(name, table_name, *bounds,
+                                         schema=schema))
+    nc = naming_convention
+    create_partition(nc.build_partition_name(table_name))
+    first = level._decoded(func.min(level.column))
+    last = level._decoded(func.max(level.column))
+    if until is not None:
+        until = cast(literal(until), first.type)
+        first = func.coalesce(first, until)
+        last = func.greatest(last, until)
+    lower, last = conn.execute(select([level.function(first),
+                                       level.function(last)])).first()
+    while lower is not None and lower <= last:
+        upper = conn.execute(select([
+            level.bounds(literal(lower))[1]])).scalar()
+        create_partition(nc.build_partition_name(table_name, lower),
+                         lower, upper)
+        lower = upper
+
+
+def watermark_table(metadata, naming_convention=NamingConvention):
+    """Returns the catalog table recording, for each aggregate table, the
+    watermark of its last refresh."""
+    name = naming_convention.watermark_table_name
+    if name in metadata.tables:
+        return metadata.tables[name]
+    return Table(name, metadata,
+                 Column('table_name', types.String, primary_key=True),
+                 Column('watermark', types.String, nullable=False),
+                 Column('refreshed_at', types.DateTime,
+                        server_default=func.now()))
+
+
+def maintenance_table(metadata, naming_convention=NamingConvention):
+    """Returns the catalog table recording which aggregate tables are
+    maintained by a mode shared between the aggregates of a fact table:
+    'COMBINED' (the combined trigger) or 'DEFERRED' (the delta log)."""
+    name = naming_convention.maintenance_table_name
+    if name in metadata.tables:
+        return metadata.tables[name]
+    return Table(name, metadata,
+                 Column('fact_table', types.String, primary_key=True),
+                 Column('aggregate_table', types.String, primary_key=True),
+                 Column('mode', types.String, nullable=False))
+
+
+def maintained_aggregates(conn, cube, mode, aggregates=(),
+                          naming_convention=NamingConvention):
+    """Returns the aggregates of the cube recorded in the maintenance catalog
+    for the given mode.
+
+    The recorded aggregates must be registered on the cube, or given in
+    ```aggregates```.
+    """
+    catalog = maintenance_table(cube.alchemy_md, naming_convention)
+    catalog.create(bind=conn, checkfirst=True)
+    known = {agg.selectable.key: agg
+             for agg in list(cube.aggregates) + list(aggregates)}
+    members = []
+    for row in conn.execute(select([catalog.c.aggregate_table])
+                            .where(catalog.c.fact_table == cube.table.key)
+                            .where(catalog.c.mode == mode)
+                            .order_by(catalog.c.aggregate_table)):
+        if row.aggregate_table not in known:
+            raise ValueError('The aggregate %s maintained in %s mode is not '
+                             'registered on the cube' %
+                             (row.aggregate_table, mode.lower()))
+        members.append(known[row.aggregate_table])
+    return members
+
+
+def install_combined_trigger(conn, cube, aggregates=(),
+                             naming_convention=NamingConvention):
+    """(Re)generates the combined trigger of the cube fact table, maintaining
+    every aggregate recorded in the maintenance catalog in 'COMBINED' mode.
+
+    The recorded aggregates must be registered on the cube, or given in
+    ```aggregates```. If none is left, the trigger is dropped.
+    """
+    nc = naming_convention
+    members = maintained_aggregates(conn, cube, 'COMBINED', aggregates, nc)
+    fn_name = '%s_%s' % (nc.combined_trigger_prefix,
+                         nc.build_trigger_function_name(cube.table.name))
+    conn.execute(DropFunction(fn_name, schema=cube.table.schema))
+    if not members:
+        return
+    function_declaration = CreateFunction(
+        fn_name, {}, 'TRIGGER', CombinedTriggerBody(cube, members),
+        schema=cube.table.schema, or_replace=True)
+    conn.execute(function_declaration)
+    trigger_name = '%s_%s' % (nc.combined_trigger_prefix,
+                              nc.build_trigger_name(cube.table.name))
+    conn.execute(CreateTrigger(trigger_name, 'AFTER', ['INSERT', 'UPDATE'],
+                               cube.selectable, 'ROW',
+                               function_declaration))
+
+
+def drop_aggregate(cube, agg, naming_convention=NamingConvention):
+    """Drops an aggregate table, along with its triggers, and unregisters it
+    from the cube.
+
+    If the aggregate was maintained by the combined trigger, the trigger is
+    regenerated for the remaining aggregates. If it was the last aggregate
+    maintained in deferred mode, the delta log is dropped.
+    """
+    nc = naming_convention
+    table = agg.selectable
+    conn = cube.selectable.bind.connect()
+    tr = conn.begin()
+    catalog = maintenance_table(cube.alchemy_md, nc)
+    if catalog.exists(bind=conn):
+        mode = conn.execute(catalog.delete().where(and_(
+            catalog.c.fact_table == cube.table.key,
+            catalog.c.aggregate_table == table.key))
+            .returning(catalog.c.mode)).scalar()
+        remaining = [other for other in cube.aggregates
+                     if other is not agg]
+        old_aggregates = cube.aggregates
+        cube.aggregates = remaining
+        try:
+            if mode == 'COMBINED':
+                install_combined_trigger(conn, cube, naming_convention=nc)
+            elif mode == 'DEFERRED' and not maintained_aggregates(
+                    conn, cube, mode, naming_convention=nc):
+                DeltaLog(cube, nc).uninstall(conn)
+        finally:
+            cube.aggregates = old_aggregates
+    for prefix in ('ins', 'upd'):
+        conn.execute(DropFunction(
+            '%s_%s' % (prefix, nc.build_trigger_function_name(table.name)),
+            schema=table.schema))
+    table.drop(bind=conn)
+    tr.commit()
+    cube.alchemy_md.remove(table)
+    cube.aggregates = [other for other in cube.aggregates
+                       if other is not agg]
 
 
 def reflect_aggregates(cube, naming_convention=NamingConvention):
@@ -291,9 +611,28 @@ def reflect_aggregates(cube, naming_convention=NamingConvention):
     The sqlalchemy metadata should have been populated beforehand (via
     "reflect")
     """
+    deferred = set()
+    catalog = maintenance_table(cube.alchemy_md, naming_convention)
+    bind = cube.selectable.bind
+    if bind is not None and catalog.exists(bind=bind):
+        deferred = set(row.aggregate_table for row in bind.execute(
+            select([catalog.c.aggregate_table])
+            .where(catalog.c.fact_table == cube.table.key)
+            .where(catalog.c.mode == 'DEFERRED')))
+    partitioned = partitions(bind) if bind is not None else {}
+    skipped = set(name for names in partitioned.values() for name in names)
+    for table_name in partitioned:
+        if naming_convention.matches_table_name(cube, TableClause(table_name)):
+            reflect_table(bind, cube.alchemy_md, table_name,
+                          naming_convention=naming_convention)
     for table in cube.alchemy_md.tables.values():
+        if table.name in skipped:
+            # The partitions only hold a part of the aggregate.
+            continue
         agg = table_to_aggregate(cube, table, naming_convention)
         if agg is not None:
+            if table.key in deferred:
+                agg.delta_log = DeltaLog(cube, naming_convention)
             cube.aggregates.append(agg)
 
 
@@ -339,6 +678,9 @@ class AggTriggerBody(ClauseElement):
         primary_keys = {}
         for name, expr in self.agg.levels.items():
             primary_keys[expr.name] = self.new_row.c[expr.name]
+        # The labels depend on the keys.
+        for name, expr in self.agg.labels.items():
+            primary_keys[expr.name] = self.new_row.c[expr.name]
         return primary_keys
 
     def build_filter_clause(self):
@@ -383,6 +725,9 @@ class AggTriggerBody(ClauseElement):
     def insert_stmt(self):
         all_values = self._values_from_variable()
         all_values.update(self._pk_values_from_variable())
+        for name, expr in self.agg.labels.items():
+            all_values[expr.name] = literal_column(
+                'temp_row_for_update."%s"' % expr.name)
         cols = []
         for key in self.agg.selectable.c.keys():
             cols.append(all_values[key].label(key))
@@ -466,6 +811,512 @@ def visit_aggtriggerbody(elt, compiler, **kw):
     return fn_body
 
 
+# Guards the cube metadata against concurrent reflections.
+_metadata_lock = threading.Lock()
+
+BuildReport = namedtuple('BuildReport', ('aggregate', 'source', 'duration'))
+
+
+def lattice_order(builders):
+    """Sort aggregate builders so that every aggregate comes after the
+    aggregates from the same batch it can be derived from.
+
+    Builders whose aggregates are equivalent keep their relative order.
+    """
+    remaining = list(builders)
+    ordered = []
+    while remaining:
+        for builder in remaining:
+            if not any(other.covers(builder) and not builder.covers(other)
+                       for other in remaining if other is not builder):
+                break
+        remaining.remove(builder)
+        ordered.append(builder)
+    return ordered
+
+
+def aggregate_select(cube, agg):
+    """Returns the select statement computing the rows of the aggregate from
+    the fact table, its columns being named after the aggregate ones."""
+    measures = [measure for name, measure in agg.measures.items()
+                if name != agg.fact_count_measure.name]
+    sql_query = (cube.query.axis(*agg.levels.keys())
+                 .measure(*(measures +
+                            [CountMeasure(cube.fact_count_measure.name)]))
+                 ._as_sql(cube).alias())
+    columns = [_stored_key(level, sql_query.c[level._label_for_select],
+                           column).label(column.name)
+               for level, column in agg.levels.items()]
+    columns += [sql_query.c[level._label_label_for_select].label(column.name)
+                for level, column in agg.labels.items()]
+    columns += [sql_query.c[measure.name].label(
+        agg.measures_expr[measure.name].name) for measure in measures]
+    columns.append(sql_query.c[cube.fact_count_measure.name].label(
+        agg.fact_count_column.name))
+    return select(columns)
+
+
+def upsert_stmt(cube, sql_query, agg, rows):
+    """Returns the statement merging the given fact rows into the aggregate.
+
+    ```sql_query``` is the select computing the aggregate rows from the fact
+    table, and ```rows``` a from clause standing for the fact table.
+    """
+    table = agg.selectable
+    new_rows = sql_query.replace_selectable(cube.selectable, rows)
+    proposed = UpsertRow({col.name: excluded(col.name)
+                          for col in table.c}, agg)
+    return InsertFromSelect(
+        table, new_rows,
+        destination=[col.key for col in new_rows.c],
+        on_conflict=[key.name for key in table.primary_key.columns],
+        update=accumulate(agg, proposed, UpsertRow(table.c, agg)))
+
+
+def retract_stmt(cube, sql_query, agg, rows):
+    """Returns the statement subtracting the given fact rows from the
+    aggregate rows they belong to."""
+    table = agg.selectable
+    old_rows = sql_query.replace_selectable(cube.selectable, rows).alias()
+    zero = UpsertRow({col.name: literal(0) for col in table.c}, agg)
+    values = accumulate(agg, zero, UpsertRow(table.c, agg),
+                        UpsertRow(old_rows.c, agg))
+    return (update(table)
+            .values(values)
+            .where(and_(*[key == old_rows.c[key.name]
+                          for key in table.primary_key.columns])))
+
+
+def delete_empty_stmt(cube, sql_query, agg, rows):
+    """Returns the statement deleting the aggregate rows the given fact rows
+    belong to, if they are left without any fact."""
+    table = agg.selectable
+    old_rows = sql_query.replace_selectable(cube.selectable, rows).alias()
+    keys = [key.name for key in table.primary_key.columns]
+    return (delete(table)
+            .where(table.c[agg.fact_count_column.name] == 0)
+            .where(tuple_(*[table.c[key] for key in keys]).in_(
+                select([old_rows.c[key] for key in keys]))))
+
+
+class StatementTriggerBody(ClauseElement):
+    """The body of a statement level trigger function, maintaining an
+    aggregate from the transition tables of the fact table.
+
+    The transition rows are aggregated by the aggregate levels, so that each
+    aggregate row is updated only once per statement: the old rows (for an
+    update) are first subtracted from the matching aggregate rows, the
+    aggregate rows left without any fact being deleted, then the new rows
+    are merged with an INSERT ... ON CONFLICT DO UPDATE.
+    """
+
+    body_template = """
+        BEGIN
+            %(statements)s
+            RETURN NULL;
+        END;
+    """
+
+    def __init__(self, cube, sql_query, agg, new_table=None, old_table=None):
+        self.cube = cube
+        self.sql_query = sql_query
+        self.agg = agg
+        self.new_table = new_table
+        self.old_table = old_table
+
+    def statements(self):
+        args = (self.cube, self.sql_query, self.agg)
+        statements = []
+        if self.old_table is not None:
+            old_rows = TransitionTable(self.cube.selectable, self.old_table)
+            statements.append(retract_stmt(*(args + (old_rows,))))
+            statements.append(delete_empty_stmt(*(args + (old_rows,))))
+        if self.new_table is not None:
+            new_rows = TransitionTable(self.cube.selectable, self.new_table)
+            statements.append(upsert_stmt(*(args + (new_rows,))))
+        return statements
+
+
+@compiles(StatementTriggerBody)
+def visit_statement_trigger_body(elt, compiler, **kw):
+    return elt.body_template % dict(statements='\n'.join(
+        '%s;' % compiler.process(stmt, **kw)
+        for stmt in elt.statements()))
+
+
+class CombinedTriggerBody(ClauseElement):
+    """The body of a row level trigger function maintaining several
+    aggregates at once.
+
+    The levels keys and measures values of the fact row are computed by a
+    single query, then each aggregate is merged with an INSERT ... ON
+    CONFLICT DO UPDATE. On update, the old row is first subtracted from the
+    aggregate rows it belongs to, which are deleted if left without any
+    fact.
+    """
+
+    body_template = """
+        DECLARE
+            new_keys RECORD;
+            old_keys RECORD;
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                %(old_into_stmt)s;
+                %(retract_stmts)s
+            END IF;
+            %(new_into_stmt)s;
+            %(upsert_stmts)s
+            RETURN NULL;
+        END;
+    """
+
+    def __init__(self, cube, aggregates):
+        self.cube = cube
+        self.aggregates = aggregates
+        for agg in aggregates:
+            if not agg.selectable.primary_key.columns:
+                raise ValueError('Cannot maintain an aggregate without a '
+                                 'primary key: %s' % agg.selectable.name)
+        levels = []
+        measures = []
+        for agg in aggregates:
+            for level in agg.levels:
+                if not any(level is other for other in levels):
+                    levels.append(level)
+            for name, measure in agg.measures.items():
+                if (name != agg.fact_count_measure.name and
+                        name not in [m.name for m in measures]):
+                    measures.append(measure)
+        measures.append(CountMeasure(cube.fact_count_measure.name))
+        self.sql_query = (cube.query.axis(*levels).measure(*measures)
+                          ._as_sql(cube))
+
+    def into_stmt(self, row, variable):
+        trigger_row = TriggerRow(self.cube.selectable, row)
+        return SelectInto(self.sql_query.replace_selectable(
+            self.cube.selectable, trigger_row).alias(), variable)
+
+    def row(self, agg, variable):
+        """Returns the UpsertRow reading the aggregate columns from the
+        record variable."""
+        fields = {}
+        for name, column in agg.measures_expr.items():
+            fields[column.name] = literal_column('%s."%s"' % (variable, name))
+        fields[agg.fact_count_column.name] = literal_column('%s."%s"' % (
+            variable, self.cube.fact_count_measure.name))
+        for level, column in agg.levels.items():
+            fields[column.name] = _stored_key(level, literal_column(
+                '%s."%s"' % (variable, level._label_for_select)), column)
+        for level, column in agg.labels.items():
+            fields[column.name] = literal_column('%s."%s"' % (
+                variable, level._label_label_for_select))
+        return UpsertRow(fields, agg)
+
+    def retract_stmt(self, agg):
+        table = agg.selectable
+        old_row = self.row(agg, 'old_keys')
+        zero = UpsertRow({col.name: literal(0) for col in table.c}, agg)
+        keys = table.primary_key.columns
+        return (update(table)
+                .values(accumulate(agg, zero, UpsertRow(table.c, agg),
+                                   old_row))
+                .where(and_(*[key == old_row.c[key.name]
+                              for key in keys])))
+
+    def delete_empty_stmt(self, agg):
+        table = agg.selectable
+        old_row = self.row(agg, 'old_keys')
+        return (delete(table)
+                .where(table.c[agg.fact_count_column.name] == 0)
+                .where(and_(*[key == old_row.c[key.name]
+                              for key in table.primary_key.columns])))
+
+    def upsert_stmt(self, agg):
+        table = agg.selectable
+        new_row = self.row(agg, 'new_keys')
+        proposed = UpsertRow({col.name: excluded(col.name)
+                              for col in table.c}, agg)
+        return InsertFromSelect(
+            table,
+            select([value.label(name)
+                    for name, value in new_row.c.items()]),
+            destination=new_row.c.keys(),
+            on_conflict=[key.name for key in table.primary_key.columns],
+            update=accumulate(agg, proposed, UpsertRow(table.c, agg)))
+
+
+@compiles(CombinedTriggerBody)
+def visit_combined_trigger_body(elt, compiler, **kw):
+    def process_all(statements):
+        return '\n'.join('%s;' % compiler.process(stmt, **kw)
+                         for stmt in statements)
+    return elt.body_template % dict(
+        old_into_stmt=compiler.process(elt.into_stmt('OLD', 'old_keys'),
+                                       **kw),
+        retract_stmts=process_all(stmt for agg in elt.aggregates
+                                  for stmt in (elt.retract_stmt(agg),
+                                               elt.delete_empty_stmt(agg))),
+        new_into_stmt=compiler.process(elt.into_stmt('NEW', 'new_keys'),
+                                       **kw),
+        upsert_stmts=process_all(elt.upsert_stmt(agg)
+                                 for agg in elt.aggregates))
+
+
+class DeltaTriggerBody(ClauseElement):
+    """The body of the statement level trigger function appending the fact
+    table changes to the delta log: the new rows with a sign of 1, and the
+    old ones with a sign of -1."""
+
+    body_template = """
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                %(old_stmt)s;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                %(new_stmt)s;
+            END IF;
+            RETURN NULL;
+        END;
+    """
+
+    def __init__(self, delta_log):
+        self.delta_log = delta_log
+
+    def log_stmt(self, name, sign):
+        fact_table = self.delta_log.cube.table
+        rows = TransitionTable(fact_table, name)
+        names = [col.name for col in fact_table.c]
+        return InsertFromSelect(
+            self.delta_log.table,
+            select([literal(sign)] + [rows.c[name] for name in names]),
+            destination=['pypet_sign'] + names)
+
+
+@compiles(DeltaTriggerBody)
+def visit_delta_trigger_body(elt, compiler, **kw):
+    return elt.body_template % dict(
+        old_stmt=compiler.process(elt.log_stmt(DeltaLog.old_table, -1),
+                                  **kw),
+        new_stmt=compiler.process(elt.log_stmt(DeltaLog.new_table, 1),
+                                  **kw))
+
+
+class DeltaLog(object):
+    """The log of the fact table changes not yet folded into the aggregates
+    maintained in deferred mode.
+
+    Statement level triggers append each inserted fact row to the log with a
+    sign of 1, and each deleted one with a sign of -1, an update being
+    logged as both. The fact table writers thus never touch the aggregates,
+    the logged changes being folded into them by batches with ```merge```,
+    typically from a worker process calling ```run```.
+    """
+
+    new_table = 'pypet_new_rows'
+    old_table = 'pypet_old_rows'
+
+    def __init__(self, cube, naming_convention=NamingConvention,
+                 table_name=None):
+        """```table_name```: the name of the log table, which defaults to the
+        delta table of the naming convention."""
+        self.cube = cube
+        self.naming_convention = naming_convention
+        fact_table = cube.table
+        name = (table_name or
+                naming_convention.build_delta_table_name(fact_table.name))
+        key = name
+        if fact_table.schema:
+            key = '%s.%s' % (fact_table.schema, name)
+        with _metadata_lock:
+            if key in cube.alchemy_md.tables:
+                self.table = cube.alchemy_md.tables[key]
+            else:
+                self.table = Table(
+                    name, cube.alchemy_md,
+                    Column('pypet_delta_id', types.BigInteger,
+                           primary_key=True),
+                    Column('pypet_xid', types.BigInteger, nullable=False,
+                           server_default=text('txid_current()')),
+                    Column('pypet_sign', types.SmallInteger, nullable=False),
+                    *[Column(col.name, col.type) for col in fact_table.c],
+                    schema=fact_table.schema)
+
+    @property
+    def function_name(self):
+        return self.naming_convention.build_trigger_function_name(
+            self.table.name)
+
+    def install(self, conn):
+        """Creates the log table if needed, and (re)installs the triggers
+        logging the fact table changes."""
+        nc = self.naming_convention
+        fact_table = self.cube.table
+        self.table.create(bind=conn, checkfirst=True)
+        conn.execute(DropFunction(self.function_name,
+                                  schema=fact_table.schema))
+        function_declaration = CreateFunction(
+            self.function_name, {}, 'TRIGGER', DeltaTriggerBody(self),
+            schema=fact_table.schema)
+        conn.execute(function_declaration)
+        for prefix, operation, referencing in (
+                ('ins', 'INSERT', {'NEW': self.new_table}),
+                ('upd', 'UPDATE', {'NEW': self.new_table,
+                                   'OLD': self.old_table}),
+                ('del', 'DELETE', {'OLD': self.old_table})):
+            trigger_name = '%s_%s' % (
+                prefix, nc.build_trigger_name(self.table.name))
+            conn.execute(CreateTrigger(trigger_name, 'AFTER', [operation],
+                                       self.cube.selectable, 'STATEMENT',
+                                       function_declaration,
+                                       referencing=referencing))
+
+    def uninstall(self, conn):
+        """Drops the logging triggers and the log table."""
+        conn.execute(DropFunction(self.function_name,
+                                  schema=self.cube.table.schema))
+        self.table.drop(bind=conn, checkfirst=True)
+        with _metadata_lock:
+            self.cube.alchemy_md.remove(self.table)
+
+    def lag(self):
+        """Returns the number of changes not yet folded into the
+        aggregates."""
+        return (select([func.count()]).select_from(self.table)
+                .execute().scalar())
+
+    def rows(self, sign, upto=None):
+        """Returns a subquery standing for the logged fact rows of the given
+        sign, up to the ```upto``` delta id if given."""
+        query = (select([self.table.c[col.name] for col in self.cube.table.c])
+                 .where(self.table.c.pypet_sign == sign))
+        if upto is not None:
+            query = query.where(self.table.c.pypet_delta_id <= upto)
+        name = self.new_table if sign > 0 else self.old_table
+        return FactRows(query, self.cube.table, name)
+
+    def merge(self, conn=None, batch_size=10000, aggregates=None):
+        """Folds a batch of the oldest logged changes into the given
+        aggregates, defaulting to every deferred aggregate, then removes them
+        from the log.
+
+        The new rows are merged first, so that the aggregate rows the old
+        ones are subtracted from always exist. The aggregate rows left
+        without any fact are deleted.
+
+        If ```conn``` is given, the merge takes place in its current
+        transaction. A ```batch_size``` of None merges every logged change.
+
+        Returns the number of changes merged.
+        """
+        cube = self.cube
+        own_conn = conn is None
+        if own_conn:
+            # A single snapshot for the whole merge, so that the changes
+            # logged meanwhile are neither folded nor removed.
+            conn = cube.selectable.bind.connect().execution_options(
+                isolation_level='REPEATABLE READ')
+        tr = conn.begin()
+        try:
+            merged = self._merge(conn, batch_size, aggregates)
+            tr.commit()
+        except:
+            tr.rollback()
+            raise
+        finally:
+            if own_conn:
+                conn.close()
+        return merged
+
+    def _merge(self, conn, batch_size, aggregates):
+        """Merges a batch of the logged changes within the transaction of the
+        connection."""
+        cube = self.cube
+        # Mergers exclude each other, but not the fact table writers.
+        conn.execute('LOCK TABLE %s IN SHARE UPDATE EXCLUSIVE MODE' %
+                     conn.dialect.identifier_preparer.format_table(
+                         self.table))
+        delta_id = self.table.c.pypet_delta_id
+        batch = select([delta_id]).order_by(delta_id)
+        if batch_size is not None:
+            batch = batch.limit(batch_size)
+        upto = conn.execute(select([func.max(batch.alias().c.pypet_delta_id)])
+                            ).scalar()
+        merged = 0
+        if upto is not None:
+            new_rows = self.rows(1, upto)
+            old_rows = self.rows(-1, upto)
+            if aggregates is None:
+                aggregates = maintained_aggregates(
+                    conn, cube, 'DEFERRED',
+                    naming_convention=self.naming_convention)
+            for agg in aggregates:
+                sql_query = aggregate_select(cube, agg)
+                conn.execute(upsert_stmt(cube, sql_query, agg, new_rows))
+                conn.execute(retract_stmt(cube, sql_query, agg, old_rows))
+                conn.execute(delete_empty_stmt(cube, sql_query, agg,
+                                               old_rows))
+            merged = conn.execute(self.table.delete()
+                                  .where(delta_id <= upto)).rowcount
+        return merged
+
+    def run(self, interval=1, batch_size=10000, stop=None):
+        """Merges the logged changes until the ```stop``` event, if any, is
+        set, waiting ```interval``` seconds whenever the log is empty."""
+        while stop is None or not stop.is_set():
+            if not self.merge(batch_size=batch_size):
+                if stop is not None:
+                    stop.wait(interval)
+                else:
+                    time.sleep(interval)
+
+    def folded(self, agg):
+        """Returns an aggregate reading the rows of the given one along with
+        the pending changes, pre-aggregated by its levels."""
+        cube = self.cube
+        table = agg.selectable
+        sql_query = aggregate_select(cube, agg)
+        new_rows = sql_query.replace_selectable(
+            cube.selectable, self.rows(1)).alias()
+        old_rows = sql_query.replace_selectable(
+            cube.selectable, self.rows(-1)).alias()
+        measures = {agg.measures_expr[name].name: measure
+                    for name, measure in agg.measures.items()}
+        inverse = []
+        for col in table.c:
+            value = old_rows.c[col.name]
+            if col.name in measures:
+                value = measures[col.name].agg.inverse(value)
+            inverse.append(value.label(col.name))
+        rows = union_all(
+            select(list(table.c)),
+            select([new_rows.c[col.name] for col in table.c]),
+            select(inverse)).alias()
+        # Fold the rows sharing the same keys, dropping the ones left
+        # without any fact.
+        rows_agg = Aggregate(rows, {}, {},
+                             rows.c[agg.fact_count_column.name])
+        keys = [rows.c[col.name]
+                for col in agg.levels.values() + agg.labels.values()]
+        fact_count = func.sum(rows_agg.fact_count_column)
+        selectable = OpaqueAlias(
+            select(keys + [measure.agg(rows.c[name], rows_agg).label(name)
+                           for name, measure in measures.items()])
+            .group_by(*keys)
+            .having(fact_count != 0),
+            '%s_folded' % table.name)
+        return Aggregate(
+            selectable,
+            {level: selectable.c[col.name]
+             for level, col in agg.levels.items()},
+            {agg.measures[name]: selectable.c[col.name]
+             for name, col in agg.measures_expr.items()
+             if name != agg.fact_count_measure.name},
+            selectable.c[agg.fact_count_column.name],
+            fact_count_measure=agg.fact_count_measure,
+            labels={level: selectable.c[col.name]
+                    for level, col in agg.labels.items()})
+
+
 class AggBuilder(object):
     """Aggregate builder.
 
@@ -506,6 +1357,147 @@ class AggBuilder(object):
                     'An aggregate query MUST NOT contain'
                     'any measure not defined on the cube itself')
 
+    @property
+    def axes(self):
+        """The levels stored in the aggregate, excluding "All" levels."""
+        return filter(lambda x: not isinstance(x, AllLevel), self.query.axes)
+
+    @property
+    def measures(self):
+        """The measures stored in the aggregate."""
+        return filter(lambda x: type(x) == Measure, self.query.measures)
+
+    def stored_levels(self, with_ancestors=False):
+        """The levels whose ids are stored in the aggregate: its axes, and
+        if ```with_ancestors``` the dimension levels above them."""
+        levels = list(self.axes)
+        if with_ancestors:
+            for axis in self.axes:
+                level = axis.parent_level
+                while (isinstance(level, Level) and
+                       not isinstance(level, (ComputedLevel, AllLevel))):
+                    levels.append(level)
+                    level = level.parent_level
+        return levels
+
+    def covers(self, other):
+        """Returns True if the aggregate built by this builder can answer the
+        query of the other builder."""
+        levels = {axis.dimension.name: axis for axis in self.axes}
+        for axis in other.axes:
+            level = levels.get(axis.dimension.name)
+            if level is None or level.hierarchy is not axis.hierarchy:
+                return False
+            if (level.hierarchy.level_index(level) <
+                    axis.hierarchy.level_index(axis)):
+                return False
+        names = set(measure.name for measure in self.measures)
+        return all(measure.name in names for measure in other.measures)
+
+    def _build_query(self):
+        """Returns the query used to populate the aggregate, with the fact
+        count measure added."""
+        cube = self.query.cuboid
+        query = self.query._generate()
+        query.measures.append(CountMeasure(cube.fact_count_measure.name))
+        return query
+
+    def _populate_select(self, source, member=None, with_labels=False,
+                         with_ancestors=False):
+        """Returns the select statement computing the aggregate rows from the
+        given cuboid, along with a dictionary mapping each axis to its
+        column.
+
+        If ```member``` is given, only the rows belonging to it are computed.
+        See ```build``` for the other parameters.
+        """
+        axis_columns = {}
+        level_columns = []
+        measure_columns = []
+        cube = self.query.cuboid
+        nc = self.naming_convention
+        levels = self.stored_levels(with_ancestors)
+        query = self._build_query().axis(*levels)
+        if member is not None:
+            query = query.filter(member)
+        sql_query = query._as_sql(source)
+        # Work on the "raw" query to add the fact count column
+        sql_query = sql_query.alias()
+        fact_count_col = (sql_query.c[cube.fact_count_measure.name])
+        # Build aliases for axes and measures
+        for axis in self.axes:
+            label = nc.build_level_name(axis)
+            axis_columns[axis] = _stored_key(
+                axis, sql_query.c[axis._label_for_select]).label(label)
+        for level in levels[len(self.axes):]:
+            level_columns.append(sql_query.c[level._label_for_select]
+                                 .label(nc.build_level_name(level)))
+        if with_labels:
+            for level in filter(_stores_label, levels):
+                level_columns.append(
+                    sql_query.c[level._label_label_for_select]
+                    .label(nc.build_level_label_name(level)))
+        for measure in self.measures:
+            label = nc.build_measure_name(measure)
+            measure_columns.append(sql_query.c[measure.name].label(label))
+        return (select(axis_columns.values() + level_columns +
+                       measure_columns + [fact_count_col]),
+                axis_columns)
+
+    def _stored_options(self, agg):
+        """Returns the ```_populate_select``` options matching the columns
+        of the given aggregate."""
+        return {'with_labels': bool(agg.labels),
+                'with_ancestors': len(agg.levels) > len(self.axes)}
+
+    def find_source(self, sizes=None):
+        """Returns the smallest cuboid able to answer this builder's query.
+
+        Every registered aggregate is considered, the fact table being used
+        only if no aggregate matches. ```sizes``` is an optional dictionary
+        caching the aggregates row counts between calls.
+        """
+        cube = self.query.cuboid
+        parts = self._build_query().parts
+        sizes = {} if sizes is None else sizes
+        source = cube
+        for agg in cube.aggregates:
+            if agg.score(parts) < 0:
+                continue
+            if agg not in sizes:
+                sizes[agg] = (select([func.count()])
+                              .select_from(agg.selectable)
+                              .execute().scalar())
+            if source is cube or sizes[agg] < sizes[source]:
+                source = agg
+        return source
+
+    @classmethod
+    def build_many(cls, queries, naming_convention=NamingConvention,
+                   **kwargs):
+        """Builds an aggregate table for each of the given queries.
+
+        The aggregates are built from the finest to the coarsest, each one
+        being populated from the smallest already built aggregate able to
+        answer it instead of the fact table.
+
+        The keyword arguments are passed to ```build```.
+
+        Returns a list of BuildReport, giving for each aggregate the table
+        it has been built from and the time it took.
+        """
+        builders = lattice_order([cls(query, naming_convention)
+                                  for query in queries])
+        sizes = {}
+        reports = []
+        for builder in builders:
+            start = time.time()
+            source = builder.find_source(sizes)
+            agg = builder.build(source=source, **kwargs)
+            reports.append(BuildReport(agg, source.selectable,
+                                       time.time() - start))
+        return reports
+
     def build_trigger(self, conn, cube, sql_query, agg,
                       nc=NamingConvention):
         fn_name = 'ins_%s' % nc.build_trigger_function_name(
@@ -515,7 +1507,7 @@ class AggBuilder(object):
         function_declaration = CreateFunction(fn_name, {}, 'TRIGGER', fn_body,
                                               schema=agg.selectable.schema)
         conn.execute(function_declaration)
-        trigger_name = '"ins_%s"' % nc.build_trigger_name(agg.selectable.name)
+        trigger_name = 'ins_%s' % nc.build_trigger_name(agg.selectable.name)
         conn.execute(CreateTrigger(trigger_name, 'BEFORE', ['INSERT'],
                                    cube.selectable, 'ROW',
                                    function_declaration))
@@ -526,73 +1518,214 @@ class AggBuilder(object):
         function_declaration = CreateFunction(fn_name, {}, 'TRIGGER', fn_body,
                                               schema=agg.selectable.schema)
         conn.execute(function_declaration)
-        trigger_name = '"upd_%s"' % nc.build_trigger_name(agg.selectable.name)
+        trigger_name = 'upd_%s' % nc.build_trigger_name(agg.selectable.name)
         conn.execute(CreateTrigger(trigger_name, 'BEFORE', ['UPDATE'],
                                    cube.selectable, 'ROW',
                                    function_declaration))
 
         return
 
-    def build(self, schema=None, with_trigger=False, with_indexes=True):
-        """Creates the actual aggregate table.
-
-        It will create and populate the table with a name and column names
-        according to the NamingConvention, as well as a primary key and the
-        needed foreign keys.
-
-        THIS CAN TAKE A LONG, LONG TIME !
-
-        ```schema```: if given, will create the table in the specified schema.
-        ```with_trigger```: Add a trigger to the fact table to automatically
-        maintain the aggregate table.
+    def build_statement_trigger(self, conn, cube, sql_query, agg,
+                                nc=NamingConvention):
+        """Installs statement level triggers maintaining the aggregate from
+        the whole set of rows inserted or updated by each statement."""
+        if not agg.selectable.primary_key.columns:
+            raise ValueError('Statement level triggers need an aggregate '
+                             'with a primary key')
+        new_table = 'pypet_new_rows'
+        old_table = 'pypet_old_rows'
+        for prefix, operation, referencing in (
+                ('ins', 'INSERT', {'NEW': new_table}),
+                ('upd', 'UPDATE', {'NEW': new_table, 'OLD': old_table})):
+            fn_name = '%s_%s' % (prefix, nc.build_trigger_function_name(
+                agg.selectable.name))
+            fn_body = StatementTriggerBody(cube, sql_query, agg,
+                                           referencing.get('NEW'),
+                                           referencing.get('OLD'))
+            function_declaration = CreateFunction(
+                fn_name, {}, 'TRIGGER', fn_body,
+                schema=agg.selectable.schema)
+            conn.execute(function_declaration)
+            trigger_name = '%s_%s' % (prefix, nc.build_trigger_name(
+                agg.selectable.name))
+            conn.execute(CreateTrigger(trigger_name, 'AFTER', [operation],
+                                       cube.selectable, 'STATEMENT',
+                                       function_declaration,
+                                       referencing=referencing))
+
+    def build_combined_trigger(self, conn, cube, sql_query, agg,
+                               nc=NamingConvention):
+        """Adds the aggregate to the ones maintained by the combined trigger
+        of the fact table, and regenerates it."""
+        cube = self.query.cuboid
+        catalog = maintenance_table(cube.alchemy_md, nc)
+        catalog.create(bind=conn, checkfirst=True)
+        conn.execute(catalog.insert().values(
+            fact_table=cube.table.key,
+            aggregate_table=agg.selectable.key,
+            mode='COMBINED'))
+        install_combined_trigger(conn, cube, [agg], nc)
+
+    def build_deferred_trigger(self, conn, cube, sql_query, agg,
+                               nc=NamingConvention):
+        """Adds the aggregate to the ones maintained from the delta log of the
+        fact table, installing it if needed."""
+        cube = self.query.cuboid
+        if not agg.selectable.primary_key.columns:
+            raise ValueError('Deferred maintenance needs an aggregate with a '
+                             'primary key')
+        catalog = maintenance_table(cube.alchemy_md, nc)
+        catalog.create(bind=conn, checkfirst=True)
+        conn.execute(catalog.insert().values(
+            fact_table=cube.table.key,
+            aggregate_table=agg.selectable.key,
+            mode='DEFERRED'))
+        agg.delta_log = DeltaLog(cube, nc)
+
+    def _check_deferred(self):
+        """Checks that the pending changes of the fact table can be folded
+        into the aggregate, each of its measures having an inverse."""
+        for measure in self.measures:
+            try:
+                measure.agg.inverse(column(measure.name))
+            except NotImplementedError:
+                raise ValueError('Deferred maintenance needs measures with an '
+                                 'inverse: %s has none' % measure.name)
+
+    def _prepare_deferred(self, conn):
+        """Blocks the fact table writers, and folds the pending changes into
+        the deferred aggregates: a new aggregate then starts from the same
+        state as the delta log."""
+        cube = self.query.cuboid
+        conn.execute('LOCK TABLE %s IN SHARE MODE' %
+                     conn.dialect.identifier_preparer.format_table(
+                         cube.table))
+        delta_log = DeltaLog(cube, self.naming_convention)
+        delta_log.install(conn)
+        delta_log.merge(conn=conn, batch_size=None)
+
+    def _install_trigger(self, conn, trigger_level, source, sql_query, agg):
+        if trigger_level == 'STATEMENT':
+            build_trigger = self.build_statement_trigger
+        elif trigger_level == 'COMBINED':
+            build_trigger = self.build_combined_trigger
+        elif trigger_level == 'DEFERRED':
+            build_trigger = self.build_deferred_trigger
+        else:
+            build_trigger = self.build_trigger
+        build_trigger(conn, source, sql_query, agg, self.naming_convention)
 
+    def _table_aggregate(self, conn, table_name, schema=None):
+        """Reflects the aggregate table from the given connection, and
+        returns the matching aggregate."""
+        cube = self.query.cuboid
+        nc = self.naming_convention
+        with _metadata_lock:
+            table = reflect_table(conn, cube.alchemy_md, table_name, schema,
+                                  nc)
+        levels = self.stored_levels(with_ancestors=True)
+        return Aggregate(
+            table,
+            {level: table.c[nc.build_level_name(level)] for level in levels
+             if nc.build_level_name(level) in table.c},
+            {measure: table.c[measure.name] for measure in self.measures},
+            fact_count_column=table.c[cube.fact_count_measure.name],
+            labels={level: table.c[nc.build_level_label_name(level)]
+                    for level in levels
+                    if nc.build_level_label_name(level) in table.c})
+
+    def _partition_level(self, partition_by):
+        """Returns the aggregate axis holding the partition key, and the
+        level the table is partitioned by."""
+        axes = [axis for axis in self.axes
+                if getattr(axis, 'bounds', None) is not None]
+        if not axes:
+            raise ValueError('Only an aggregate with a time level can be '
+                             'partitioned')
+        axis = axes[0]
+        hierarchy = axis.hierarchy
+        if partition_by is True:
+            partition_by = [level for level in hierarchy.levels.values()
+                            if not isinstance(level, AllLevel)][0]
+        if (partition_by.hierarchy is not hierarchy or
+                getattr(partition_by, 'bounds', None) is None or
+                hierarchy.level_index(partition_by) >
+                hierarchy.level_index(axis)):
+            raise ValueError('The aggregate cannot be partitioned by %s' %
+                             partition_by.name)
+        return axis, partition_by
+
+    def _create_partitioned_table(self, conn, table_name, sql_query, source,
+                                  partition_by, schema=None):
+        """Creates the aggregate table, partitioned by range on its time
+        level, with a partition for each ```partition_by``` member found in
+        the source, and a default partition for the others."""
+        cube = self.query.cuboid
+        nc = self.naming_convention
+        axis, level = self._partition_level(partition_by)
+        preparer = conn.dialect.identifier_preparer
+        # Let PostgreSQL tell the columns types, without running the query.
+        shape_name = ('pypet_shape_%s' % table_name)[:63]
+        conn.execute(CreateTableAs(shape_name, sql_query, temporary=True,
+                                   with_data=False))
+        conn.execute(CreatePartitionedTable(
+            table_name, shape_name, nc.build_level_name(axis), schema))
+        conn.execute('DROP TABLE %s' % preparer.quote_identifier(shape_name))
+        if source is not cube:
+            level = level._adapt(source)
+        create_partitions(conn, table_name, level, schema,
+                          naming_convention=nc,
+                          encoding=getattr(axis, 'encoding', None))
+
+    def create_table(self, conn, schema=None, with_trigger=False,
+                     source=None, trigger_level='ROW', table_name=None,
+                     partition_by=None, with_labels=False,
+                     with_ancestors=False):
+        """Creates and populates the aggregate table on the given connection,
+        with its primary key and foreign keys, but without any index.
+
+        See ```build``` for the parameters. ```table_name``` overrides the
+        name given by the naming convention.
+
+        Returns the new aggregate, which is not yet registered on the cube.
         """
-        axis_columns = {}
-        measure_columns = []
         cube = self.query.cuboid
-        fact_count_column_name = cube.fact_count_measure.name
-        query = self.query._generate()
-        query.measures.append(CountMeasure(fact_count_column_name))
-        axes = filter(lambda x: not isinstance(x, AllLevel), self.query.axes)
-        measures = filter(lambda x: type(x) == Measure, self.query.measures)
-        table_name = self.naming_convention.build_table_name(self.query.axes,
-                                                             measures)
-        base_agg = cube._find_best_agg(query.parts)
-        sql_query = query._as_sql()
-        # Work on the "raw" query to add the fact count column
-        sql_query = sql_query.alias()
-        fact_count_col = (sql_query.c[cube.fact_count_measure.name])
-        # Build aliases for axes and measures
-        for axis in axes:
-            label = self.naming_convention.build_level_name(axis)
-            axis_columns[axis] = (sql_query.c[axis._label_for_select]
-                                  .label(label))
-        for measure in measures:
-            label = self.naming_convention.build_measure_name(measure)
-            measure_columns.append(sql_query.c[measure.name].label(label))
+        if table_name is None:
+            table_name = self.naming_convention.build_table_name(
+                self.query.axes, self.measures)
+        if with_trigger and trigger_level == 'DEFERRED':
+            self._check_deferred()
+            self._prepare_deferred(conn)
+        base_agg = source
+        if base_agg is None:
+            base_agg = cube._find_best_agg(self._build_query().parts)
+        sql_query, axis_columns = self._populate_select(
+            base_agg, with_labels=with_labels, with_ancestors=with_ancestors)
 
         # Create table
-        sql_query = select(axis_columns.values() + measure_columns +
-                           [fact_count_col])
-        conn = sql_query.bind.connect()
-        tr = conn.begin()
-        conn.execute(CreateTableAs(table_name, sql_query, schema=schema))
+        if partition_by is None:
+            conn.execute(CreateTableAs(table_name, sql_query, schema=schema))
+        else:
+            self._create_partitioned_table(conn, table_name, sql_query,
+                                           base_agg, partition_by, schema)
 
         # Add it to the metadata via reflection
-        cube.alchemy_md.reflect(bind=conn, schema=schema,
-                                only=[table_name])
-        if schema:
-            metadata_table_key = '%s.%s' % (schema, table_name)
-        else:
-            metadata_table_key = table_name
-        table = cube.alchemy_md.tables[metadata_table_key]
+        agg = self._table_aggregate(conn, table_name, schema)
+        table = agg.selectable
+        if partition_by is not None:
+            conn.execute(InsertFromSelect(
+                table, sql_query,
+                destination=[column.key for column in sql_query.c]))
 
         # Add PK and FK constraints
         if axis_columns:
             pk = PrimaryKeyConstraint(*[table.c[col.key]
                                         for axis, col in axis_columns.items()])
             conn.execute(AddConstraint(pk))
-        for axis, column in axis_columns.items():
+        # Always lock the referenced tables in the same order, so that
+        # concurrent builds cannot deadlock.
+        for axis, column in sorted(axis_columns.items(),
+                                   key=lambda x: x[1].name):
             if isinstance(axis, (ComputedLevel, AllLevel)):
                 # DO NOT add foreign key for computed and all levels!
                 continue
@@ -601,21 +1734,685 @@ class AggBuilder(object):
                                       table=table,
                                       deferrable=True)
             conn.execute(AddConstraint(fk))
-        axes = {axis: table.c[column.name] for axis, column in
-                axis_columns.items()}
-        # Append the aggregate definition to the cube
-        agg = Aggregate(table, axes,
-                        {measure: table.c[measure.name]
-                         for measure in measures},
-                        fact_count_column=table.c[fact_count_column_name])
 
         if with_trigger:
-            self.build_trigger(conn, base_agg, sql_query, agg,
-                               self.naming_convention)
+            self._install_trigger(conn, trigger_level, base_agg, sql_query,
+                                  agg)
+        return agg
+
+    def indexes(self, agg):
+        """Returns the indexes to create on the aggregate table, one for each
+        level column."""
+        table = agg.selectable
+        return [Index(('ix_%s_%s' % (table.name, column.key))[:63], column)
+                for column in agg.levels.values()]
+
+    def build(self, schema=None, with_trigger=False, with_indexes=True,
+              source=None, trigger_level='ROW', partition_by=None,
+              with_labels=False, with_ancestors=False):
+        """Creates the actual aggregate table.
+
+        It will create and populate the table with a name and column names
+        according to the NamingConvention, as well as a primary key and the
+        needed foreign keys.
+
+        THIS CAN TAKE A LONG, LONG TIME ! See ```build_online``` to add an
+        aggregate to a fact table being written to.
+
+        ```schema```: if given, will create the table in the specified schema.
+        ```with_trigger```: Add a trigger to the fact table to automatically
+        maintain the aggregate table.
+        ```source```: the cuboid (the cube or one of its aggregates) to build
+        the table from. Defaults to the best aggregate available.
+        ```trigger_level```: 'ROW' to maintain the aggregate for each fact
+        row, or 'STATEMENT' to maintain it once per statement, from the
+        whole batch of rows. The latter is much faster for bulk inserts.
+        'COMBINED' maintains the aggregate, along with every other aggregate
+        built this way, from a single row level trigger on the fact table.
+        'DEFERRED' only logs the fact table changes, which are folded into
+        the aggregate later on by the cube DeltaLog ```merge``` method.
+        ```partition_by```: a time level of the aggregate hierarchy, coarser
+        than the aggregate one, or True for the coarsest one. The table is
+        then partitioned by range, with a partition for each of its members,
+        which can be rebuilt with ```rebuild_partition```.
+        ```with_labels```: also store the label of each dimension level in
+        the aggregate, so that the queries it answers do not join the level
+        tables to read them.
+        ```with_ancestors```: also store the ids of the dimension levels
+        above the aggregate ones (and their labels, with ```with_labels```),
+        so that the queries on these levels do not join the tables between
+        the aggregate and them.
+
+        Returns the new aggregate.
+
+        """
+        cube = self.query.cuboid
+        conn = cube.selectable.bind.connect()
+        tr = conn.begin()
+        agg = self.create_table(conn, schema, with_trigger, source,
+                                trigger_level, partition_by=partition_by,
+                                with_labels=with_labels,
+                                with_ancestors=with_ancestors)
         if with_indexes:
-            for column in axis_columns.values():
-                Index(('ix_%s_%s' % (table.name, column.key))[:63],
-                      table.c[column.key]).create(bind=conn)
+            for index in self.indexes(agg):
+                index.create(bind=conn)
         tr.commit()
 
+        # Append the aggregate definition to the cube
         cube.aggregates.append(agg)
+        return agg
+
+    def build_online(self, schema=None, with_trigger=False,
+                     with_indexes=True, trigger_level='ROW',
+                     batch_size=10000):
+        """Creates the aggregate table without blocking the fact table
+        writers during the build, nor missing their changes.
+
+        1. A capture log, recording the fact table changes, is installed
+           first (see DeltaLog).
+        2. The table is built under a temporary name, from a repeatable read
+           snapshot, the captured changes visible in the snapshot being then
+           discarded.
+        3. The other captured changes are replayed into the table, by
+           batches of ```batch_size```.
+        4. The fact table writers are blocked for the last changes to be
+           replayed, the table to be renamed and its trigger installed, in a
+           single short transaction.
+
+        See ```build``` for the other parameters.
+
+        Returns the new aggregate.
+        """
+        cube = self.query.cuboid
+        nc = self.naming_convention
+        if with_trigger and trigger_level == 'DEFERRED':
+            self._check_deferred()
+        engine = cube.selectable.bind
+        table_name = nc.build_table_name(self.query.axes, self.measures)
+        online_name = nc.online_table_name.format(tablename=table_name)
+        capture = DeltaLog(cube, nc,
+                           nc.capture_table_name.format(tablename=table_name))
+        conn = engine.connect()
+        preparer = conn.dialect.identifier_preparer
+        tr = conn.begin()
+        capture.install(conn)
+        tr.commit()
+        agg = None
+        online = None
+        build_conn = engine.connect().execution_options(
+            isolation_level='REPEATABLE READ')
+        try:
+            tr = build_conn.begin()
+            snapshot = build_conn.execute(select([
+                cast(func.txid_current_snapshot(), types.String)])).scalar()
+            source = cube._find_best_agg(self._build_query().parts, 'fact')
+            agg = self.create_table(build_conn, schema, source=source,
+                                    table_name=online_name)
+            online = agg.selectable
+            if with_indexes:
+                for index in self.indexes(agg):
+                    index.create(bind=build_conn)
+            tr.commit()
+            conn.execute(text(
+                'DELETE FROM %s WHERE txid_visible_in_snapshot('
+                'pypet_xid, CAST(:snapshot AS txid_snapshot))' %
+                preparer.format_table(capture.table)), snapshot=snapshot)
+            while capture.merge(batch_size=batch_size,
+                                aggregates=[agg]) == batch_size:
+                pass
+            tr = conn.begin()
+            conn.execute('LOCK TABLE %s IN SHARE MODE' %
+                         preparer.format_table(cube.table))
+            capture.merge(conn=conn, batch_size=None, aggregates=[agg])
+            capture.uninstall(conn)
+            self._rename(conn, agg.selectable, table_name)
+            with _metadata_lock:
+                cube.alchemy_md.remove(agg.selectable)
+            agg = self._table_aggregate(conn, table_name, schema)
+            if with_trigger:
+                if trigger_level == 'DEFERRED':
+                    self._prepare_deferred(conn)
+                self._install_trigger(conn, trigger_level, cube,
+                                      self._populate_select(cube)[0], agg)
+            tr.commit()
+        except:
+            if tr.is_active:
+                tr.rollback()
+            tr = conn.begin()
+            capture.uninstall(conn)
+            if online is not None:
+                # The renaming to the final name was rolled back.
+                online.drop(bind=conn, checkfirst=True)
+                with _metadata_lock:
+                    cube.alchemy_md.remove(online)
+                    cube.alchemy_md.remove(agg.selectable)
+            tr.commit()
+            raise
+        finally:
+            build_conn.close()
+            conn.close()
+        cube.aggregates.append(agg)
+        return agg
+
+    def rebuild_partition(self, agg, member):
+        """Recomputes, from the fact table, the partition of the aggregate
+        holding the given member, and swaps it with the current one.
+
+        ```agg```: an aggregate built from this builder query, with the
+        ```partition_by``` option.
+        ```member```: a member of the level the table is partitioned by.
+
+        The fact table writers are blocked during the rebuild.
+        """
+        cube = self.query.cuboid
+        nc = self.naming_convention
+        table = agg.selectable
+        conn = cube.selectable.bind.connect()
+        preparer = conn.dialect.identifier_preparer
+        name = nc.build_partition_name(table.name, member.id)
+        tr = conn.begin()
+        try:
+            bounds = conn.execute(text(
+                'SELECT pg_get_expr(relpartbound, oid) FROM pg_class '
+                'WHERE oid = to_regclass(:partition)'),
+                partition=_qualified_name(preparer, name,
+                                          table.schema)).scalar()
+            if bounds is None:
+                raise ValueError('%s has no partition for %s' % (
+                    table.name, member.label))
+            conn.execute('LOCK TABLE %s IN SHARE MODE' %
+                         preparer.format_table(cube.table))
+            if agg.delta_log is not None:
+                # The pending changes are read from the fact table.
+                agg.delta_log.merge(conn=conn, batch_size=None)
+            sql_query = self._populate_select(
+                cube, member, **self._stored_options(agg))[0]
+            new = Table(nc.online_table_name.format(tablename=name),
+                        MetaData(),
+                        *[Column(col.name, col.type) for col in table.c],
+                        schema=table.schema)
+            conn.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (
+                preparer.format_table(new), preparer.format_table(table)))
+            conn.execute(InsertFromSelect(
+                new, sql_query,
+                destination=[column.key for column in sql_query.c]))
+            partition = _qualified_name(preparer, name, table.schema)
+            conn.execute('ALTER TABLE %s DETACH PARTITION %s' % (
+                preparer.format_table(table), partition))
+            conn.execute('DROP TABLE %s' % partition)
+            conn.execute('ALTER TABLE %s RENAME TO %s' % (
+                preparer.format_table(new), preparer.quote_identifier(name)))
+            conn.execute('ALTER TABLE %s ATTACH PARTITION %s %s' % (
+                preparer.format_table(table), partition, bounds))
+            tr.commit()
+        except:
+            tr.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _rename(self, conn, table, name):
+        """Renames the table, along with its constraints and indexes."""
+        preparer = conn.dialect.identifier_preparer
+        constraints = [row.conname for row in conn.execute(text(
+            'SELECT conname FROM pg_constraint '
+            'WHERE conrelid = CAST(:table AS regclass)'),
+            table=preparer.format_table(table))]
+        indexes = [row.relname for row in conn.execute(text(
+            'SELECT relname FROM pg_class JOIN pg_index '
+            'ON pg_class.oid = indexrelid '
+            'WHERE indrelid = CAST(:table AS regclass) '
+            'AND NOT EXISTS (SELECT 1 FROM pg_constraint '
+            'WHERE conindid = indexrelid)'),
+            table=preparer.format_table(table))]
+        conn.execute('ALTER TABLE %s RENAME TO %s' % (
+            preparer.format_table(table), preparer.quote_identifier(name)))
+        renamed = preparer.quote_identifier(name)
+        if table.schema:
+            renamed = '%s.%s' % (preparer.quote_schema(table.schema,
+                                                       None), renamed)
+        for constraint in constraints:
+            if table.name in constraint:
+                conn.execute('ALTER TABLE %s RENAME CONSTRAINT %s TO %s' % (
+                    renamed, preparer.quote_identifier(constraint),
+                    preparer.quote_identifier(
+                        constraint.replace(table.name, name))))
+        for index in indexes:
+            if table.name in index:
+                old_index = preparer.quote_identifier(index)
+                if table.schema:
+                    old_index = '%s.%s' % (preparer.quote_schema(
+                        table.schema, None), old_index)
+                conn.execute('ALTER INDEX %s RENAME TO %s' % (
+                    old_index, preparer.quote_identifier(
+                        index.replace(table.name, name))))
+
+
+    def refresh(self, agg, since=None, watermark_column=None, level=None):
+        """Refreshes an aggregate built from this builder query, without
+        rebuilding it. This is meant for append-mostly fact tables.
+
+        Only the rows for the ```level``` keys affected by the facts appended
+        since the watermark are recomputed from the fact table, and merged
+        into the aggregate on its primary key. The new watermark is then
+        recorded in the watermark catalog table.
+
+        ```since```: the watermark to refresh from. Defaults to the watermark
+        recorded by the previous refresh, or to a full refresh if there is
+        none.
+        ```watermark_column```: a fact table column, either a timestamp or a
+        monotonically increasing id, telling which facts are new. Defaults to
+        the ```level``` column.
+        ```level```: the aggregate level whose keys are recomputed. It must
+        be computed from the fact table, and defaults to the first computed
+        (time) level of the aggregate.
+
+        Deleted facts are not taken into account.
+
+        Returns the new watermark.
+        """
+        cube = self.query.cuboid
+        if level is None:
+            levels = [axis for axis in self.axes
+                      if isinstance(axis, ComputedLevel)]
+            if not levels:
+                raise ValueError('The aggregate has no computed level to '
+                                 'refresh by')
+            level = levels[0]
+        if (not any(axis is level for axis in self.axes) or
+                level.column.table is not cube.table):
+            raise ValueError('%s is not a fact table level of the aggregate'
+                             % level.name)
+        if watermark_column is None:
+            watermark_column = level.column
+        if not agg.selectable.primary_key.columns:
+            raise ValueError('Cannot refresh an aggregate without a primary '
+                             'key')
+        conn = cube.selectable.bind.connect()
+        tr = conn.begin()
+        try:
+            new_watermark = self._refresh(conn, agg, since, watermark_column,
+                                          level)
+            tr.commit()
+        except:
+            tr.rollback()
+            raise
+        finally:
+            conn.close()
+        return new_watermark
+
+    def _refresh(self, conn, agg, since, watermark_column, level):
+        """Refreshes the aggregate within the transaction of the
+        connection."""
+        cube = self.query.cuboid
+        table = agg.selectable
+        catalog = watermark_table(cube.alchemy_md, self.naming_convention)
+        table_key = table.key
+        catalog.create(bind=conn, checkfirst=True)
+        if since is None:
+            since = conn.execute(
+                select([catalog.c.watermark])
+                .where(catalog.c.table_name == table_key)).scalar()
+        new_watermark = conn.execute(select([
+            cast(func.max(watermark_column), types.String)])).scalar()
+        if new_watermark is None:
+            # Nothing to refresh from
+            return since
+        members = None
+        if since is not None:
+            since = cast(literal(since), watermark_column.type)
+            affected_keys = [row[0] for row in conn.execute(
+                select([level._id_column])
+                .where(watermark_column > since)
+                .distinct())]
+            # Filtering the facts on the affected keys, rather than the
+            # grouped rows, spares scanning and grouping the others.
+            members = MembersFilter(level, affected_keys)
+            if members.table is not None:
+                members._create_table(conn)
+        sql_query, _ = self._populate_select(
+            cube, member=members, **self._stored_options(agg))
+        keys = [column.name for column in table.primary_key.columns]
+        conn.execute(InsertFromSelect(
+            table, sql_query,
+            destination=[column.key for column in sql_query.c],
+            on_conflict=keys,
+            update={column.key: excluded(column.key)
+                    for column in sql_query.c
+                    if column.key not in keys}))
+        if members is not None and members.table is not None:
+            members.table.drop(bind=conn)
+        conn.execute(InsertFromSelect(
+            catalog,
+            select([literal(table_key, types.String),
+                    literal(new_watermark, types.String)]),
+            destination=['table_name', 'watermark'],
+            on_conflict=['table_name'],
+            update={'watermark': excluded('watermark'),
+                    'refreshed_at': func.now()}))
+        return new_watermark
+
+
+class ParallelAggBuilder(object):
+    """Builds several aggregates concurrently, each worker using its own
+    connection from the cube engine pool.
+
+    An aggregate is built as soon as every aggregate of the batch it can be
+    derived from is available, from the smallest of them. Once an aggregate
+    table is loaded, its indexes are created concurrently, by any free
+    worker.
+
+    The build can be stopped at any time from another thread with
+    ```cancel```: the running statements are cancelled and the aggregates not
+    yet built are skipped.
+    """
+
+    def __init__(self, queries, workers=4, naming_convention=NamingConvention):
+        self.builders = lattice_order([AggBuilder(query, naming_convention)
+                                       for query in queries])
+        self.workers = workers
+        self.reports = []
+        self.done = 0
+        self.total = 0
+        self._cancelled = threading.Event()
+        self._condition = threading.Condition()
+        self._connections = set()
+        self._pending = []
+        self._running = []
+        self._index_jobs = []
+        self._errors = []
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Stops the build, cancelling the statements being executed."""
+        self._cancelled.set()
+        with self._condition:
+            for conn in self._connections:
+                conn.connection.cancel()
+            self._condition.notify_all()
+
+    def _is_ready(self, builder):
+        return not any(other.covers(builder) and not builder.covers(other)
+                       for other in self._pending + self._running
+                       if other is not builder)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self.cancelled or self._errors:
+                    return None
+                for builder in self._pending:
+                    if self._is_ready(builder):
+                        self._pending.remove(builder)
+                        self._running.append(builder)
+                        return self._build, builder
+                if self._index_jobs:
+                    return self._create_index, self._index_jobs.pop(0)
+                if not self._pending and not self._running:
+                    return None
+                self._condition.wait()
+
+    def _connect(self, engine, **options):
+        conn = engine.connect()
+        if options:
+            conn = conn.execution_options(**options)
+        with self._condition:
+            self._connections.add(conn)
+        return conn
+
+    def _release(self, conn):
+        with self._condition:
+            self._connections.discard(conn)
+        conn.close()
+
+    def _build(self, builder):
+        cube = builder.query.cuboid
+        start = time.time()
+        conn = self._connect(cube.selectable.bind)
+        try:
+            source = builder.find_source(self._sizes)
+            tr = conn.begin()
+            agg = builder.create_table(conn, self.schema, self.with_trigger,
+                                       source, self.trigger_level)
+            tr.commit()
+        finally:
+            self._release(conn)
+        report = BuildReport(agg, source.selectable, time.time() - start)
+        with self._condition:
+            cube.aggregates.append(agg)
+            self.reports.append(report)
+            self._running.remove(builder)
+            if self.with_indexes:
+                self._index_jobs.extend(builder.indexes(agg))
+            self._step(report)
+            self._condition.notify_all()
+
+    def _create_index(self, index):
+        conn = self._connect(index.table.bind, isolation_level='AUTOCOMMIT')
+        try:
+            conn.execute(CreateIndexConcurrently(index))
+        finally:
+            self._release(conn)
+        with self._condition:
+            self._step(index)
+
+    def _step(self, what):
+        self.done += 1
+        if self.progress is not None:
+            self.progress(self.done, self.total, what)
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            fun, arg = job
+            try:
+                fun(arg)
+            except Exception as e:
+                with self._condition:
+                    if not self.cancelled:
+                        self._errors.append(e)
+                    self._condition.notify_all()
+                return
+
+    def run(self, schema=None, with_trigger=False, with_indexes=True,
+            progress=None, trigger_level='ROW'):
+        """Builds all the aggregates, and waits for the workers to finish.
+
+        ```schema```, ```with_trigger```, ```with_indexes``` and
+        ```trigger_level``` have the same meaning as for
+        ```AggBuilder.build```.
+        ```progress```: if given, a callable called after each step (an
+        aggregate table loaded or an index created) with the number of steps
+        done, the total number of steps, and the BuildReport or Index just
+        completed.
+
+        Returns the list of BuildReport, in completion order.
+        """
+        self.schema = schema
+        self.with_trigger = with_trigger
+        self.with_indexes = with_indexes
+        self.trigger_level = trigger_level
+        self.progress = progress
+        self._sizes = {}
+        self._pending = list(self.builders)
+        self.total = len(self.builders)
+        if with_indexes:
+            self.total += sum(len(builder.axes) for builder in self.builders)
+        threads = [threading.Thread(target=self._work)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.reports
+
+
+class CopyStream(object):
+    """A file-like object reading rows as CSV, for COPY FROM STDIN.
+
+    The rows are either sequences of values, in the order of the columns,
+    or dictionaries mapping the columns names to values.
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = ''
+
+    def _encode(self, row):
+        if isinstance(row, dict):
+            row = [row.get(name) for name in self.columns]
+        return ','.join(self._encode_value(value) for value in row) + '\n'
+
+    @staticmethod
+    def _encode_value(value):
+        # COPY only reads unquoted empty fields as NULL.
+        if value is None:
+            return ''
+        if isinstance(value, float):
+            return repr(value)
+        if isinstance(value, (int, long)):
+            return str(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return '"%s"' % str(value).replace('"', '""')
+
+    def read(self, size=-1):
+        while self.rows is not None and (size < 0 or
+                                         len(self.buffer) < size):
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                self.rows = None
+            else:
+                self.buffer += self._encode(row)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _identifier(name):
+    """Returns the name truncated to the 63 bytes PostgreSQL keeps of an
+    identifier."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name[:63].decode('utf-8', 'ignore')
+
+
+def maintenance_triggers(cube, naming_convention=NamingConvention):
+    """Returns the names of the triggers pypet may have installed on the
+    fact table to maintain the registered aggregates, as truncated by
+    PostgreSQL."""
+    nc = naming_convention
+    fact_trigger_name = nc.build_trigger_name(cube.table.name)
+    names = ['%s_%s' % (nc.combined_trigger_prefix, fact_trigger_name)]
+    names += ['%s_%s' % (prefix, nc.build_trigger_name(
+        nc.build_delta_table_name(cube.table.name)))
+        for prefix in ('ins', 'upd', 'del')]
+    for agg in cube.aggregates:
+        names += ['%s_%s' % (prefix, nc.build_trigger_name(
+            agg.selectable.name)) for prefix in ('ins', 'upd')]
+    return [_identifier(name) for name in names]
+
+
+def bulk_load(cube, data, columns=None, naming_convention=NamingConvention):
+    """Loads facts into the cube fact table, maintaining every registered
+    aggregate at once.
+
+    The facts are streamed with COPY FROM STDIN into an unlogged staging
+    table, then inserted into the fact table with the aggregates triggers
+    disabled, and merged into each aggregate with a single grouped INSERT
+    ... ON CONFLICT DO UPDATE.
+
+    ```data``` is either a file-like object, in the PostgreSQL CSV format,
+    or an iterable of rows (see CopyStream).
+    ```columns```: the names of the fact table columns given for each row,
+    the other ones taking their default value. Defaults to the keys of the
+    first row for dictionaries, and to every column otherwise.
+
+    Returns the number of facts loaded.
+    """
+    fact_table = cube.table
+    for agg in cube.aggregates:
+        if not agg.selectable.primary_key.columns:
+            raise ValueError('Cannot bulk load facts into an aggregate '
+                             'without a primary key: %s' %
+                             agg.selectable.name)
+    if not hasattr(data, 'read'):
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        if columns is None and isinstance(first, dict):
+            columns = [col.name for col in fact_table.c if col.name in first]
+        data = CopyStream(itertools.chain([first], rows),
+                          columns or fact_table.c.keys())
+    columns = columns or fact_table.c.keys()
+    conn = cube.selectable.bind.connect()
+    tr = conn.begin()
+    try:
+        count = _bulk_load(conn, cube, data, columns, naming_convention)
+        tr.commit()
+    except:
+        # The staging table and the disabled triggers go with the
+        # transaction.
+        tr.rollback()
+        raise
+    finally:
+        conn.close()
+    return count
+
+
+def _bulk_load(conn, cube, data, columns, naming_convention):
+    """Loads the facts within the transaction of the connection."""
+    fact_table = cube.table
+    preparer = conn.dialect.identifier_preparer
+    staging_name = naming_convention.build_staging_table_name(
+        fact_table.name, conn.execute(select([func.pg_backend_pid()]))
+        .scalar())
+    staging = TableClause(staging_name,
+                          *[column(col.name, col.type)
+                            for col in fact_table.c])
+    conn.execute('CREATE UNLOGGED TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (
+        preparer.quote_identifier(staging_name),
+        preparer.format_table(fact_table)))
+    cursor = conn.connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        preparer.quote_identifier(staging_name),
+        ', '.join(preparer.quote_identifier(name) for name in columns)),
+        data)
+    count = cursor.rowcount
+    cursor.close()
+    conn.execute('ANALYZE %s' % preparer.quote_identifier(staging_name))
+    triggers = [row.tgname for row in conn.execute(
+        text("SELECT tgname FROM pg_trigger "
+             "WHERE tgrelid = CAST(:table AS regclass) "
+             "AND trim(both '\"' from tgname) = ANY(:names)"),
+        table=preparer.format_table(fact_table),
+        names=maintenance_triggers(cube, naming_convention))]
+
+    def alter_triggers(action):
+        for trigger in triggers:
+            conn.execute('ALTER TABLE %s %s TRIGGER %s' % (
+                preparer.format_table(fact_table), action,
+                preparer.quote_identifier(trigger)))
+    alter_triggers('DISABLE')
+    conn.execute(InsertFromSelect(
+        fact_table, select(list(staging.c)),
+        destination=[col.name for col in staging.c]))
+    alter_triggers('ENABLE')
+    rows = FactRows(select(list(staging.c)), fact_table,
+                    DeltaLog.new_table)
+    for agg in cube.aggregates:
+        conn.execute(upsert_stmt(cube, aggregate_select(cube, agg), agg,
+                                 rows))
+    conn.execute('DROP TABLE %s' % preparer.quote_identifier(staging_name))
+    return count
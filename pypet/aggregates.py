@@ -15,6 +15,11 @@ class Aggregator(object):
     def accumulator(self, old_value, new_value):
         raise NotImplemented("Not implemented!")
 
+    def inverse(self, column_clause):
+        """Returns the partial aggregate value cancelling the given one, the
+        fact count being negated along."""
+        raise NotImplementedError("Not implemented!")
+
     def py_impl(self, collection):
         raise NotImplemented("Not implemented!")
 
@@ -62,6 +67,10 @@ class avg(Aggregator):
         return case([(total_count == 0, 0)],
                     else_=(agg_value + new_total) / total_count)
 
+    def inverse(self, column_clause):
+        # Averages are weighted by the fact count, which is negated.
+        return column_clause
+
 
 class sum(Aggregator):
 
@@ -78,6 +87,9 @@ class sum(Aggregator):
         return (total_sum +
                 func.coalesce(agg_row.c[column_name], 0))
 
+    def inverse(self, column_clause):
+        return -column_clause
+
 
 class count(sum):
 
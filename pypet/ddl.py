@@ -0,0 +1,185 @@
+"""SQL statements issued by pypet which SQLAlchemy does not provide."""
+
+from sqlalchemy.sql import literal_column
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+
+class InsertFromSelect(Executable, ClauseElement):
+    """An INSERT ... SELECT statement.
+
+    If ```on_conflict``` is given, it is the list of the columns names of a
+    unique constraint, and the ```update``` dictionary maps column names to
+    the expressions they are updated with when a row conflicts. The
+    proposed row can be referenced with the ```excluded``` function.
+    """
+
+    def __init__(self, table, select, destination=None, on_conflict=None,
+                 update=None):
+        self.table = table
+        self.select = select
+        self.destination = destination or self.table.c.keys()
+        self.on_conflict = on_conflict
+        self.update = update or {}
+
+
+def excluded(column_name):
+    """References a column of the row proposed for insertion in an ON
+    CONFLICT DO UPDATE clause."""
+    return literal_column('excluded."%s"' % column_name)
+
+
+@compiles(InsertFromSelect)
+def visit_insert_from_select(element, compiler, **kw):
+    preparer = compiler.dialect.identifier_preparer
+    column_names = [preparer.quote_identifier(t)
+                    for t in element.destination]
+    result = "INSERT INTO %s (%s) (%s)" % (
+        compiler.process(element.table, asfrom=True),
+        ', '.join(column_names),
+        compiler.process(element.select)
+    )
+    if element.on_conflict is not None:
+        result += " ON CONFLICT (%s)" % ', '.join(
+            preparer.quote_identifier(name) for name in element.on_conflict)
+        if element.update:
+            result += " DO UPDATE SET %s" % ', '.join(
+                '%s = %s' % (preparer.quote_identifier(name),
+                             compiler.process(value))
+                for name, value in element.update.items())
+        else:
+            result += " DO NOTHING"
+    return result
+
+
+class CreateTableAs(Executable, ClauseElement):
+
+    def __init__(self, table_name, select, columns=None, schema=None,
+                 temporary=False, with_data=True):
+        self.table_name = table_name
+        self.schema = schema
+        self.select = select
+        self.columns = columns
+        self.temporary = temporary
+        self.with_data = with_data
+
+
+@compiles(CreateTableAs)
+def visit_create_table_as(element, compiler, **kw):
+    preparer = compiler.dialect.identifier_preparer
+    table_name = preparer.quote_identifier(element.table_name)
+    if element.schema is not None:
+        table_name = '%s.%s' % (preparer.quote_identifier(element.schema),
+                                table_name)
+    return "CREATE %sTABLE %s AS %s%s" % (
+        'TEMPORARY ' if element.temporary else '',
+        table_name,
+        compiler.process(element.select),
+        '' if element.with_data else ' WITH NO DATA'
+    )
+
+
+class CreateFunction(Executable, ClauseElement):
+
+    _returning = False
+
+    def __init__(self, name, args, return_type, body,
+                 language='plpgsql', schema=None, or_replace=False):
+        self.name = name
+        self.args = args
+        self.return_type = return_type
+        self.language = language
+        self.body = body
+        self.schema = schema
+        self.or_replace = or_replace
+
+
+@compiles(CreateFunction)
+def visit_create_function(element, compiler, **kw):
+    preparer = compiler.dialect.identifier_preparer
+    fn_name = preparer.quote_identifier(element.name)
+    if element.schema is not None:
+        fn_name = '%s.%s' % (preparer.quote_identifier(element.schema),
+                             fn_name)
+    if 'as_trigger' in kw:
+        return '%s()' % fn_name
+    params = []
+    for name, type in element.args.items():
+        if not isinstance(type, basestring):
+            type = compiler.process(type, **kw)
+        params.append('%s %s' % (name, type))
+    return_type = element.return_type
+    if not isinstance(return_type, basestring):
+        return_type = compiler.process(type, **kw)
+    result = ('CREATE %sFUNCTION %s (%s) RETURNS %s as $fn_body$ \n' %
+              ('OR REPLACE ' if element.or_replace else '',
+               fn_name, ','.join(params), return_type))
+    if isinstance(element.body, ClauseElement):
+        result += compiler.process(element.body, **kw)
+    else:
+        result += element.body
+    result += '\n $fn_body$ language %s' % (element.language)
+    return result
+
+
+class DropFunction(Executable, ClauseElement):
+
+    def __init__(self, name, schema=None):
+        self.name = name
+        self.schema = schema
+
+
+@compiles(DropFunction)
+def visit_drop_function(element, compiler, **kw):
+    preparer = compiler.dialect.identifier_preparer
+    fn_name = preparer.quote_identifier(element.name)
+    if element.schema is not None:
+        fn_name = '%s.%s' % (preparer.quote_identifier(element.schema),
+                             fn_name)
+    return 'DROP FUNCTION IF EXISTS %s() CASCADE' % fn_name
+
+
+class CreateTrigger(Executable, ClauseElement):
+
+    _returning = False
+
+    def __init__(self, name, when, operations, table, level, fn,
+                 referencing=None):
+        self.name = name
+        self.when = when
+        self.operations = operations
+        if isinstance(self.operations, basestring):
+            self.operations = [self.operations]
+        self.table = table
+        self.level = level
+        self.fn = fn
+        # Maps 'OLD' and / or 'NEW' to transition table names.
+        self.referencing = referencing or {}
+
+
+@compiles(CreateTrigger)
+def visit_create_trigger(element, compiler, **kw):
+    preparer = compiler.dialect.identifier_preparer
+    trigger_name = preparer.quote_identifier(element.name)
+    table_name = element.table
+    if isinstance(table_name, ClauseElement):
+        table_name = compiler.process(table_name, asfrom=True, **kw)
+    fn = element.fn
+    if isinstance(fn, ClauseElement):
+        fn = compiler.process(fn, as_trigger=True, **kw)
+    referencing = ''
+    if element.referencing:
+        referencing = 'REFERENCING %s' % ' '.join(
+            '%s TABLE AS %s' % (key, preparer.quote_identifier(name))
+            for key, name in sorted(element.referencing.items()))
+    return """
+        CREATE TRIGGER %(name)s %(when)s %(operations)s
+        ON %(table)s %(referencing)s
+        FOR EACH %(level)s EXECUTE PROCEDURE %(fn)s
+        """ % dict(name=trigger_name,
+                   when=element.when,
+                   operations=' OR '.join(element.operations),
+                   table=table_name,
+                   referencing=referencing,
+                   level=element.level,
+                   fn=fn)
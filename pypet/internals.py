@@ -2,8 +2,12 @@ from sqlalchemy.sql import (util as sql_util,
         ColumnCollection)
 from sqlalchemy.util import OrderedSet
 from sqlalchemy.sql.expression import (
-        and_, _Generative, _generative, func, Join)
+        and_, _Generative, _generative, func, Join, Alias, Select as SQLSelect,
+        Over, ColumnElement, ClauseList, BindParameter)
+from sqlalchemy.sql.visitors import replacement_traverse, iterate
+from sqlalchemy.ext.compiler import compiles
 from operator import and_ as builtin_and
+from functools import wraps
 
 
 def find_join(_from, table):
@@ -25,9 +29,203 @@ def find_join(_from, table):
 
 
 
-def join_table_with_query(query, table):
+class Lateral(Alias):
+    """A subquery which can read the columns of the tables joined before it
+    in the from clause, by their literal names."""
+
+    __visit_name__ = 'lateral'
+
+
+@compiles(Lateral)
+def visit_lateral(element, compiler, **kw):
+    return 'LATERAL %s' % compiler.visit_alias(element, **kw)
+
+
+class NamedOver(ColumnElement):
+    """A window function computed over a window of the WINDOW clause."""
+
+    def __init__(self, over, window_name):
+        self.func = over.func
+        self.window_name = window_name
+        self.type = over.type
+
+
+@compiles(NamedOver)
+def visit_named_over(element, compiler, **kw):
+    return '%s OVER %s' % (compiler.process(element.func, **kw),
+                           element.window_name)
+
+
+class WindowSelect(SQLSelect):
+    """A select with a WINDOW clause, defining the windows shared by its
+    window functions.
+
+    ```windows``` is a list of (name, over) tuples, the partition and order
+    of each over giving the window definition."""
+
+    windows = ()
+
+
+@compiles(WindowSelect)
+def visit_window_select(element, compiler, **kw):
+    parens = kw.pop('parens', True)
+    # The WINDOW clause goes between the HAVING and the ORDER BY clauses.
+    plain = element._generate()
+    plain.__class__ = SQLSelect
+    plain._order_by_clause = ClauseList()
+    plain._limit = plain._offset = None
+    text = compiler.visit_select(plain, parens=False, **kw)
+    definitions = []
+    for name, over in element.windows:
+        clauses = []
+        if over.partition_by is not None:
+            clauses.append('PARTITION BY %s' %
+                           compiler.process(over.partition_by, **kw))
+        if over.order_by is not None:
+            clauses.append('ORDER BY %s' %
+                           compiler.process(over.order_by, **kw))
+        definitions.append('%s AS (%s)' % (name, ' '.join(clauses)))
+    text += ' \nWINDOW %s' % ', '.join(definitions)
+    if element._order_by_clause.clauses:
+        text += compiler.order_by_clause(element, **kw)
+    if element._limit is not None or element._offset is not None:
+        text += compiler.limit_clause(element)
+    if kw.get('asfrom') and parens:
+        return '(%s)' % text
+    return text
+
+
+def _same_clause(clause, other):
+    """Returns True if both clauses render the same SQL, with the same
+    parameter values."""
+    # Unlike ClauseElement.compare, this compares each node of the clauses
+    # once, which keeps deeply nested expressions cheap to compare.
+    if clause is None or other is None:
+        return clause is other
+    if clause is other:
+        return True
+    if type(clause) is not type(other):
+        return False
+    if isinstance(clause, BindParameter):
+        return clause.value == other.value
+    if any(getattr(clause, attr, None) != getattr(other, attr, None)
+           for attr in ('name', 'operator', 'modifier', 'key')):
+        return False
+    children, other_children = clause.get_children(), other.get_children()
+    if not children:
+        return clause.compare(other)
+    return (len(children) == len(other_children) and
+            all(_same_clause(child, other_child)
+                for child, other_child in zip(children, other_children)))
+
+
+def _clause_key(clause):
+    """Returns a hashable key, which is the same for the clauses
+    ```_same_clause``` considers the same, and rarely for others."""
+    if isinstance(clause, BindParameter):
+        try:
+            return BindParameter, hash(clause.value)
+        except TypeError:
+            return BindParameter
+    return type(clause)
+
+
+def _same_window(over, other):
+    return (_same_clause(over.partition_by, other.partition_by) and
+            _same_clause(over.order_by, other.order_by))
+
+
+def name_windows(query):
+    """Returns the query, with the windows shared by several of its window
+    functions defined once in a WINDOW clause."""
+    overs = [element for column in query.inner_columns
+             for element in iterate(column, {})
+             if isinstance(element, Over)]
+    windows = []
+    for over in overs:
+        for window in windows:
+            if _same_window(window[0], over):
+                window.append(over)
+                break
+        else:
+            windows.append([over])
+    windows = [window for window in windows if len(window) > 1]
+    if not windows:
+        return query
+    names = {}
+    for index, window in enumerate(windows):
+        for over in window:
+            names[over] = 'pypet_window_%d' % index
+
+    def replace(element):
+        if element in names:
+            return NamedOver(element, names[element])
+        return None
+    columns = [replacement_traverse(column, {}, replace)
+               for column in query.inner_columns]
+    query = query.with_only_columns(columns)
+    query.__class__ = WindowSelect
+    query.windows = [('pypet_window_%d' % index, window[0])
+                     for index, window in enumerate(windows)]
+    return query
+
+
+class JoinGraph(object):
+    """The shortest join paths from a root table to the tables reachable
+    through many-to-one foreign keys.
+
+    ```overrides``` maps tables to the clause joining them, used instead of
+    their foreign keys, for example to join a role-playing alias of a
+    dimension table. Tables referenced by several foreign keys of a table
+    are only reached from it through an override.
+    """
+
+    def __init__(self, root, overrides=None):
+        self.root = root
+        overrides = overrides or {}
+        self.paths = {root: []}
+        queue = [root]
+        while queue:
+            table = queue.pop(0)
+            for target, onclause in self._edges(table, overrides):
+                if target not in self.paths:
+                    self.paths[target] = (self.paths[table] +
+                                          [(target, onclause)])
+                    queue.append(target)
+
+    def _edges(self, table, overrides):
+        constraints = {}
+        for fk in getattr(table, 'foreign_keys', ()):
+            (constraints.setdefault(fk.column.table, {})
+             .setdefault(fk.constraint, []).append(fk))
+        for target, fks in constraints.items():
+            if target not in overrides and len(fks) == 1:
+                yield target, and_(*[fk.parent == fk.column
+                                     for fk in fks.values()[0]])
+        for target, onclause in overrides.items():
+            if any(column.table is table
+                   for column in sql_util.find_columns(onclause)):
+                yield target, onclause
+
+
+def join_table_with_query(query, table, graph=None):
     """Find a join between a query and a table, modifying the from clause in
-    place."""
+    place.
+
+    If the table is in the ```graph``` JoinGraph and the query selects from
+    its root, the tables on the path to the table are joined too."""
+    if graph is not None and table in graph.paths:
+        for index, _from in enumerate(query._from_obj):
+            if not _from.is_derived_from(graph.root):
+                continue
+            for hop, onclause in graph.paths[table]:
+                if not _from.is_derived_from(hop):
+                    _from = _from.join(hop, onclause)
+            query._from_obj = OrderedSet(
+                query._from_obj[:index] +
+                [_from] +
+                query._from_obj[index + 1:])
+            return
     # Check if the join is needed.
     _, orig_clause = sql_util.find_join_source(
                                             query._froms,
@@ -51,6 +249,51 @@ def join_table_with_query(query, table):
                                                                  query))
     return
 
+def column_collection(query):
+    """Returns the columns of the query, as a ColumnCollection.
+
+    The collection is built once for each list of columns of the query,
+    instead of once for each select looking up its column in it."""
+    return _query_columns(query)[0]
+
+
+def available_names(query):
+    """Returns the names of the columns of the query, and of the columns of
+    the tables and subqueries it selects from."""
+    return _query_columns(query)[1]
+
+
+def _query_columns(query):
+    key = (query._raw_columns, query._from_obj)
+    cached = getattr(query, '_pypet_columns', None)
+    if cached is None or cached[0][0] is not key[0] or (
+            cached[0][1] is not key[1]):
+        columns = ColumnCollection(*query.inner_columns)
+        names = set(col.key for col in columns)
+        names.update(col.key for _from in query._froms for col in _from.c)
+        cached = query._pypet_columns = key, columns, names
+    return cached[1:]
+
+
+def memoized(method):
+    """Decorates a method of the selects, whose result only depends on the
+    graph of their dependencies, to compute it once for each select in the
+    ```cache``` dict given to it, if any.
+
+    The cache is only valid as long as the graph does not change: compile
+    uses a new one for each of its passes."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = kwargs.get('cache')
+        if cache is None:
+            return method(self, *args, **kwargs)
+        key = method.__name__, self
+        if key not in cache:
+            cache[key] = method(self, *args, **kwargs)
+        return cache[key]
+    return wrapper
+
+
 class Select(_Generative):
 
     def __init__(self, comes_from, column_clause=None, name=None,
@@ -66,14 +309,12 @@ class Select(_Generative):
         self.need_groups = need_groups or []
 
     def _trim_dependency(self, query):
-        _froms_col = [col for _from in query._froms for col in _from.c]
+        names = available_names(query)
         for dep in self.dependencies:
             if isinstance(dep, (AggregateSelect, OverSelect)):
                 continue
             dep._trim_dependency(query)
-            if any(col.key == dep.name for col in
-                    query.inner_columns) or (any(col.key ==
-                        dep.name for col in _froms_col)):
+            if dep.name in names:
                 self.dependencies.remove(dep)
 
     def simplify(self, query, cuboid):
@@ -82,9 +323,11 @@ class Select(_Generative):
             select._trim_dependency(query)
         return new_selects
 
-    def depth(self):
-        sub_depth = max([0] + [sub.depth() for sub in self.dependencies])
-        if self.need_subquery():
+    @memoized
+    def depth(self, cache=None):
+        sub_depth = max([0] + [sub.depth(cache=cache)
+                               for sub in self.dependencies])
+        if self.need_subquery(cache=cache):
             return sub_depth + 1
         return sub_depth
 
@@ -92,16 +335,53 @@ class Select(_Generative):
     def rename(self, name):
         self.name = name
 
-    def need_column(self, column):
-        return self.name == column.key or any(dep.need_column(column)
-                for dep in self.dependencies)
+    def need_column(self, column, computed=(), cache=None):
+        """Returns True if the select reads the column, from its own
+        expression or from those of its dependencies which are not in
+        ```computed```. Those are rather read from their own column."""
+        return column.key in self.read_names(computed, cache=cache)
+
+    @memoized
+    def read_names(self, computed=(), cache=None):
+        """Returns the names of the columns read by the select, as
+        ```need_column``` does. A cache is only valid for a single
+        ```computed```."""
+        names = set([self.name])
+        for dep in self.dependencies:
+            if dep in computed:
+                names.add(dep.name)
+            else:
+                names.update(dep.read_names(computed, cache=cache))
+        return names
+
+    def same_as(self, other):
+        """Returns True if both selects compute the same expression, from
+        the same dependencies."""
+        return (type(self) is type(other) and self.name == other.name and
+                self.is_constant == other.is_constant and
+                self.joins == other.joins and
+                getattr(self.comes_from, 'agg', None) is
+                getattr(other.comes_from, 'agg', None) and
+                len(self.dependencies) == len(other.dependencies) and
+                all(dep is other_dep for dep, other_dep
+                    in zip(self.dependencies, other.dependencies)) and
+                len(self.need_groups) == len(other.need_groups) and
+                all(_same_clause(group, other_group) for group, other_group
+                    in zip(self.need_groups, other.need_groups)) and
+                _same_clause(self.column_clause, other.column_clause))
 
     def _append_join(self, query, **kwargs):
         for join in self.joins:
-            join_table_with_query(query, join)
+            join_table_with_query(query, join, kwargs.get('join_graph'))
         return query
 
-    def _replace_column(self, query, column):
+    def _replace_column(self, query, column, **kwargs):
+        columns = kwargs.get('columns')
+        if columns is not None:
+            # The columns of the query are set once all the selects are
+            # processed.
+            columns.replace(column)
+            return query
         columns = ColumnCollection(*query.inner_columns)
         columns.replace(column)
         return query.with_only_columns(columns)
@@ -109,11 +389,12 @@ class Select(_Generative):
     def _append_column(self, query, **kwargs):
         if self.column_clause is not None:
             return self._replace_column(query,
-                        self.column_clause.label(self.name))
+                        self.column_clause.label(self.name), **kwargs)
         return query
 
     def _append_where(self, query, **kwargs):
-        if self.where_clause is not None and not self.need_subquery():
+        if self.where_clause is not None and not self.need_subquery(
+                cache=kwargs.get('cache')):
             return query.where(self.where_clause)
         return query
 
@@ -128,16 +409,18 @@ class Select(_Generative):
             dep.visit(fun)
         fun(self)
 
-    def need_subquery(self):
+    @memoized
+    def need_subquery(self, cache=None):
         return any(isinstance(dep, (AggregateSelect, OverSelect))
                 for dep in self.dependencies)
 
 
 class ValueSelect(Select):
 
-    def need_subquery(self):
+    @memoized
+    def need_subquery(self, cache=None):
         return any(isinstance(dep, (AggregateSelect, OverSelect))
-                or dep.need_subquery()
+                or dep.need_subquery(cache=cache)
                 for dep in self.dependencies)
 
     def _append_column(self, query, **kwargs):
@@ -145,16 +428,16 @@ class ValueSelect(Select):
                 False):
             agg = self.comes_from.agg or func.max
             col = agg(self.column_clause).label(self.name)
-            return self._replace_column(query, col)
+            return self._replace_column(query, col, **kwargs)
         else:
-            return super(ValueSelect, self)._append_column(query)
+            return super(ValueSelect, self)._append_column(query, **kwargs)
 
 
 class AggregateSelect(ValueSelect):
 
     def _append_column(self, query, **kwargs):
         return self._replace_column(query,
-                    self.column_clause.label(self.name))
+                    self.column_clause.label(self.name), **kwargs)
 
     def _trim_dependency(self, query):
         pass
@@ -166,7 +449,7 @@ class OverSelect(Select):
         col = self.column_clause.label(self.name)
         if hasattr(self.column_clause, '_is_agg'):
             col._is_agg = self.column_clause._is_agg
-        query = self._replace_column(query, col)
+        query = self._replace_column(query, col, **kwargs)
         if kwargs['in_group']:
             for attr in ('order_by', 'partition_by'):
                 value = getattr(self.column_clause, attr)
@@ -214,13 +497,25 @@ class FilterSelect(Select):
     def __init__(self, *args, **kwargs):
         super(FilterSelect, self).__init__(*args, **kwargs)
         self.embedded = False
+        self.in_having = False
 
     def _append_where(self, query, **kwargs):
         if self.embedded:
             return query
+        elif self.in_having:
+            return query.having(self.where_clause)
         else:
             return super(FilterSelect, self)._append_where(query, **kwargs)
 
+    def can_have(self, values):
+        """Returns True if the filter only compares constants and aggregates
+        computed by the given selects, so that it can be the HAVING clause
+        of their query rather than filter it from an outer query."""
+        return (type(self) is FilterSelect and not self.embedded and
+                all(dep in values if isinstance(dep, AggregateSelect)
+                    else dep.is_constant and not dep.dependencies
+                    for dep in self.dependencies))
+
     def _contains_where(self, whereclause):
         """Isolates components of a where clause.
 
@@ -241,14 +536,17 @@ class FilterSelect(Select):
         for _from in query._froms:
             while(hasattr(_from, 'element')):
                 _from = _from.element
-            if self._contains_where(getattr(_from, '_whereclause', None)):
+            if (self._contains_where(getattr(_from, '_whereclause', None)) or
+                    self._contains_where(getattr(_from, '_having', None))):
                 return []
         return super(FilterSelect, self).simplify(query, cuboid)
 
-    def need_subquery(self):
+    @memoized
+    def need_subquery(self, cache=None):
         return any(isinstance(dep, (AggregateSelect, OverSelect))
                 for dep in self.dependencies) or any(
-                        dep.need_subquery() for dep in self.dependencies)
+                        dep.need_subquery(cache=cache)
+                        for dep in self.dependencies)
 
 
 class OrderSelect(Select):
@@ -257,18 +555,24 @@ class OrderSelect(Select):
         super(OrderSelect, self).__init__(comes_from, **kwargs)
         self.reverse = reverse
 
-    def need_subquery(self):
-        return any(d.need_subquery() or isinstance(d, OverSelect)
+    @memoized
+    def need_subquery(self, cache=None):
+        return any(d.need_subquery(cache=cache) or isinstance(d, OverSelect)
                    for d in self.dependencies)
 
     def _append_column(self, query, **kwargs):
         sort_col = self.column_clause
+        aggregate = (kwargs['in_group'] and
+                     not getattr(sort_col, '_is_agg', False) and
+                     getattr(self.comes_from, 'agg', None))
+        if aggregate:
+            sort_col = self.comes_from.agg(sort_col)
         if self.reverse:
             sort_col = sort_col.desc()
         else:
             sort_col = sort_col.asc()
         query = query.order_by(sort_col)
-        if kwargs['in_group']:
+        if kwargs['in_group'] and not aggregate:
             if not getattr(self.column_clause, '_is_agg', False):
                 self.column_clause._keep_group = True
                 query = query.group_by(self.column_clause)
@@ -288,35 +592,99 @@ def by_class(selects):
     return selects_dicts
 
 
+# The selects merged with the ones computing the same expression.
+SHARED_SELECTS = (ValueSelect, AggregateSelect, OverSelect, IdSelect,
+                  LabelSelect)
+
+
+def share_selects(selects):
+    """Returns the selects, each one computing the same expression as a
+    previous one being replaced by it, in the dependencies too.
+
+    Measures expand their operands into selects of their own, so that the
+    base measures used by several computed measures would else be compiled
+    once for each of them."""
+    seen = {}
+
+    def share(select):
+        select.dependencies = [share(dep) for dep in select.dependencies]
+        if type(select) not in SHARED_SELECTS:
+            return select
+        # Dependencies are shared first, so that selects computing the same
+        # expression depend on the very same selects.
+        key = (type(select), select.name, _clause_key(select.column_clause),
+               tuple(id(dep) for dep in select.dependencies))
+        candidates = seen.setdefault(key, [])
+        for other in candidates:
+            if other is select or select.same_as(other):
+                return other
+        candidates.append(select)
+        return select
+    return [share(select) for select in selects]
+
+
 def process_selects(query, selects, **kwargs):
     for select in selects:
         query = select._append_join(query, **kwargs)
+    kwargs['columns'] = ColumnCollection(*query.inner_columns)
     for select in selects:
         query = select._append_to_query(query, **kwargs)
-    return query
+    return query.with_only_columns(kwargs['columns'])
+
+
+def needed_names(selects, computed, cache=None):
+    """Returns the names of the columns read by the selects, from their own
+    expressions or from those of their dependencies which are not in
+    ```computed```, like ```Select.need_column``` does for a single column.
+
+    With a ```cache```, the names read by each select are only collected
+    once, so that the columns a query has to keep are found in a time linear
+    in the number of selects."""
+    names = set()
+    for select in selects:
+        names.update(select.read_names(computed, cache=cache))
+    return names
 
 
 def compile(selects, query, cuboid, level=0):
     if level > 10:
         raise Exception('Not convergent query, abort, abort!')
-    simples = [sel for sub in selects for sel in
-                sub.simplify(query, cuboid)]
+    simples = share_selects([sel for sub in selects for sel in
+                             sub.simplify(query, cuboid)])
+    # The select graph does not change anymore during this pass.
+    cache = {}
     subqueries = {}
-    tags = {}
+    visited = []
+    seen = set()
 
     def visit_sub(dep):
-        select_list = subqueries.setdefault(dep.depth(), [])
-        select_list.append(dep)
+        # Shared selects are only visited once.
+        if dep in seen:
+            return
+        seen.add(dep)
         for sub in dep.dependencies:
-            current_tag = tags.setdefault(sub, 0)
-            tags[sub] = current_tag + 1
+            visit_sub(sub)
+        visited.append(dep)
+        subqueries.setdefault(dep.depth(cache=cache), []).append(dep)
     for select in simples:
-        select.visit(visit_sub)
+        visit_sub(select)
+    # Tag the selects with the number of paths leading to them, each select
+    # being before its dependencies in the reversed visit order.
+    paths = {}
+    for select in simples:
+        paths[select] = paths.get(select, 0) + 1
+    tags = {}
+    for select in reversed(visited):
+        for sub in select.dependencies:
+            tags[sub] = tags.get(sub, 0) + paths.get(select, 0)
+            paths[sub] = paths.get(sub, 0) + paths.get(select, 0)
     subqueries = [sorted(val, key=lambda x: -tags.get(x, 0))
         for _, val in sorted(subqueries.items(), key=lambda x: x[0])]
     values = subqueries[0]
 
-    kwargs = {'in_group': False}
+    kwargs = {'in_group': False,
+              'join_graph': getattr(cuboid, 'join_graph', None),
+              'cache': cache}
     if any(isinstance(a, (AggregateSelect,)) for a in values):
         kwargs['in_group'] = True
         if any(isinstance(a, OverSelect) and not a.need_groups for a in values):
@@ -327,16 +695,45 @@ def compile(selects, query, cuboid, level=0):
                     values.extend(a.dependencies)
     if any(getattr(a, 'need_groups', []) for a in values):
         kwargs['in_group'] = True
-    idx = 0
+    if kwargs['in_group'] and len(subqueries) > 1:
+        # Filters on the aggregates of this query need no outer query.
+        for select in list(subqueries[1]):
+            if isinstance(select, FilterSelect) and select.can_have(values):
+                select.in_having = True
+                subqueries[1].remove(select)
+                values.append(select)
+        subqueries = [sub for sub in subqueries if sub]
+    if not kwargs['in_group']:
+        # Expressions on the windows of this query need no outer query.
+        computed = set(values)
+        pulled = True
+        while pulled:
+            pulled = False
+            for sub in subqueries[1:]:
+                for select in list(sub):
+                    if (type(select) is ValueSelect and
+                            select.dependencies and
+                            all(dep in computed
+                                for dep in select.dependencies)):
+                        sub.remove(select)
+                        values.append(select)
+                        computed.add(select)
+                        pulled = True
+        subqueries = [sub for sub in subqueries if sub]
+    # Selects of the same name replace the column of each other: the one
+    # read by the outer queries is processed last, to keep its column.
+    read = set(dep for sub in subqueries[1:] for select in sub
+               for dep in select.dependencies)
+    values.sort(key=lambda select: select in read)
     query = process_selects(query, values, **kwargs)
+    names = set(sel.name for sel in selects)
+    names.update(needed_names([sub for subs in subqueries[1:] for sub in subs],
+                              set(values), cache))
     columns_to_keep = []
     group_bys = []
     for column in list(query.inner_columns):
-        if ((column.key in [sel.name for sel in selects]) or
-            any(sub.need_column(column)
-                    for sub in reduce(list.__add__, subqueries[idx + 1:],
-                        []))):
-                columns_to_keep.append(column)
+        if column.key in names:
+            columns_to_keep.append(column)
         if hasattr(column, 'partition_by'):
             group_bys.append(column.partion_by)
     for column in query._group_by_clause:
@@ -345,13 +742,16 @@ def compile(selects, query, cuboid, level=0):
         elif hasattr(column, '_keep_group'):
             group_bys.append(column)
     if len(subqueries) > 1:
+        kept = set(c.key for c in columns_to_keep)
         for column in query._order_by_clause:
             column = column.element
-            if column.key not in [c.key for c in columns_to_keep]:
+            if column.key not in kept:
+                kept.add(column.key)
                 columns_to_keep.append(column)
     query = query.with_only_columns(columns_to_keep)
     query._group_by_clause = []
     query = query.group_by(*set(group_bys))
+    query = name_windows(query)
     if len(subqueries) > 1:
         query = query.alias().select()
         if cuboid.fact_count_column is not None:
@@ -0,0 +1,204 @@
+"""Helpers managing the physical layout of the cube fact table: its time
+range partitions, and the indexes its queries need."""
+
+from sqlalchemy.schema import Index, Table, Column, MetaData
+from sqlalchemy.sql import text
+from pypet import Level, ComputedLevel, AllLevel, Filter
+from pypet.aggbuilder import (NamingConvention, CreatePartitionedTable,
+                              create_partitions, _qualified_name)
+
+
+def partition_fact_table(cube, level, until=None,
+                         naming_convention=NamingConvention):
+    """Partitions the fact table by range on the column of the given time
+    level, with a partition for each member of the level, up to the member
+    of ```until``` if given, and a default partition.
+
+    A fact table which is not partitioned yet is converted, along with its
+    data, constraints, indexes and triggers. Writers are blocked during the
+    conversion. If it is already partitioned, only the missing partitions are
+    created, so that this can be used to create them ahead of time.
+
+    As PostgreSQL requires of a partitioned table, the level column is added
+    to the primary key and unique constraints of the fact table. A fact table
+    with an exclusion constraint not including that column, or referenced by
+    foreign keys, cannot be converted.
+    """
+    table = cube.table
+    if (level.column.table is not table or
+            getattr(level, 'bounds', None) is None):
+        raise ValueError('%s is not a time level of the fact table' %
+                         level.name)
+    conn = cube.selectable.bind.connect()
+    preparer = conn.dialect.identifier_preparer
+    tr = conn.begin()
+    try:
+        relkind = conn.execute(text(
+            'SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)'),
+            table=preparer.format_table(table)).scalar()
+        if relkind == 'p':
+            create_partitions(conn, table.name, level, table.schema, until,
+                              naming_convention)
+        else:
+            _convert(conn, table, level, until, naming_convention)
+        tr.commit()
+    except:
+        tr.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _convert(conn, table, level, until, naming_convention):
+    """Replaces the table by a partitioned table holding the same rows."""
+    preparer = conn.dialect.identifier_preparer
+    fact = preparer.format_table(table)
+    conn.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % fact)
+    # What the new table cannot inherit from the old one is recreated from
+    # its definition.
+    referencing = [row[0] for row in conn.execute(text(
+        'SELECT conname FROM pg_constraint '
+        'WHERE confrelid = CAST(:table AS regclass)'), table=fact)]
+    if referencing:
+        raise ValueError('%s is referenced by the foreign keys %s' % (
+            table.name, ', '.join(referencing)))
+    column = preparer.quote_identifier(level.column.name)
+    constraints = []
+    for row in conn.execute(text(
+            'SELECT conname, contype, pg_get_constraintdef(oid) AS definition, '
+            'EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = conrelid '
+            'AND attnum = ANY (conkey) AND attname = :column) AS keyed '
+            'FROM pg_constraint WHERE conrelid = CAST(:table AS regclass) '
+            "AND contype IN ('p', 'u', 'f', 'x') ORDER BY contype"),
+            table=fact, column=level.column.name):
+        definition = row.definition
+        if row.contype == 'x' and not row.keyed:
+            raise ValueError('The exclusion constraint %s does not include '
+                             'the %s column' % (row.conname,
+                                                level.column.name))
+        if row.contype in ('p', 'u') and not row.keyed:
+            # The key columns are the first parenthesized list.
+            definition = definition.replace(')', ', %s)' % column, 1)
+        constraints.append((row.conname, definition))
+    indexes = [row[0] for row in conn.execute(text(
+        'SELECT pg_get_indexdef(indexrelid) FROM pg_index '
+        'WHERE indrelid = CAST(:table AS regclass) '
+        'AND NOT EXISTS (SELECT 1 FROM pg_constraint '
+        'WHERE conindid = indexrelid)'), table=fact)]
+    triggers = [row[0] for row in conn.execute(text(
+        'SELECT pg_get_triggerdef(oid) FROM pg_trigger '
+        'WHERE tgrelid = CAST(:table AS regclass) AND NOT tgisinternal'),
+        table=fact)]
+    # The sequences owned by the columns, declared or not, which would be
+    # dropped along with the old table.
+    sequences = [(row.attname, row.sequence) for row in conn.execute(text(
+        'SELECT attname, CAST(CAST(objid AS regclass) AS text) AS sequence '
+        'FROM pg_depend '
+        "JOIN pg_class ON pg_class.oid = objid AND relkind = 'S' "
+        'JOIN pg_attribute ON attrelid = refobjid AND attnum = refobjsubid '
+        "WHERE classid = CAST('pg_class' AS regclass) "
+        "AND refobjid = CAST(:table AS regclass) AND deptype = 'a'"),
+        table=fact)]
+    old = Table(('pypet_unpartitioned_%s' % table.name)[:63], MetaData(),
+                *[Column(column.name, column.type) for column in table.c],
+                schema=table.schema)
+    conn.execute('ALTER TABLE %s RENAME TO %s' % (
+        fact, preparer.quote_identifier(old.name)))
+    conn.execute(CreatePartitionedTable(table.name, old.name,
+                                        level.column.name, table.schema,
+                                        table.schema))
+    create_partitions(conn, table.name,
+                      level.replace_expr(old.c[level.column.name]),
+                      table.schema, until, naming_convention)
+    conn.execute('INSERT INTO %s SELECT * FROM %s' % (
+        fact, preparer.format_table(old)))
+    for column_name, sequence in sequences:
+        conn.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (
+            sequence, fact, preparer.quote_identifier(column_name)))
+    conn.execute('DROP TABLE %s' % preparer.format_table(old))
+    statements = ['ALTER TABLE %s ADD CONSTRAINT %s %s' % (
+        fact, preparer.quote_identifier(name), definition)
+        for name, definition in constraints] + indexes + triggers
+    for statement in statements:
+        # The DBAPI would take any % in the definitions for a parameter.
+        conn.execute(statement.replace('%', '%%'))
+
+
+def _filter_levels(filter):
+    if isinstance(filter, Level):
+        return [filter]
+    if isinstance(filter, Filter):
+        return [level for operand in filter.operands
+                for level in _filter_levels(operand)]
+    return []
+
+
+def _references(table, target, seen=()):
+    """Returns True if the target table can be reached from the table
+    through foreign keys."""
+    if table is target:
+        return True
+    return any(_references(fk.column.table, target, seen + (table,))
+               for fk in table.foreign_keys if fk.column.table not in seen)
+
+
+def fact_indexes(cube, queries=None):
+    """Returns the indexes on the fact table useful to the given queries
+    (by default, to any query on the cube levels).
+
+    Time levels, whose values follow the facts insertion order, get a small
+    BRIN index on their column. The other levels get a btree index on the
+    fact table column joining their table, or on their own column if it
+    belongs to the fact table.
+    """
+    table = cube.table
+    if queries is None:
+        levels = [level for dimension in cube.dimensions.values()
+                  for hierarchy in dimension.hierarchies.values()
+                  for level in hierarchy.levels.values()]
+    else:
+        levels = [level for query in queries for level in query.axes]
+        levels += [level for query in queries
+                   for level in _filter_levels(query.filter_clause)]
+    existing = dict((index.name, index) for index in table.indexes)
+    indexes = {}
+    for level in levels:
+        if isinstance(level, AllLevel):
+            continue
+        if level.column.table is table:
+            columns = [level.column]
+        else:
+            columns = [fk.parent for fk in table.foreign_keys
+                       if _references(fk.column.table, level.column.table)]
+        for column in columns[:1]:
+            if column.key in indexes:
+                continue
+            if (isinstance(level, ComputedLevel) and
+                    getattr(level, 'bounds', None) is not None):
+                name = ('brin_%s_%s' % (table.name, column.key))[:63]
+                kwargs = {'postgresql_using': 'brin'}
+            else:
+                name = ('ix_%s_%s' % (table.name, column.key))[:63]
+                kwargs = {}
+            if name not in existing:
+                existing[name] = Index(name, column, **kwargs)
+            indexes[column.key] = existing[name]
+    return sorted(indexes.values(), key=lambda index: index.name)
+
+
+def create_indexes(cube, queries=None):
+    """Creates the indexes returned by ```fact_indexes``` which do not exist
+    yet, and returns them."""
+    conn = cube.selectable.bind.connect()
+    preparer = conn.dialect.identifier_preparer
+    created = []
+    tr = conn.begin()
+    for index in fact_indexes(cube, queries):
+        if conn.execute(text('SELECT to_regclass(:index) IS NULL'),
+                        index=_qualified_name(preparer, index.name,
+                                              cube.table.schema)).scalar():
+            index.create(bind=conn)
+            created.append(index)
+    tr.commit()
+    conn.close()
+    return created
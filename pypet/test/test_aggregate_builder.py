@@ -1,5 +1,32 @@
 from pypet.test import BaseTestCase
-from pypet.aggbuilder import AggBuilder, reflect_aggregates
+from pypet import Cube, Measure, aggregates
+from pypet.util import TimeDimension
+from pypet.aggbuilder import (AggBuilder, ParallelAggBuilder,
+                              NamingConvention, reflect_aggregates,
+                              drop_aggregate)
+from sqlalchemy import inspect, event, Integer
+from StringIO import StringIO
+
+
+def _rows(query):
+    """Returns the rows of the query, as dicts sorted by the axes ids."""
+    keys = [axis._label_for_select for axis in query.axes]
+    return sorted((dict(row) for row in query._as_sql().execute()),
+                  key=lambda row: [row[key] for key in keys])
+
+
+def assert_close_rows(rows, expected):
+    """Checks that the rows hold the expected values, up to the rounding
+    of the float sums maintained incrementally."""
+    assert len(rows) == len(expected)
+    for row, expected_row in zip(rows, expected):
+        assert sorted(row) == sorted(expected_row)
+        for key, value in row.items():
+            if isinstance(value, float):
+                assert abs(value - expected_row[key]) <= 1e-9 * max(
+                    1, abs(expected_row[key])), (key, value, expected_row)
+            else:
+                assert value == expected_row[key], (key, value, expected_row)
 
 
 class TestAggregateBuilder(BaseTestCase):
@@ -25,6 +52,205 @@ class TestAggregateBuilder(BaseTestCase):
         assert c.table.name not in sql_query
         assert other_query.execute() == facts_table_other_result
 
+    def test_build_many(self):
+        c = self.cube
+        year = c.query.axis(c.d['time'].l['year'])
+        month_region = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        month_country = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['country'])
+        expected = [q.execute() for q in (year, month_region, month_country)]
+        reports = AggBuilder.build_many([year, month_region, month_country])
+        assert [r.aggregate.selectable.name for r in reports] == [
+            'agg_time_month_store_country',
+            'agg_time_month_store_region',
+            'agg_time_year']
+        assert [r.source.name for r in reports] == [
+            'facts_table',
+            'agg_time_month_store_country',
+            'agg_time_month_store_region']
+        assert all(r.duration >= 0 for r in reports)
+        assert [q.execute() for q in (year, month_region,
+                                      month_country)] == expected
+
+    def test_parallel_build(self):
+        c = self.cube
+        year = c.query.axis(c.d['time'].l['year'])
+        month_region = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        product = c.query.axis(c.d['product'].l['product'])
+        expected = [q.execute() for q in (year, month_region, product)]
+        steps = []
+        builder = ParallelAggBuilder([year, month_region, product],
+                                     workers=2)
+        reports = builder.run(
+            progress=lambda done, total, what: steps.append((done, total)))
+        assert steps == [(i, 7) for i in range(1, 8)]
+        assert set(r.aggregate.selectable.name for r in reports) == set([
+            'agg_time_year', 'agg_time_month_store_region',
+            'agg_product_product'])
+        sources = {r.aggregate.selectable.name: r.source.name
+                   for r in reports}
+        assert sources['agg_time_year'] == 'agg_time_month_store_region'
+        indexes = inspect(c.table.bind).get_indexes(
+            'agg_time_month_store_region')
+        assert len(indexes) == 2
+        assert [q.execute() for q in (year, month_region,
+                                      product)] == expected
+
+    def test_parallel_build_cancel(self):
+        c = self.cube
+        year = c.query.axis(c.d['time'].l['year'])
+        month = c.query.axis(c.d['time'].l['month'])
+        builder = ParallelAggBuilder([year, month], workers=2)
+        reports = builder.run(
+            progress=lambda done, total, what: builder.cancel())
+        assert builder.cancelled
+        assert [r.aggregate.selectable.name for r in reports] == [
+            'agg_time_month']
+        assert [agg.selectable.name for agg in c.aggregates] == [
+            'agg_time_month']
+
+    def _fact_table_result(self, query):
+        aggs = self.cube.aggregates
+        self.cube.aggregates = []
+        result = query.execute()
+        self.cube.aggregates = aggs
+        return result
+
+    def test_refresh(self):
+        c = self.cube
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        builder = AggBuilder(query)
+        agg = builder.build()
+        watermark = builder.refresh(agg)
+        assert watermark == '2011-11-21'
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2012-03-01', 'qty': 10,
+                        'price': 100}).execute()
+        c.table.insert({'store_id': 5, 'product_id': 2,
+                        'date': '2012-03-15', 'qty': 20,
+                        'price': 50}).execute()
+        assert query.execute() != self._fact_table_result(query)
+        bind = c.table.bind
+        statements = []
+        event.listen(bind, 'before_cursor_execute',
+                     lambda conn, cursor, statement, parameters, *args:
+                     statements.append((statement, parameters)))
+        assert builder.refresh(agg) == '2012-03-15'
+        # Only the facts of the affected months are scanned and grouped
+        statement, parameters = [
+            (statement, parameters) for statement, parameters in statements
+            if statement.startswith('INSERT INTO agg_time_month')][0]
+        plan = [row[0] for row in bind.execute('EXPLAIN ' + statement,
+                                                parameters)]
+        scan = [i for i, line in enumerate(plan)
+                if 'Scan on facts_table' in line][0]
+        assert 'Filter: (date_trunc' in plan[scan + 1]
+        assert 'facts_table' not in str(query._as_sql())
+        assert query.execute() == self._fact_table_result(query)
+        # A late fact is only seen when refreshing from an older watermark.
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2009-01-12', 'qty': 200,
+                        'price': 1000}).execute()
+        builder.refresh(agg)
+        assert query.execute() != self._fact_table_result(query)
+        builder.refresh(agg, since='2009-01-01')
+        assert query.execute() == self._fact_table_result(query)
+
+    def test_partitioned(self):
+        c = self.cube
+        year = c.d['time'].l['year']
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        builder = AggBuilder(query)
+        agg = builder.build(partition_by=True)
+        table_name = 'agg_time_month_store_region'
+        bind = c.table.bind
+        assert sorted(row.relname for row in bind.execute(
+            "SELECT relname FROM pg_inherits JOIN pg_class "
+            "ON pg_class.oid = inhrelid "
+            "WHERE inhparent = '%s'::regclass" % table_name)) == [
+                table_name + suffix for suffix in (
+                    '_20090101', '_20100101', '_20110101', '_default')]
+        assert query.execute() == self._fact_table_result(query)
+        # Time filters only read the matching partition.
+        year_query = c.query.axis(c.d['store'].l['region']).filter(
+            year['2010-03-01'])
+        sql = year_query._as_sql().compile(bind=bind)
+        plan = '\n'.join(row[0] for row in bind.execute(
+            'EXPLAIN ' + unicode(sql), sql.params))
+        assert table_name + '_20100101' in plan
+        assert table_name + '_20090101' not in plan
+        assert year_query.execute() == self._fact_table_result(year_query)
+        # A late fact is taken into account by rebuilding its partition.
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2009-01-12', 'qty': 200,
+                        'price': 1000}).execute()
+        assert query.execute() != self._fact_table_result(query)
+        builder.rebuild_partition(agg, year['2009-01-12'])
+        assert query.execute() == self._fact_table_result(query)
+        self.assertRaises(ValueError, builder.rebuild_partition, agg,
+                          year['2020-01-01'])
+        # The partitioned table is reflected, but not its partitions.
+        c.aggregates = []
+        c.alchemy_md.remove(agg.selectable)
+        reflect_aggregates(c)
+        table = c.alchemy_md.tables[table_name]
+        assert set(table.primary_key.columns.keys()) == set([
+            'time_month', 'store_region'])
+        assert [agg.selectable.name for agg in c.aggregates
+                if agg.selectable.name.startswith(table_name)] == [table_name]
+        assert query.execute() == self._fact_table_result(query)
+
+    def test_integer_keys(self):
+        c = self.cube
+        time = TimeDimension('time', self.facts_table.c.date,
+                             ['year', 'month', 'day'], integer_keys=True)
+        c = self.cube = Cube(self.metadata, self.facts_table,
+                             [c.d['store'], c.d['product'], time],
+                             c.measures.values(),
+                             fact_count_column=self.facts_table.c.qty)
+        year = time.l['year']
+        query = c.query.axis(time.l['month'], c.d['store'].l['region'])
+        builder = AggBuilder(query)
+        agg = builder.build(partition_by=True, with_trigger=True)
+        assert isinstance(agg.selectable.c.time_month.type, Integer)
+        assert query.execute() == self._fact_table_result(query)
+        # The coarser levels and the filters read the keys.
+        year_query = c.query.axis(year).filter(year > year['2009-03-01'].id)
+        sql = str(year_query._as_sql())
+        assert 'WHERE agg_time_month_store_region.time_month >=' in sql
+        assert year_query.execute() == self._fact_table_result(year_query)
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2011-01-12', 'qty': 200,
+                        'price': 1000}).execute()
+        assert query.execute() == self._fact_table_result(query)
+        drop_aggregate(c, agg)
+
+    def test_labels(self):
+        c = self.cube
+        store = c.d['store']
+        query = c.query.axis(store.l['store'], c.d['time'].l['month'])
+        c.aggregates = []
+        agg = AggBuilder(query).build(with_labels=True, with_ancestors=True,
+                                      with_trigger=True)
+        assert set(column.name for column in agg.selectable.c) >= set([
+            'store_store', 'store_country', 'store_region',
+            'store_store_label', 'store_country_label',
+            'store_region_label'])
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2011-01-12', 'qty': 200,
+                        'price': 1000}).execute()
+        for other in (query, c.query.axis(store.l['country']),
+                      c.query.axis(store.l['region'],
+                                   c.d['time'].l['year'])):
+            # The aggregate answers alone
+            assert 'JOIN' not in str(other._as_sql())
+            assert other.execute() == self._fact_table_result(other)
+        drop_aggregate(c, agg)
+
     def test_matching(self):
         c = self.cube
         query = c.query.axis(c.d['time'].l['month'],
@@ -60,13 +286,14 @@ class TestAggregateBuilder(BaseTestCase):
 
 class TestTriggers(BaseTestCase):
 
-    def test_triggers(self, schema=None):
+    def test_triggers(self, schema=None, trigger_level='ROW'):
         c = self.cube
         query = c.query.axis(c.d['time'].l['month'],
                 c.d['store'].l['region'],
                 c.d['product'].l['All'])
         builder = AggBuilder(query)
-        builder.build(with_trigger=True, schema=schema)
+        builder.build(with_trigger=True, schema=schema,
+                      trigger_level=trigger_level)
         old_total_qty = c.query.axis().execute()["Quantity"]
         old_total_fact_count = c.query.axis().execute()["FACT_COUNT"]
         # Test with a value already in the agg table
@@ -107,9 +334,271 @@ class TestTriggers(BaseTestCase):
         assert res.by_label()['2020'].Quantity == 200
         assert res.by_label()['2020'].FACT_COUNT == 200
 
+    def _check_aggregates(self, queries):
+        c = self.cube
+        for query in queries:
+            assert 'facts_table' not in str(query._as_sql())
+        results = [query.execute() for query in queries]
+        oldaggs = c.aggregates
+        c.aggregates = []
+        assert [query.execute() for query in queries] == results
+        c.aggregates = oldaggs
+
+    def _count_fact_triggers(self):
+        return self.cube.table.bind.execute(
+            "SELECT count(*) FROM pg_trigger WHERE NOT tgisinternal AND "
+            "tgrelid = 'facts_table'::regclass").scalar()
+
+    def test_combined_trigger(self):
+        c = self.cube
+        month_region = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        year_store = c.query.axis(c.d['time'].l['year'],
+                c.d['store'].l['store'], c.d['product'].l['category'])
+        month_agg = AggBuilder(month_region).build(
+            with_trigger=True, trigger_level='COMBINED')
+        year_agg = AggBuilder(year_store).build(
+            with_trigger=True, schema='aggregates',
+            trigger_level='COMBINED')
+        assert self._count_fact_triggers() == 1
+        c.table.insert().execute([
+            {'store_id': 1, 'product_id': 2, 'date': '2009-01-12',
+             'qty': 200, 'price': 1000},
+            {'store_id': 5, 'product_id': 4, 'date': '2020-01-12',
+             'qty': 20, 'price': 10}])
+        c.table.update().where(c.table.c.store_id == 2).values(
+            qty=c.table.c.qty + 1, date='2011-01-01').execute()
+        self._check_aggregates([month_region, year_store])
+        drop_aggregate(c, month_agg)
+        assert c.aggregates == [year_agg]
+        assert self._count_fact_triggers() == 1
+        c.table.insert({'store_id': 3, 'product_id': 1, 'date': '2010-05-03',
+                        'qty': 5, 'price': 100}).execute()
+        self._check_aggregates([year_store])
+        drop_aggregate(c, year_agg)
+        assert c.aggregates == []
+        assert self._count_fact_triggers() == 0
+
+    def test_deferred(self):
+        c = self.cube
+        month_region = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        year_store = c.query.axis(c.d['time'].l['year'],
+                c.d['store'].l['store'])
+        month_agg = AggBuilder(month_region).build(
+            with_trigger=True, trigger_level='DEFERRED')
+        c.table.insert().execute([
+            {'store_id': 1, 'product_id': 2, 'date': '2009-01-12',
+             'qty': 200, 'price': 1000},
+            {'store_id': 5, 'product_id': 4, 'date': '2020-01-12',
+             'qty': 20, 'price': 10}])
+        # The pending changes are folded when building another aggregate
+        year_agg = AggBuilder(year_store).build(
+            with_trigger=True, schema='aggregates',
+            trigger_level='DEFERRED')
+        assert month_agg.lag() == year_agg.lag() == 0
+        c.table.update().where(c.table.c.store_id == 2).values(
+            qty=c.table.c.qty + 1, date='2011-01-01').execute()
+        c.table.delete().where(c.table.c.store_id == 3).execute()
+        assert month_agg.lag() > 0
+        oldaggs = c.aggregates
+        c.aggregates = []
+        expected = [query.execute() for query in (month_region, year_store)]
+        c.aggregates = oldaggs
+        # Stale aggregates are used by default
+        assert month_region.execute() != expected[0]
+        for fold in (True, False):
+            query = month_region.fresh(fold)
+            sql = str(query._as_sql())
+            assert ('pypet_delta_facts_table' in sql) == fold
+            assert ('agg_time_month' in sql) == fold
+            assert query.execute() == expected[0]
+        log = month_agg.delta_log
+        # A failed merge releases the log table
+        self.assertRaises(AttributeError, log.merge, aggregates=[None])
+        assert self.metadata.bind.execute(
+            "SELECT count(*) FROM pg_locks "
+            "WHERE relation = 'pypet_delta_facts_table'::regclass"
+        ).scalar() == 0
+        while log.merge(batch_size=2):
+            pass
+        assert month_agg.lag() == 0
+        self._check_aggregates([month_region, year_store])
+        assert [query.execute()
+                for query in (month_region, year_store)] == expected
+        drop_aggregate(c, month_agg)
+        drop_aggregate(c, year_agg)
+        assert self._count_fact_triggers() == 0
+
+    def test_deferred_without_inverse(self):
+        c = self.cube
+        c.measures['Max Price'] = Measure('Max Price', c.table.c.price,
+                                          aggregates.max)
+        query = c.query.axis(c.d['time'].l['month']).measure(
+            c.m['Quantity'], c.m['Max Price'])
+        for build in (AggBuilder(query).build, AggBuilder(query).build_online):
+            self.assertRaises(ValueError, build, with_trigger=True,
+                              trigger_level='DEFERRED')
+        assert self._count_fact_triggers() == 0
+        assert not c.table.bind.has_table('pypet_delta_facts_table')
+
+    def test_bulk_load(self):
+        c = self.cube
+        month_region = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'], c.d['product'].l['All'])
+        year_store = c.query.axis(c.d['time'].l['year'],
+                c.d['store'].l['store'], c.d['product'].l['category'])
+        AggBuilder(month_region).build(with_trigger=True)
+        AggBuilder(year_store).build(with_trigger=True, schema='aggregates',
+                                     trigger_level='STATEMENT')
+        facts = c.table.count().scalar()
+        assert c.bulk_load([
+            {'store_id': 1, 'product_id': 2, 'date': date, 'qty': qty,
+             'price': 1000}
+            for date, qty in (('2009-01-12', 200), ('2020-01-12', 20),
+                              ('2020-02-01', 1))]) == 3
+        assert c.bulk_load(StringIO('5,4,2011-05-02,10,"5.5"\n'
+                                    '7,1,2020-01-13,3,20\n'),
+                           columns=['store_id', 'product_id', 'date',
+                                    'qty', 'price']) == 2
+        assert c.table.count().scalar() == facts + 5
+        self._check_aggregates([month_region, year_store])
+        # The triggers are enabled again
+        c.table.insert({'store_id': 3, 'product_id': 1, 'date': '2010-05-03',
+                        'qty': 5, 'price': 100}).execute()
+        self._check_aggregates([month_region, year_store])
+
+    def test_bulk_load_long_names(self):
+        c = self.cube
+
+        class LongNames(NamingConvention):
+            table_name = 'aggregate_table_{levels}'
+
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'], c.d['product'].l['category'])
+        agg = AggBuilder(query, naming_convention=LongNames).build(
+            with_trigger=True)
+        # PostgreSQL truncates the names of its triggers
+        assert len('ins_trigger_%s' % agg.selectable.name) > 63
+        assert c.bulk_load([
+            {'store_id': 1, 'product_id': 2, 'date': '2009-01-12',
+             'qty': 200, 'price': 1000}],
+            naming_convention=LongNames) == 1
+        self._check_aggregates([query])
+        drop_aggregate(c, agg, naming_convention=LongNames)
+
+    def test_bulk_load_nulls(self):
+        c = self.cube
+        nulls = c.table.select().where(c.table.c.product_id == None)
+        assert c.bulk_load([
+            {'store_id': 1, 'product_id': None, 'date': '2009-01-12',
+             'qty': 3, 'price': 1.5},
+            {'store_id': 2, 'date': '2009-01-13', 'qty': 4,
+             'price': 2.5}]) == 2
+        assert [(row.store_id, row.qty) for row in nulls.order_by(
+            c.table.c.store_id).execute()] == [(1, 3), (2, 4)]
+        # A failed load releases its connection, and loads nothing
+        pool = c.table.bind.pool
+        checkedout = pool.checkedout()
+        try:
+            c.bulk_load([{'store_id': 1, 'product_id': 1,
+                          'date': 'not a date', 'qty': 1, 'price': 1}])
+        except Exception:
+            pass
+        else:
+            assert False, 'The invalid fact was loaded'
+        assert pool.checkedout() == checkedout
+        assert len(list(nulls.execute())) == 2
+
+    def test_online_build(self):
+        c = self.cube
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'],
+                c.d['product'].l['All'])
+        builder = AggBuilder(query)
+        create_table = builder.create_table
+
+        def create_table_with_writers(*args, **kwargs):
+            agg = create_table(*args, **kwargs)
+            # Other sessions write to the fact table during the build.
+            c.table.insert().execute([
+                {'store_id': 1, 'product_id': 2, 'date': '2009-01-12',
+                 'qty': 200, 'price': 1000},
+                {'store_id': 5, 'product_id': 4, 'date': '2020-01-12',
+                 'qty': 20, 'price': 10}])
+            c.table.update().where(c.table.c.store_id == 2).values(
+                qty=c.table.c.qty + 1, date='2011-01-01').execute()
+            return agg
+        builder.create_table = create_table_with_writers
+        agg = builder.build_online(with_trigger=True, batch_size=1)
+        assert agg.selectable.name == 'agg_time_month_store_region_product_All'
+        assert c.aggregates == [agg]
+        inspector = inspect(c.table.bind)
+        assert not [name for name in inspector.get_table_names()
+                    if name.startswith('pypet_')]
+        assert len(inspector.get_indexes(agg.selectable.name)) == 2
+        assert self._count_fact_triggers() == 2
+        self._check_aggregates([query])
+        c.table.insert({'store_id': 3, 'product_id': 1, 'date': '2010-05-03',
+                        'qty': 5, 'price': 100}).execute()
+        self._check_aggregates([query])
+
+    def test_online_build_failure(self):
+        c = self.cube
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'])
+        builder = AggBuilder(query)
+
+        def failing_trigger(*args, **kwargs):
+            raise RuntimeError('trigger')
+        builder._install_trigger = failing_trigger
+        self.assertRaises(RuntimeError, builder.build_online,
+                          with_trigger=True)
+        # The table built under the online name is dropped.
+        inspector = inspect(c.table.bind)
+        assert not [name for name in inspector.get_table_names()
+                    if name.startswith('pypet_') or
+                    name == 'agg_time_month_store_region']
+        assert 'agg_time_month_store_region' not in c.alchemy_md.tables
+        assert c.aggregates == []
+        assert self._count_fact_triggers() == 0
+
     def test_in_schema(self):
         self.test_triggers(schema='aggregates')
 
+    def test_statement_triggers(self):
+        self.test_triggers(trigger_level='STATEMENT')
+
+    def test_statement_triggers_in_schema(self):
+        self.test_triggers(schema='aggregates', trigger_level='STATEMENT')
+
+    def test_statement_triggers_batch(self):
+        c = self.cube
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'],
+                c.d['product'].l['All'])
+        AggBuilder(query).build(with_trigger=True,
+                                trigger_level='STATEMENT')
+        c.table.insert().execute([
+            {'store_id': store_id, 'product_id': 2, 'date': day,
+             'qty': qty, 'price': 1000}
+            for store_id, day, qty in ((1, '2009-01-12', 200),
+                                       (3, '2009-01-20', 10),
+                                       (5, '2020-01-12', 20),
+                                       (7, '2020-01-13', 30))])
+        c.table.update().where(c.table.c.store_id == 2).values(
+            qty=c.table.c.qty + 1, price=10).execute()
+        c.table.update().where(c.table.c.store_id == 4).values(
+            date='2011-01-01').execute()
+        assert 'facts_table' not in str(query._as_sql())
+        result = _rows(query)
+        oldaggs = c.aggregates
+        c.aggregates = []
+        # The statement deltas are added to the float sums in another order
+        # than the facts are summed
+        assert_close_rows(result, _rows(query))
+        c.aggregates = oldaggs
+
     def setUp(self):
         self.schema = None
         super(TestTriggers, self).setUp()
@@ -1,9 +1,18 @@
 from pypet.test import BaseTestCase
-from pypet import Aggregate, OrFilter, AndFilter
+from pypet import (Aggregate, OrFilter, AndFilter, Cube, Dimension,
+                   Hierarchy, Level, Measure, MembersFilter, rank)
+from pypet.util import TimeDimension
+from pypet.aggbuilder import AggBuilder, drop_aggregate
+from pypet.internals import share_selects
 from pypet import aggregates
 from sqlalchemy.sql import func
 
 
+def _row_set(query):
+    """Returns the rows of the query SQL, unordered."""
+    return set(frozenset(row.items()) for row in query._as_sql().execute())
+
+
 class TestModel(BaseTestCase):
 
     def test_dimensions(self):
@@ -97,6 +106,10 @@ class TestModel(BaseTestCase):
                 found = self._find_from(_from._froms, value)
                 if found:
                     return True
+            if hasattr(_from, 'selects'):
+                found = self._find_from(_from.selects, value)
+                if found:
+                    return True
         return False
 
     def compare_agg(self, query, used_agg=None):
@@ -168,6 +181,53 @@ class TestModel(BaseTestCase):
         assert self._find_from(query._as_sql()._froms,
                 self.agg_by_year_country_table)
 
+    def test_split_measures(self):
+        max_quantity = Measure('Max Quantity', self.facts_table.c.qty,
+                               aggregates.max)
+        query = (self.cube.query
+                 .axis(self.cube.d['time'].l['month'],
+                       self.cube.d['store'].l['store'])
+                 .measure(self.cube.measures['Quantity'], max_quantity))
+        self._append_aggregate_by_month()
+        # The quantity is read from the aggregate, its maximum from the facts
+        split = query._as_sql()
+        assert self._find_from(split._froms, self.agg_by_month_table)
+        assert self._find_from(split._froms, self.facts_table)
+        late = query.late_labels()
+        assert str(late._as_sql()).count('store_name') == 1
+        self.cube.aggregates = []
+        assert not self._find_from(query._as_sql()._froms,
+                                   self.agg_by_month_table)
+        self.compare_agg(query)
+        self.compare_agg(late)
+        # The rows missing from a lagging aggregate are kept
+        self.facts_table.insert().execute(store_id=1, product_id=1,
+                                          date='2012-03-04', qty=3, price=5)
+        self._append_aggregate_by_month()
+        row = query.execute().by_label()['2012-03'].by_label()['ACME.fr']
+        assert row['Max Quantity'] == 3
+        assert row['Quantity'] is None
+        # And the rows with a null axis id are merged
+        self.facts_table.insert().execute(store_id=1, product_id=1,
+                                          date=None, qty=7, price=5)
+        for month, qty in (('2012-03-01', 3), (None, 7)):
+            self.agg_by_month_table.insert().execute({
+                'store_store': 1, 'product_product': 1, 'time_month': month,
+                'Unit Price': 5, 'Quantity': qty, 'fact_count': qty})
+        month = self.cube.d['time'].l['month']._label_for_select
+        for split_query in (query, late):
+            self.cube.aggregates = []
+            self._append_aggregate_by_month()
+            rows = _row_set(split_query)
+            assert None in [dict(row)[month] for row in rows]
+            self.cube.aggregates = []
+            assert rows == _row_set(split_query)
+        # Ordered queries are not split
+        self._append_aggregate_by_month()
+        ordered = query.order_by(max_quantity)
+        assert not self._find_from(ordered._as_sql()._froms,
+                                   self.agg_by_month_table)
+
     def test_filters(self):
         query1 = (self.cube.query
                 .filter(self.cube.d['time'].l['year'].member_by_label('2010')))
@@ -255,6 +315,184 @@ class TestModel(BaseTestCase):
                  .filter(self.cube.d['store'].l['store'].label_only.ilike('%%mart%%')))
         assert query.execute().keys() == [3, 4, 6, 8]
 
+    def test_members_filters(self):
+        product = self.cube.d['product'].l['product']
+        year = self.cube.d['time'].l['year']
+        members = product.members[:3]
+        reference = self.cube.query.axis(year).filter(
+            OrFilter(*[product == member.id for member in members]))
+        query = self.cube.query.axis(year).filter(*members)
+        assert isinstance(query.filter_clause, MembersFilter)
+        assert '= any(' in str(query._as_sql())
+        assert query.execute() == reference.execute()
+        self.compare_agg(query)
+        # Above the threshold, the ids are read from a temporary table
+        threshold = MembersFilter.table_threshold
+        MembersFilter.table_threshold = 2
+        try:
+            query = self.cube.query.axis(year).filter(*members)
+        finally:
+            MembersFilter.table_threshold = threshold
+        assert 'IN (SELECT pypet_members_' in str(query._as_sql())
+        assert query.execute() == reference.execute()
+        assert query[0:2].keys() == reference[0:2].keys()
+        self.compare_agg(query)
+
+    def test_having(self):
+        country = self.cube.d['store'].l['country']
+        quantity = self.cube.measures['Quantity']
+        query = (self.cube.query.axis(country).measure(quantity)
+                 .filter(quantity > 40))
+        sql = str(query._as_sql())
+        assert 'HAVING sum(facts_table.qty) > ' in sql
+        assert 'FROM (' not in sql
+        expected = [key for key, value in self.cube.query.axis(country)
+                    .measure(quantity).execute().by_label().items()
+                    if value['Quantity'] > 40]
+        assert query.execute().by_label().keys() == expected
+        self.compare_agg(query)
+
+    def test_time_filters(self):
+        year = self.cube.d['time'].l['year']
+        month = self.cube.d['time'].l['month']
+        for member_filter, expected in (
+                (year >= year['2010-01-01'].id, ['2010', '2011']),
+                (year > year['2010-01-01'].id, ['2011']),
+                (year <= year['2010-01-01'].id, ['2009', '2010']),
+                (year < year['2010-01-01'].id, ['2009']),
+                (month.between(month['2009-11-01'].id,
+                               month['2010-01-01'].id), ['2009', '2010']),
+                (OrFilter(year['2009-01-01'], year['2011-01-01']),
+                 ['2009', '2011'])):
+            query = self.cube.query.axis(year).filter(member_filter)
+            self.cube.aggregates = []
+            # The filter reads the date column, without computing the level
+            sql = str(query._as_sql())
+            assert 'date_trunc' not in sql.split('WHERE')[1].split('GROUP BY')[0]
+            assert sorted(query.execute().by_label().keys()) == expected
+            self.compare_agg(query)
+
+    def test_date_table(self):
+        time = TimeDimension('time', self.facts_table.c.date,
+                             ['year', 'month', 'day'], date_table='dates')
+        cube = Cube(self.metadata, self.facts_table,
+                    [self.cube.d['store'], self.cube.d['product'], time],
+                    self.cube.measures.values(),
+                    fact_count_column=self.facts_table.c.qty)
+        time.populate_date_table(until='2012-01-31')
+        # Populating again only adds the missing dates
+        time.populate_date_table()
+        dates = time.date_table
+        assert dates.count().scalar() == dates.select().where(
+            dates.c.date.between('2009-01-01', '2012-01-31')).count().scalar()
+        month = time.l['month']
+        for query, reference in (
+                (cube.query.axis(time.l['year']),
+                 self.cube.query.axis(self.cube.d['time'].l['year'])),
+                (cube.query.axis(month).filter(month >= month['2010-05-01'].id),
+                 self.cube.query.axis(self.cube.d['time'].l['month']).filter(
+                     self.cube.d['time'].l['month'] >=
+                     self.cube.d['time'].l['month']['2010-05-01'].id))):
+            sql = str(query._as_sql())
+            assert 'date_trunc' not in sql
+            assert 'dates' in sql
+            assert query.execute() == reference.execute()
+        # Rolling up an aggregate reads its own columns
+        agg = AggBuilder(cube.query.axis(month)).build(with_trigger=True)
+        query = cube.query.axis(time.l['year'])
+        assert cube.aggregates == [agg]
+        assert agg.selectable.name in str(query._as_sql())
+        assert query.execute() == self.cube.query.axis(
+            self.cube.d['time'].l['year']).execute()
+        # The quoted trigger names of older aggregates are migrated
+        bind = self.facts_table.bind
+        bind.execute('ALTER TRIGGER ins_trigger_agg_time_month ON facts_table '
+                     'RENAME TO """ins_trigger_agg_time_month"""')
+        time.populate_date_table()
+        assert sorted(row[0] for row in bind.execute(
+            "SELECT tgname FROM pg_trigger WHERE NOT tgisinternal AND "
+            "tgrelid = 'facts_table'::regclass")) == [
+                'date_facts_table_dates', 'ins_trigger_agg_time_month',
+                'upd_trigger_agg_time_month']
+        # The date of a new fact is added to the date table by a trigger,
+        # before the aggregate is maintained
+        self.facts_table.insert().execute(store_id=1, product_id=1,
+                                          date='2013-02-03', qty=2, price=5)
+        reference = self.cube.query.axis(self.cube.d['time'].l['year'])
+        self.cube.aggregates = []
+        assert '2013' in query.execute().by_label()
+        assert query.execute() == reference.execute()
+        drop_aggregate(cube, agg)
+        self.facts_table.update().where(
+            self.facts_table.c.date == '2009-01-03').values(
+            date='2014-06-07').execute()
+        assert '2014' in query.execute().by_label()
+        assert query.execute() == reference.execute()
+
+    def test_join_paths(self):
+        graph = self.cube.join_graph
+        assert [table for table, _ in graph.paths[self.region_table]] == [
+            self.store_table, self.country_table, self.region_table]
+        # A role-playing alias is only reachable through an explicit path
+        country = self.country_table.alias('store_country')
+        assert country not in graph.paths
+        dimension = Dimension('store_country', [Hierarchy('default', [
+            Level('country', country.c.country_id, country.c.country_name)])])
+        cube = Cube(self.metadata, self.facts_table, [dimension],
+                    self.cube.measures.values(),
+                    fact_count_column=self.facts_table.c.qty,
+                    join_paths={country: country.c.country_id ==
+                                self.store_table.c.country_id})
+        result = cube.query.axis(dimension.l['country']).execute().by_label()
+        reference = self.cube.query.axis(
+            self.cube.d['store'].l['country']).execute().by_label()
+        assert result.keys() == reference.keys()
+        for key in reference:
+            assert result[key]['Quantity'] == reference[key]['Quantity']
+
+    def test_join_elimination(self):
+        store = self.cube.d['store'].l['store']
+        year = self.cube.d['time'].l['year']
+        query = self.cube.query.axis(year).filter(store == 3)
+        sql = str(query._as_sql())
+        assert 'facts_table.store_id = ' in sql
+        assert 'JOIN store' not in sql
+        result = query.execute().by_label()
+        assert [result[key]['Quantity'] for key in result] == [3, 10, 21]
+        # The label still needs the store table
+        sql = str(self.cube.query.axis(store)._as_sql())
+        group_by = sql.split('GROUP BY ', 1)[1]
+        assert 'facts_table.store_id' in group_by
+        assert 'store.store_name' in group_by
+        late = self.cube.query.axis(store).late_labels()
+        aggregation = str(late._as_sql()).split('FROM (', 1)[1]
+        assert 'JOIN store ON' not in aggregation
+        assert late.execute() == self.cube.query.axis(store).execute()
+        # A fact without a store, left out by the join, is filtered out
+        self.facts_table.insert().execute(store_id=None, product_id=1,
+                                          date='2010-01-03', qty=1000,
+                                          price=5)
+        result = late.execute()
+        assert None not in result
+        assert sum(result[key]['Quantity'] for key in result) == 212
+        assert result == self.cube.query.axis(store).execute()
+
+    def test_late_labels(self):
+        country = self.cube.d['store'].l['country']
+        query = self.cube.query.axis(country,
+                                     self.cube.d['time'].l['year'])
+        late = query.late_labels()
+        sql = str(late._as_sql())
+        # The labels are neither read nor grouped by in the aggregation
+        aggregation = sql.split('FROM (', 1)[1]
+        assert 'country_name' not in aggregation
+        assert 'country_name' in sql
+        assert late.execute() == query.execute()
+        self.compare_agg(late)
+        top = (self.cube.query.axis(self.cube.d['store'].l['store'])
+               .top(3, self.cube.measures['Price']).late_labels())
+        assert top.execute().by_label().keys() == [
+            u'Food Mart.us', u'Food Mart.fr', u'Food Mart.de']
 
     def test_top(self):
         query = (self.cube.query.axis(self.cube.d['time'].l['month'])
@@ -262,6 +500,11 @@ class TestModel(BaseTestCase):
         res = query.execute().by_label()
         self.compare_agg(query)
         assert res.keys() == [u'2011-01', u'2011-05', u'2010-11']
+        sql = str(query._as_sql())
+        assert 'LIMIT' in sql
+        assert 'dense_rank' not in sql
+        # Slices are taken among the top rows
+        assert query[1:10].by_label().keys() == [u'2011-05', u'2010-11']
         mes = self.cube.measures['Price'].percent_over(
                     self.cube.d['time'].l['year'])
         query = (self.cube.query.axis(self.cube.d['time'].l['month'])
@@ -277,6 +520,26 @@ class TestModel(BaseTestCase):
         self.compare_agg(query)
         # Top 2 by year = 6 entries
         assert len(res) == 6
+        assert 'LATERAL' in str(query._as_sql())
+        by_year = {}
+        for key, value in (self.cube.query.axis(self.cube.d['time'].l['month'])
+                           .measure(mes).execute().by_label().items()):
+            by_year.setdefault(key[:4], []).append((value[mes.name], key))
+        assert set(res.keys()) == set(key for values in by_year.values()
+                                      for _, key in sorted(values)[-2:])
+        # Window measures added after the top are computed over every row
+        price = self.cube.measures['Price']
+        ranked = rank('R', None, [price])
+        year = self.cube.d['time'].l['year']
+        query = (self.cube.query.axis(self.cube.d['time'].l['month'])
+                 .top(2, price, partition_by=year).measure(ranked))
+        expected = (self.cube.query.axis(self.cube.d['time'].l['month'])
+                    .measure(ranked).top(2, price, partition_by=year))
+        assert 'LATERAL' not in str(query._as_sql())
+        assert query.execute().by_label() == expected.execute().by_label()
+        assert sorted(value['R'] for value in
+                      query.execute().by_label().values()) == [1, 2, 3, 6,
+                                                               9, 10]
         # Top 3 (in percent by year) of all time
         query = (self.cube.query.axis(self.cube.d['time'].l['month'])
                 .measure(mes)
@@ -297,6 +560,81 @@ class TestModel(BaseTestCase):
                     .top(3, m))
         res = query.execute()
 
+    def test_shared_windows(self):
+        year = self.cube.d['time'].l['year']
+        region = self.cube.d['store'].l['region']
+        price = self.cube.m['Price']
+        quantity = self.cube.m['Quantity']
+        query = (self.cube.query.axis(self.cube.d['time'].l['month'], region)
+                 .measure(price.percent_over(year),
+                          quantity.percent_over(year),
+                          quantity.percent_over(region)))
+        sql = str(query._as_sql())
+        # The windows partitioned by year are defined once, and the
+        # percentages computed along with them
+        assert sql.count('PARTITION BY') == 2
+        assert 'WINDOW pypet_window_0 AS (PARTITION BY' in sql
+        assert sql.count('FROM (') == 1
+        totals = {}
+        for month, regions in query.execute().by_label().items():
+            for values in regions.values():
+                totals.setdefault(month[:4], []).append(
+                    values[quantity.percent_over(year).name])
+        for values in totals.values():
+            assert round(sum(values), 6) == 100
+
+    def test_shared_selects(self):
+        price = self.cube.m['Price']
+        quantity = self.cube.m['Quantity']
+        query = (self.cube.query.axis(self.cube.d['time'].l['month'])
+                 .measure(price, quantity, (price / quantity).label('mean'),
+                          (quantity * 2).label('double')))
+        def quantities(selects):
+            found = []
+            for select in selects:
+                select.visit(lambda sel: sel.name == 'Quantity' and
+                             sel not in found and found.append(sel))
+            return found
+        selects = [select for part in query.parts
+                   for select in part._as_selects(self.cube)]
+        assert len(quantities(selects)) == 8
+        # The sum of the quantities expanded by each measure is computed
+        # once, the price using its own unaggregated quantity
+        assert len(quantities(share_selects(selects))) == 3
+        sql = str(query._as_sql())
+        assert sql.count('sum(facts_table.qty)') == 1
+        # The operands of the price are not computed for themselves
+        assert 'max(facts_table.price)' not in sql
+        for values in query.execute().values():
+            assert values['double'] == 2 * values['Quantity']
+            assert values['mean'] == values['Price'] / values['Quantity']
+        # The shared sum of the quantities is read from the subquery
+        query = (self.cube.query.axis(self.cube.d['time'].l['month'])
+                 .measure(price, quantity,
+                          (price + quantity + quantity).label('sum')))
+        for values in query.execute().values():
+            assert values['sum'] == values['Price'] + 2 * values['Quantity']
+
+    def test_deep_measures(self):
+        price = self.cube.m['Price']
+        quantity = self.cube.m['Quantity']
+        deep = price
+        for _ in range(60):
+            deep = deep + quantity
+        selects = share_selects(deep._as_selects(self.cube))
+        found = []
+        for select in selects:
+            select.visit(lambda sel: sel not in found and found.append(sel))
+        # The depth and the need of a subquery are computed once by select
+        cache = {}
+        depths = [select.depth(cache=cache) for select in selects]
+        assert depths == [select.depth() for select in selects]
+        assert len(cache) == 2 * len(found)
+        query = (self.cube.query.axis(self.cube.d['time'].l['month'])
+                 .measure(price, quantity, deep.label('deep')))
+        for values in query.execute().values():
+            assert values['deep'] == values['Price'] + 60 * values['Quantity']
+
     def test_query_equality(self):
         assert self.cube.query == self.cube.query
         region = self.cube.d['store'].l['region'][1]
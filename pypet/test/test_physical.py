@@ -0,0 +1,100 @@
+from pypet.test import BaseTestCase
+from pypet.aggbuilder import AggBuilder, drop_aggregate
+from pypet.physical import (partition_fact_table, fact_indexes,
+                            create_indexes)
+from sqlalchemy import inspect
+
+
+class TestPhysical(BaseTestCase):
+
+    def _partitions(self, table_name):
+        return sorted(row.relname for row in self.cube.table.bind.execute(
+            "SELECT relname FROM pg_inherits JOIN pg_class "
+            "ON pg_class.oid = inhrelid "
+            "WHERE inhparent = '%s'::regclass" % table_name))
+
+    def test_partition_fact_table(self):
+        c = self.cube
+        c.aggregates = []
+        year = c.d['time'].l['year']
+        query = c.query.axis(c.d['time'].l['month'],
+                c.d['store'].l['region'],
+                c.d['product'].l['All'])
+        agg = AggBuilder(query).build(with_trigger=True)
+        c.aggregates = []
+        expected = query.execute()
+        partition_fact_table(c, year)
+        assert self._partitions('facts_table') == [
+            'facts_table_20090101', 'facts_table_20100101',
+            'facts_table_20110101', 'facts_table_default']
+        assert query.execute() == expected
+        # Time filters only read the matching partition.
+        year_query = c.query.axis(c.d['store'].l['region']).filter(
+            year['2010-03-01'])
+        sql = year_query._as_sql().compile(bind=c.table.bind)
+        plan = '\n'.join(row[0] for row in c.table.bind.execute(
+            'EXPLAIN ' + unicode(sql), sql.params))
+        assert 'facts_table_20100101' in plan
+        assert 'facts_table_20090101' not in plan
+        # Partitions are created ahead of time, and the triggers are kept.
+        partition_fact_table(c, year, until='2013-06-01')
+        assert self._partitions('facts_table')[3:] == [
+            'facts_table_20120101', 'facts_table_20130101',
+            'facts_table_default']
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2012-03-01', 'qty': 10,
+                        'price': 100}).execute()
+        facts_result = query.execute()
+        c.aggregates = [agg]
+        assert query.execute() == facts_result
+        drop_aggregate(c, agg)
+        self.assertRaises(ValueError, partition_fact_table, c,
+                          c.d['store'].l['store'])
+
+    def test_indexes(self):
+        c = self.cube
+        names = [index.name for index in fact_indexes(c)]
+        assert names == ['brin_facts_table_date',
+                         'ix_facts_table_product_id',
+                         'ix_facts_table_store_id']
+        query = c.query.axis(c.d['store'].l['region']).filter(
+            c.d['time'].l['year']['2010-03-01'])
+        created = create_indexes(c, [query])
+        assert [index.name for index in created] == [
+            'brin_facts_table_date', 'ix_facts_table_store_id']
+        assert create_indexes(c, [query]) == []
+        indexes = inspect(c.table.bind).get_indexes('facts_table')
+        assert set(index['name'] for index in indexes) == set([
+            'brin_facts_table_date', 'ix_facts_table_store_id'])
+
+    def test_partition_keyed_fact_table(self):
+        c = self.cube
+        bind = c.table.bind
+        year = c.d['time'].l['year']
+        # A serial key which the table metadata does not declare
+        bind.execute('ALTER TABLE facts_table ADD COLUMN id serial '
+                     'PRIMARY KEY')
+        bind.execute('ALTER TABLE facts_table ADD CONSTRAINT '
+                     'facts_table_store_key UNIQUE (id, store_id)')
+        bind.execute('CREATE TABLE facts_notes (fact_id integer '
+                     'REFERENCES facts_table (id))')
+        self.assertRaises(ValueError, partition_fact_table, c, year)
+        bind.execute('DROP TABLE facts_notes')
+        query = c.query.axis(c.d['time'].l['month'])
+        expected = query.execute()
+        partition_fact_table(c, year)
+        assert self._partitions('facts_table')[0] == 'facts_table_20090101'
+        assert query.execute() == expected
+        # The partition column is added to the keys
+        keys = dict(bind.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = 'facts_table'::regclass "
+            "AND contype IN ('p', 'u')").fetchall())
+        assert keys == {'facts_table_pkey': 'PRIMARY KEY (id, date)',
+                        'facts_table_store_key': 'UNIQUE (id, store_id, date)'}
+        # The sequence of the key is kept
+        c.table.insert({'store_id': 1, 'product_id': 2,
+                        'date': '2012-03-01', 'qty': 10,
+                        'price': 100}).execute()
+        assert bind.execute(
+            'SELECT max(id) = count(*) FROM facts_table').scalar()
@@ -1,5 +1,12 @@
-from pypet import ComputedLevel, Hierarchy, Dimension, Query, Member
-from sqlalchemy.sql import func, extract, cast, select
+from pypet import (ComputedLevel, KeyEncoding, Hierarchy, Dimension, Query,
+                   Member)
+from pypet.ddl import (InsertFromSelect, CreateFunction, DropFunction,
+                       CreateTrigger)
+from sqlalchemy.schema import Table, Column, ForeignKey
+from sqlalchemy.sql import (func, extract, cast, select, literal_column,
+                            type_coerce, text)
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy import types
 
 to_char = func.to_char
@@ -10,21 +17,85 @@ FORMAT_FUNCTIONS = {
         'day': lambda x: to_char(x, 'YYYY-MM-DD'),
 }
 
+# The length of the date_trunc time slices not spanning exactly one unit.
+INTERVALS = {
+        'quarter': '3 months',
+        'decade': '10 years',
+        'century': '100 years',
+        'millennium': '1000 years',
+}
+
+EPOCH = cast('1970-01-01', types.Date)
+
+# Stores the time levels ids in the aggregates as their number of days since
+# the epoch. Being the same for every time slice, the keys of a level can be
+# rolled up to the coarser ones.
+DAY_NUMBERS = KeyEncoding(
+    types.Integer(),
+    encode=lambda id: type_coerce(cast(id, types.Date) - EPOCH,
+                                  types.Integer),
+    decode=lambda key: type_coerce(EPOCH + key, types.Date))
+
 
 class TimeLevel(ComputedLevel):
 
-    def __init__(self, name, column, time_slice=None):
+    def __init__(self, name, column, time_slice=None, date_table=None,
+                 integer_keys=False):
+        """```integer_keys```: if True, the aggregates built for this level
+        store its ids as integers (see ```DAY_NUMBERS```) instead of
+        timestamps. The ids are still returned in the queries results."""
         if time_slice is None:
             time_slice = name
+        self.time_slice = time_slice
+        self.date_table = date_table
+
+        def from_date_table(function):
+            # The date table holds the precomputed values.
+            def partial(column):
+                if self._reads_date_table(column):
+                    return column
+                return function(column)
+            return partial
 
         def partial_trunc(column):
             return func.date_trunc(time_slice, column)
 
         def partial_extract(column):
             return extract(time_slice, column)
+
+        def partial_bounds(key):
+            interval = INTERVALS.get(time_slice, '1 %s' % time_slice)
+            return key, key + cast(interval, types.Interval)
+
         label_expression = FORMAT_FUNCTIONS.get(time_slice, partial_extract)
+        label_column = None
+        if date_table is not None:
+            column = date_table.c[time_slice]
+            label_column = date_table.c['%s_label' % time_slice]
         super(TimeLevel, self).__init__(name, column,
-                function=partial_trunc, label_expression=label_expression)
+                function=from_date_table(partial_trunc),
+                label_expression=from_date_table(label_expression),
+                bounds=partial_bounds,
+                encoding=DAY_NUMBERS if integer_keys else None)
+        if label_column is not None:
+            self.label_column = label_column
+
+    def _reads_date_table(self, column):
+        # Subqueries columns proxy the date table columns they select.
+        return self.date_table is not None and any(
+            getattr(proxied, 'table', None) is self.date_table
+            for proxied in getattr(column, 'proxy_set', ()))
+
+    def _as_selects(self, cuboid=None):
+        selects = super(TimeLevel, self)._as_selects(cuboid)
+        if self._reads_date_table(self.column):
+            self._join_date_table(selects)
+        return selects
+
+    def _join_date_table(self, selects):
+        for select in selects:
+            select.joins.append(self.date_table)
+            self._join_date_table(select.dependencies)
 
     def __getitem__(self, key):
         bind = self.column.table.bind
@@ -35,9 +106,156 @@ class TimeLevel(ComputedLevel):
         return Member(self, values.id, values.label)
 
 
+def date_dimension_table(metadata, name, time_slices):
+    """Returns a date dimension table, keyed by date, holding the id and the
+    label of each time slice for the date."""
+    columns = [Column('date', types.Date, primary_key=True)]
+    for time_slice in time_slices:
+        columns.append(Column(time_slice, types.DateTime(timezone=True),
+                              nullable=False, index=True))
+        label_type = (types.String if time_slice in FORMAT_FUNCTIONS
+                      else types.Float)
+        columns.append(Column('%s_label' % time_slice, label_type,
+                              nullable=False))
+    return Table(name, metadata, *columns)
+
+
 class TimeDimension(Dimension):
 
-    def __init__(self, name, column, time_levels):
-        levels = [TimeLevel(level, column) for level in time_levels]
+    def __init__(self, name, column, time_levels, date_table=None,
+                 integer_keys=False):
+        """Creates a dimension whose levels are computed from a date column.
+
+        ```date_table```: optionally, the name of a date dimension table. The
+        levels ids and labels are then computed once for each date in this
+        table, and read from it instead of being computed for each fact
+        row. The fact table column is declared as referencing it, so that
+        they can be joined. See ```populate_date_table```.
+
+        ```integer_keys```: see ```TimeLevel```.
+        """
+        self.column = column
+        self.date_table = None
+        if date_table is not None:
+            self.date_table = date_dimension_table(column.table.metadata,
+                                                   date_table, time_levels)
+            if not column.references(self.date_table.c.date):
+                column.append_foreign_key(ForeignKey(self.date_table.c.date))
+        levels = [TimeLevel(level, column, date_table=self.date_table,
+                            integer_keys=integer_keys)
+                  for level in time_levels]
         super(TimeDimension, self).__init__(name, [Hierarchy('default',
             levels)])
+
+    def _date_columns(self, day):
+        """Returns the columns of the date table row of the ```day``` date
+        expression."""
+        columns = [day.label('date')]
+        for level in self.levels.values()[1:]:
+            columns.append(func.date_trunc(level.time_slice, day)
+                           .label(level.time_slice))
+            columns.append(FORMAT_FUNCTIONS.get(
+                level.time_slice,
+                lambda x: extract(level.time_slice, x))(day)
+                .label('%s_label' % level.time_slice))
+        return columns
+
+    def populate_date_table(self, until=None):
+        """Creates the date table if needed, and adds the missing dates to
+        it, from the first fact date up to the last one, or to ```until```.
+
+        A trigger is also installed on the fact table, adding the date of
+        each inserted or updated fact to the date table when it is missing,
+        so that no fact is left out of the join.
+        """
+        table = self.date_table
+        if table is None:
+            raise ValueError('The %s dimension has no date table' % self.name)
+        bind = table.bind
+        conn = bind.connect()
+        tr = conn.begin()
+        try:
+            table.create(bind=conn, checkfirst=True)
+            first = func.min(self.column)
+            last = func.max(self.column)
+            if until is not None:
+                until = cast(until, types.Date)
+                first = func.coalesce(first, until)
+                last = func.greatest(last, until)
+            days = select([func.generate_series(
+                first, last, cast('1 day', types.Interval)).label('day')
+                ]).alias()
+            columns = self._date_columns(cast(days.c.day, types.Date))
+            conn.execute(InsertFromSelect(
+                table, select(columns),
+                destination=[column.name for column in columns],
+                on_conflict=['date']))
+            self._install_date_trigger(conn)
+            tr.commit()
+        except:
+            tr.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _install_date_trigger(self, conn):
+        """Installs the row level trigger adding the missing fact dates to
+        the date table.
+
+        Row level triggers firing in the order of their names, its
+        ```date_``` prefix makes it fire before the aggregates maintenance
+        triggers, which may read the date table. The row triggers of the
+        aggregates built by earlier versions, named with literal quotes
+        sorting before it, are renamed to their unquoted name.
+        """
+        fact_table = self.column.table
+        preparer = conn.dialect.identifier_preparer
+        for row in conn.execute(
+                text("SELECT tgname FROM pg_trigger "
+                     "WHERE tgrelid = CAST(:table AS regclass) "
+                     "AND tgname LIKE '\"%\"'"),
+                table=preparer.format_table(fact_table)):
+            conn.execute('ALTER TRIGGER %s ON %s RENAME TO %s' % (
+                preparer.quote_identifier(row.tgname),
+                preparer.format_table(fact_table),
+                preparer.quote_identifier(row.tgname.strip('"'))))
+        fn_name = 'date_%s_%s' % (fact_table.name, self.date_table.name)
+        conn.execute(DropFunction(fn_name, schema=fact_table.schema))
+        function_declaration = CreateFunction(
+            fn_name, {}, 'TRIGGER', DateTriggerBody(self),
+            schema=fact_table.schema)
+        conn.execute(function_declaration)
+        conn.execute(CreateTrigger(fn_name, 'BEFORE', ['INSERT', 'UPDATE'],
+                                   fact_table, 'ROW', function_declaration))
+
+
+class DateTriggerBody(ClauseElement):
+    """The body of the trigger function adding the date of the fact row to
+    the date table of a ```TimeDimension```."""
+
+    body_template = """
+        BEGIN
+        IF NEW.%(column)s IS NOT NULL THEN
+            %(insert)s;
+        END IF;
+        RETURN NEW;
+        END;
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+
+
+@compiles(DateTriggerBody)
+def visit_date_trigger_body(elt, compiler, **kw):
+    dimension = elt.dimension
+    column = compiler.dialect.identifier_preparer.quote_identifier(
+        dimension.column.name)
+    columns = dimension._date_columns(
+        cast(literal_column('NEW.%s' % column), types.Date))
+    return elt.body_template % dict(
+        column=column,
+        insert=compiler.process(InsertFromSelect(
+            dimension.date_table, select(columns),
+            destination=[c.name for c in columns],
+            on_conflict=['date']), **kw))